@@ -0,0 +1,62 @@
+import base64
+from collections import namedtuple
+
+# Expediente de um recurso (cadeira/profissional) num dia, em minutos desde 00:00.
+# busy: lista de (inicio, fim) — agendamentos e almoço.
+ResourceDay = namedtuple('ResourceDay', 'resource_id work_start work_end busy')
+
+
+def to_minutes(t):
+    return t.hour * 60 + t.minute
+
+
+def start_ranges(day, duration):
+    # Faixas [a, b] de inícios possíveis: lacunas livres com pelo menos `duration`.
+    ranges, cursor = [], day.work_start
+    for bs, be in sorted(day.busy):
+        if be <= bs or be <= cursor: continue
+        gap_end = min(bs, day.work_end)
+        if gap_end - cursor >= duration: ranges.append((cursor, gap_end - duration))
+        cursor = be
+        if cursor >= day.work_end: return ranges
+    if day.work_end - cursor >= duration: ranges.append((cursor, day.work_end - duration))
+    return ranges
+
+
+def available_starts(days, duration, step=15, not_before=None):
+    # Varredura única: junta as faixas livres de todos os recursos, une as que se
+    # sobrepõem e percorre a grade de `step` minutos uma vez. Um horário está livre
+    # se pelo menos um recurso comporta o serviço inteiro a partir dele.
+    ranges = sorted(r for day in days for r in start_ranges(day, duration))
+    if not ranges: return []
+    merged = [list(ranges[0])]
+    for a, b in ranges[1:]:
+        if a <= merged[-1][1]: merged[-1][1] = max(merged[-1][1], b)
+        else: merged.append([a, b])
+    anchor = min(day.work_start for day in days)
+    starts = []
+    for a, b in merged:
+        if not_before is not None: a = max(a, not_before)
+        t = anchor + -(-(a - anchor) // step) * step
+        while t <= b:
+            starts.append(t); t += step
+    return starts
+
+
+def find_free_resource(days, start, duration):
+    end = start + duration
+    for day in days:
+        if start < day.work_start or end > day.work_end: continue
+        if all(not (max(start, bs) < min(end, be)) for bs, be in day.busy): return day
+    return None
+
+
+def encode_starts(starts, origin, cell=5):
+    # Formato compacto: bit i ligado = horário livre em origin + i*cell minutos,
+    # bits em ordem little-endian dentro de cada byte, tudo em base64.
+    if not starts: return ''
+    bits = bytearray((starts[-1] - origin) // cell // 8 + 1)
+    for m in starts:
+        i = (m - origin) // cell
+        bits[i // 8] |= 1 << (i % 8)
+    return base64.b64encode(bytes(bits)).decode('ascii')
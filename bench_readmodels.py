@@ -0,0 +1,110 @@
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time as time_module
+import tracemalloc
+from datetime import date, timedelta
+
+# Compara a listagem de agendamentos do painel em dois caminhos:
+#   orm       Appointment.query...all() + service_info/resource (como o template antigo lia)
+#   projecao  appointment_rows(): SELECT das colunas usadas em tuplas nomeadas
+# Mede linhas/s (melhor de --repeticoes) e memória retida pela lista por 10 mil linhas.
+# Roda com um SQLite temporário e dados de exemplo, ou num banco informado.
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Benchmark das leituras por projeção.')
+    p.add_argument('--linhas', type=int, default=10000, help='agendamentos semeados')
+    p.add_argument('--recursos', type=int, default=3, help='cadeiras do estabelecimento de teste')
+    p.add_argument('--repeticoes', type=int, default=5)
+    p.add_argument('--database-url', help='banco a usar (padrão: SQLite temporário)')
+    return p.parse_args()
+
+
+# --- DADOS DE EXEMPLO ---
+def seed(appmod, rows, resources):
+    with appmod.app.app_context():
+        db = appmod.db
+        est = appmod.Establishment(name='Benchmark', url_prefix=f'bench-{os.getpid()}', is_active=True)
+        db.session.add(est); db.session.flush()
+        services = [appmod.Service(name=f'Serviço {i}', duration=30, price=40.0, establishment_id=est.id) for i in range(5)]
+        chairs = [appmod.Resource(name=f'Cadeira {i + 1}', establishment_id=est.id) for i in range(resources)]
+        db.session.add_all(services + chairs); db.session.commit()
+        start = date.today()
+        clients = [appmod.Client(establishment_id=est.id, name=f'Cliente {i}', phone='11999999999', phone_norm='11999999999', phone_local='999999999',
+                                 email=f'c{i}@example.com', email_norm=f'c{i}@example.com') for i in range(max(1, rows // 10))]
+        db.session.add_all(clients); db.session.commit()
+        appts = [{'client_id': clients[i % len(clients)].id,
+                  'appointment_date': start + timedelta(days=i // 200), 'appointment_time': appmod.time(9 + (i % 18) // 2, 30 * (i % 2)),
+                  'service_id': services[i % len(services)].id, 'resource_id': chairs[i % len(chairs)].id if chairs else None,
+                  'establishment_id': est.id, 'reminders_sent': 0, 'notified': False} for i in range(rows)]
+        # Direto na tabela: sem change_log nem invalidações, só os dados
+        for i in range(0, len(appts), 5000): db.session.execute(appmod.Appointment.__table__.insert(), appts[i:i + 5000])
+        db.session.commit()
+        return est.id
+
+
+# --- CAMINHOS MEDIDOS ---
+def via_orm(appmod, est_id, today):
+    A = appmod.Appointment
+    appts = A.query.filter(A.establishment_id == est_id, A.appointment_date >= today).order_by(A.appointment_date, A.appointment_time).all()
+    for a in appts: a.service_info.name, a.resource.name if a.resource else None
+    return appts
+
+
+def via_projection(appmod, est_id, today):
+    A = appmod.Appointment
+    return list(appmod.appointment_rows(A.establishment_id == est_id, A.appointment_date >= today))
+
+
+def measure(appmod, fn, est_id, repeats):
+    today = date.today()
+    best, count = float('inf'), 0
+    for _ in range(repeats):
+        with appmod.app.app_context():
+            started = time_module.perf_counter()
+            count = len(fn(appmod, est_id, today))
+            best = min(best, time_module.perf_counter() - started)
+            appmod.db.session.remove()
+    # Memória: o que fica retido enquanto a lista existe (inclui identity map no ORM)
+    with appmod.app.app_context():
+        gc.collect(); tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        result = fn(appmod, est_id, today)
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        retained = sum(s.size_diff for s in after.compare_to(before, 'filename'))
+        del result
+        appmod.db.session.remove()
+    return count, best, retained
+
+
+def main():
+    args = parse_args()
+    if not args.database_url:
+        args.database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench.db')
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ.setdefault('BREVO_API_KEY', '')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('BACKGROUND_SERVICES', 'post_fork')  # sem worker de lembretes no benchmark
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as appmod
+
+    est_id = seed(appmod, args.linhas, args.recursos)
+    print(f"\n{args.linhas} agendamentos, melhor de {args.repeticoes}")
+    print(f"{'caminho':<10} {'linhas':>7} {'ms':>8} {'linhas/s':>10} {'KB/10k linhas':>14}")
+    results = {}
+    for name, fn in (('orm', via_orm), ('projecao', via_projection)):
+        count, best, retained = measure(appmod, fn, est_id, args.repeticoes)
+        results[name] = (best, retained)
+        per_10k = retained / 1024 * 10000 / max(count, 1)
+        print(f"{name:<10} {count:>7} {best * 1000:>8.1f} {count / best:>10.0f} {per_10k:>14.0f}")
+    (t_orm, m_orm), (t_proj, m_proj) = results['orm'], results['projecao']
+    print(f"\nprojeção: {t_orm / t_proj:.1f}x mais rápida, {m_orm / max(m_proj, 1):.1f}x menos memória")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
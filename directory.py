@@ -0,0 +1,83 @@
+import threading
+import unicodedata
+from bisect import bisect_left
+from collections import namedtuple
+
+# Entrada do diretório: só estabelecimentos ativos entram no índice.
+Listing = namedtuple('Listing', 'id name url_prefix')
+
+
+def normalize(text):
+    # Minúsculas e sem acentos: "Salão" casa com "salao"
+    text = unicodedata.normalize('NFKD', (text or '').lower())
+    return ''.join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def tokens(text):
+    return [t for t in ''.join(ch if ch.isalnum() else ' ' for ch in normalize(text)).split() if t]
+
+
+# --- ÍNDICE DE PREFIXOS EM MEMÓRIA ---
+class DirectoryIndex:
+    # Lista ordenada de (termo, posição) com as palavras do nome, do url_prefix e dos
+    # serviços; uma busca é um bisect por palavra digitada (todas precisam casar com
+    # o prefixo de algum termo). Reconstruído inteiro quando a versão muda: a primeira
+    # carga bloqueia, as seguintes rodam numa thread e as buscas continuam no índice
+    # anterior até a troca.
+    def __init__(self, scan_limit=5000):
+        self.scan_limit = scan_limit
+        self.version, self._built = None, False
+        self._data = ([], [], [], [])  # (listings, nomes normalizados, termos, chaves)
+        self._lock = threading.Lock()
+
+    def ensure(self, version, load):
+        if self._built and version == self.version: return
+        if not self._lock.acquire(blocking=not self._built): return  # já há uma reconstrução em curso
+        if self._built:
+            threading.Thread(target=self._rebuild, args=(version, load), daemon=True).start()
+        else:
+            self._rebuild(version, load)
+
+    def _rebuild(self, version, load):
+        try:
+            if not self._built or version != self.version: self._build(load(), version)
+        finally:
+            self._lock.release()
+
+    def _build(self, entries, version):
+        # entries: [(Listing, [nomes de serviço])]
+        entries = sorted(entries, key=lambda e: normalize(e[0].name))
+        terms = set()
+        for pos, (listing, services) in enumerate(entries):
+            for text in (listing.name, listing.url_prefix, *services):
+                terms.update((t, pos) for t in tokens(text))
+        terms = sorted(terms)
+        # Troca atômica (uma atribuição): quem está lendo segue com o índice anterior
+        self._data = ([e[0] for e in entries], [normalize(e[0].name) for e in entries], terms, [t for t, _ in terms])
+        self.version, self._built = version, True
+
+    def _matches(self, keys, terms, prefix):
+        # (posições com algum termo começando por prefix, posições com o termo exato)
+        found, exact, i = set(), set(), bisect_left(keys, prefix)
+        while i < len(keys) and keys[i].startswith(prefix) and len(found) < self.scan_limit:
+            found.add(terms[i][1])
+            if keys[i] == prefix: exact.add(terms[i][1])
+            i += 1
+        return found, exact
+
+    def search(self, query, limit=20):
+        listings, names, terms, keys = self._data
+        words = tokens(query)
+        if not words: return listings[:limit]
+        hits, exact = None, {}
+        for word in sorted(words, key=len, reverse=True):  # a palavra mais longa filtra mais
+            found, whole = self._matches(keys, terms, word)
+            hits = found if hits is None else hits & found
+            if not hits: return []
+            for p in whole: exact[p] = exact.get(p, 0) + 1
+        # Nome começando pelo que foi digitado, depois mais palavras inteiras, depois alfabética
+        full = ' '.join(words)
+        return [listings[p] for p in sorted(hits, key=lambda p: (not names[p].startswith(full), -exact.get(p, 0), p))[:limit]]
+
+    def __len__(self):
+        return len(self._data[0])
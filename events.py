@@ -0,0 +1,101 @@
+import logging
+import queue
+import threading
+import time as time_module
+
+log = logging.getLogger('agenda.eventos')
+
+
+# --- ASSINATURA (UMA POR CONEXÃO SSE) ---
+class Subscription:
+    def __init__(self, establishment_id, buffer_size):
+        self.establishment_id = establishment_id
+        self.queue = queue.Queue(maxsize=buffer_size)
+        self.overflowed = False
+
+    def push(self, event):
+        try: self.queue.put_nowait(event)
+        except queue.Full:
+            # Cliente lento: em vez de crescer sem limite, pede ressincronização
+            self.overflowed = True
+
+    def get(self, timeout):
+        try: return self.queue.get(timeout=timeout)
+        except queue.Empty: return None
+
+
+# --- HUB PUBLICAR/ASSINAR ENTRE WORKERS ---
+class EventHub:
+    # Os workers do gunicorn não compartilham memória, então o hub de cada worker
+    # lê os eventos do banco (tabela de alterações) com UMA consulta por intervalo,
+    # independente do número de conexões, e distribui por estabelecimento.
+    # Sem assinantes, a thread fica parada e não consulta nada.
+    # Ids pulados pelo cursor são transações ainda não confirmadas (o id é reservado
+    # no INSERT, a confirmação pode vir depois de uma com id maior): ficam numa lista
+    # de lacunas relida a cada ciclo até aparecerem ou passarem `gap_ttl` segundos
+    # (transação desfeita).
+    def __init__(self, fetch_after, fetch_latest, interval=1.0, buffer_size=100, gap_ttl=30.0, max_gaps=1000):
+        self.fetch_after = fetch_after      # (after_id, gap_ids) -> [(id, establishment_id, event)]
+        self.fetch_latest = fetch_latest    # () -> id mais recente
+        self.interval = interval
+        self.buffer_size = buffer_size
+        self.gap_ttl = gap_ttl
+        self.max_gaps = max_gaps
+        self._gaps = {}  # id pulado -> quando foi visto (monotonic)
+        self._subs = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._cursor = None
+
+    def subscribe(self, establishment_id):
+        # O cursor é fixado aqui (e não na thread) para que a leitura de recuperação
+        # feita logo depois pela conexão cubra tudo que o hub ainda não entregou.
+        sub = Subscription(establishment_id, self.buffer_size)
+        with self._lock:
+            self._subs.setdefault(establishment_id, set()).add(sub)
+            if self._cursor is None: self._cursor = self.fetch_latest()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='event-hub', daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subs.get(sub.establishment_id)
+            if subs:
+                subs.discard(sub)
+                if not subs: del self._subs[sub.establishment_id]
+
+    def subscriber_count(self):
+        with self._lock: return sum(len(s) for s in self._subs.values())
+
+    def _run(self):
+        while True:
+            with self._lock:
+                idle = not self._subs
+                if idle: self._cursor = None; self._gaps.clear(); self._wake.clear()
+            if idle:
+                self._wake.wait()
+                continue
+            try:
+                self._poll()
+            except Exception:
+                log.exception("Erro no hub de eventos.")
+            time_module.sleep(self.interval)
+
+    def _poll(self):
+        now = time_module.monotonic()
+        for event_id, establishment_id, event in self.fetch_after(self._cursor, sorted(self._gaps)):
+            if event_id > self._cursor:
+                # Salto grande demais (sequência reiniciada, importação) não vira lacuna
+                if event_id - self._cursor <= self.max_gaps:
+                    for missing in range(self._cursor + 1, event_id): self._gaps[missing] = now
+                self._cursor = event_id
+            elif self._gaps.pop(event_id, None) is None:
+                continue
+            with self._lock: targets = list(self._subs.get(establishment_id, ()))
+            for sub in targets: sub.push(event)
+        for gap in [g for g, seen in self._gaps.items() if now - seen > self.gap_ttl]: del self._gaps[gap]
+        while len(self._gaps) > self.max_gaps: del self._gaps[min(self._gaps)]
@@ -0,0 +1,33 @@
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+
+# --- {% cache %} PARA FRAGMENTOS DE TEMPLATE ---
+class FragmentCacheExtension(Extension):
+    # Uso: {% cache 'servicos', establishment.id, establishment.content_version %}...{% endcache %}
+    # A chave inclui a versão do estabelecimento, então uma alteração gera uma chave
+    # nova e o fragmento antigo simplesmente sai pelo LRU (sharedcache.LRUCache); não há
+    # invalidação explícita.
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'): parts.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cached', [nodes.List(parts)]), [], [], body).set_lineno(lineno)
+
+    def _cached(self, parts, caller):
+        cache = self.environment.fragment_cache
+        if cache is None: return caller()
+        key = 'fragmento:' + ':'.join(str(p) for p in parts)
+        html = cache.get(key)
+        if html is None:
+            html = str(caller())
+            cache.set(key, html)
+        return Markup(html)
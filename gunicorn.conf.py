@@ -0,0 +1,66 @@
+import gc
+import os
+import sys
+import time as time_module
+
+# Configuração do gunicorn (Procfile: gunicorn app:app -c gunicorn.conf.py)
+# Com preload o master importa Flask, SQLAlchemy e stripe uma vez e os workers
+# compartilham essas páginas via copy-on-write. O que não pode atravessar o fork
+# (conexões do pool e a thread de lembretes) é tratado nos hooks abaixo.
+# Para comparar com o modo antigo: GUNICORN_PRELOAD=0.
+
+os.environ.setdefault('BACKGROUND_SERVICES', 'post_fork')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', '8'))
+# Cada aba do painel com o stream de agendamentos (SSE) ocupa uma thread por até
+# 5 min. Por worker, no máximo SSE_MAX_STREAMS streams (padrão: metade das threads);
+# acima disso o stream responde 503 e a aba cai para o polling de 15 s. Capacidade
+# total de streams = workers x SSE_MAX_STREAMS; para mais abas abertas, aumente
+# WEB_THREADS (threads são baratas aqui: o stream fica parado esperando eventos).
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+_forked_at = {}
+
+
+def _memory_mb():
+    # RSS total e a parte ainda compartilhada com o master (Linux); fora do Linux só o RSS
+    rss = shared = None
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                if name == 'Rss': rss = int(value.split()[0]) / 1024
+                elif name in ('Shared_Clean', 'Shared_Dirty'): shared = (shared or 0) + int(value.split()[0]) / 1024
+    except OSError:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return rss, shared
+
+
+def when_ready(server):
+    # App já carregado no master: congela os objetos atuais para o GC não tocar
+    # nessas páginas nos workers (o que quebraria o compartilhamento copy-on-write)
+    if preload_app: gc.freeze()
+    rss, _ = _memory_mb()
+    server.log.info("Master pronto (preload=%s): RSS %.1f MB", preload_app, rss or 0)
+
+
+def pre_fork(server, worker):
+    _forked_at[worker.age] = time_module.perf_counter()
+
+
+def post_fork(server, worker):
+    appmod = sys.modules.get('app')
+    if appmod: appmod.dispose_engines()
+
+
+def post_worker_init(worker):
+    appmod = sys.modules.get('app')
+    if appmod: appmod.start_background_services()
+    boot = (time_module.perf_counter() - _forked_at.get(worker.age, time_module.perf_counter())) * 1000
+    rss, shared = _memory_mb()
+    worker.log.info("Worker %s pronto em %.0f ms: RSS %.1f MB%s", worker.pid, boot, rss or 0,
+                    f" (compartilhado {shared:.1f} MB)" if shared is not None else '')
@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta
+
+# iCalendar (RFC 5545): linhas CRLF com no máximo 75 octetos, texto escapado.
+# Os horários do app são de Brasília (UTC-3 fixo, como get_now_brazil), então os
+# eventos saem em UTC e cada calendário converte para o fuso do usuário.
+BRAZIL_OFFSET = timedelta(hours=3)
+
+
+def escape_text(value):
+    return (value or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def fold(line):
+    data = line.encode('utf-8')
+    if len(data) <= 75: return line + '\r\n'
+    parts, start, limit = [], 0, 75
+    while start < len(data):
+        end = min(start + limit, len(data))
+        while end < len(data) and (data[end] & 0xC0) == 0x80: end -= 1  # não corta caractere UTF-8
+        parts.append(data[start:end].decode('utf-8'))
+        start, limit = end, 74  # linhas de continuação começam com um espaço
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def utc_stamp(local_dt):
+    return (local_dt + BRAZIL_OFFSET).strftime('%Y%m%dT%H%M%SZ')
+
+
+def header(calendar_name):
+    return ''.join(fold(line) for line in (
+        'BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Agenda Facil//Agendamentos//PT-BR', 'CALSCALE:GREGORIAN', 'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{escape_text(calendar_name)}', 'X-PUBLISHED-TTL:PT5M', 'REFRESH-INTERVAL;VALUE=DURATION:PT5M'))
+
+
+def footer():
+    return 'END:VCALENDAR\r\n'
+
+
+def event(uid, start, duration_minutes, summary, description, updated_at=None):
+    # start: datetime local (Brasília); updated_at: datetime UTC
+    stamp = (updated_at or datetime.utcnow()).strftime('%Y%m%dT%H%M%SZ')
+    return ''.join(fold(line) for line in (
+        'BEGIN:VEVENT', f'UID:{uid}', f'DTSTAMP:{stamp}', f'DTSTART:{utc_stamp(start)}',
+        f'DTEND:{utc_stamp(start + timedelta(minutes=duration_minutes))}',
+        f'SUMMARY:{escape_text(summary)}', f'DESCRIPTION:{escape_text(description)}', 'END:VEVENT'))
@@ -1,6 +1,10 @@
 import os
+import re
 import sys
+import time
+import hashlib
 import subprocess
+from importlib import metadata
 
 # --- DEPENDÊNCIAS ---
 REQUIREMENTS_TXT = r'''Flask
@@ -13,22 +17,49 @@ requests
 psycopg2-binary
 '''
 
-PROCFILE = r'''web: gunicorn app:app'''
+PROCFILE = r'''web: gunicorn app:app -c gunicorn.conf.py'''
 
 # --- APP.PY (Funcionalidades Completas V35) ---
 APP_PY = r'''import os
+import re
+import logging
+import hmac
+import secrets
+import json
 import threading
 import time as time_module
 import socket
+import tempfile
+import click
 import requests
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, Response, stream_with_context, render_template, send_from_directory, request, redirect, url_for, flash, jsonify, g, has_app_context, before_render_template, template_rendered
+from flask import session as cookie_session
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
 from datetime import datetime, time, timedelta
-from sqlalchemy import inspect
+from functools import wraps
+from collections import namedtuple
+from sqlalchemy import inspect, event, func, text, select, literal_column, tuple_, bindparam, case, or_
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from jinja2 import FileSystemBytecodeCache
 import stripe
+from ratelimit import RateLimiter, make_store
+from stripe_gateway import StripeCheckout, CircuitOpenError
+from passwords import PasswordHasher, HashPoolBusy
+from instrumentation import LatencyWindow
+from profiling import RequestProfiler
+from logconfig import setup_logging
+from events import EventHub
+from availability import ResourceDay, to_minutes, available_starts, find_free_resource, encode_starts
+from reminders import ReminderScheduler
+from directory import DirectoryIndex, Listing
+from fragcache import FragmentCacheExtension
+from sharedcache import LRUCache, make_cache
+import icsfeed
 
 # Timeout de segurança
 socket.setdefaulttimeout(15)
@@ -36,6 +67,19 @@ socket.setdefaulttimeout(15)
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'chave-v36-gold-restore'
 basedir = os.path.abspath(os.path.dirname(__file__))
+# Quantos proxies confiáveis acrescentam ao X-Forwarded-For antes do app: 1 no Render,
+# 2 com uma CDN na frente, 0 exposto direto (o cabeçalho é ignorado, não dá para forjar).
+# O IP do cliente fica em request.remote_addr.
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', '1'))
+if TRUSTED_PROXIES: app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=0, x_host=0)
+
+# --- LOGS (JSON, ESCRITA EM THREAD PRÓPRIA) ---
+# LOG_LEVEL geral, LOG_LEVELS por subsistema (ex: agenda.email=DEBUG), LOG_FORMAT=json|texto
+setup_logging(os.environ.get('LOG_LEVEL', 'INFO'), os.environ.get('LOG_LEVELS', ''), os.environ.get('LOG_FORMAT', 'json'))
+log_db = logging.getLogger('agenda.banco')
+log_email = logging.getLogger('agenda.email')
+log_reminders = logging.getLogger('agenda.lembretes')
+log_waitlist = logging.getLogger('agenda.espera')
 
 # --- BANCO DE DADOS (PERSISTÊNCIA POSTGRES) ---
 database_url = os.environ.get('DATABASE_URL')
@@ -46,9 +90,18 @@ app.config['SQLALCHEMY_DATABASE_URI'] = database_url or 'sqlite:///' + os.path.j
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 if not database_url:
-    print("⚠️ AVISO LOCAL: Usando SQLite. No Render, configure DATABASE_URL.")
+    log_db.warning("Usando SQLite local; em produção configure DATABASE_URL.")
 else:
-    print("✅ MODO PRODUÇÃO: Conectado ao PostgreSQL.")
+    log_db.info("Modo produção: banco configurado por DATABASE_URL.")
+
+# Réplica de leitura opcional para as rotas públicas (só SELECT; escrita sempre no primário)
+replica_url = os.environ.get('DATABASE_REPLICA_URL')
+if replica_url and replica_url.startswith("postgres://"):
+    replica_url = replica_url.replace("postgres://", "postgresql://", 1)
+if replica_url:
+    app.config['SQLALCHEMY_BINDS'] = {'replica': replica_url}
+READ_YOUR_WRITES_SECONDS = int(os.environ.get('READ_YOUR_WRITES_SECONDS', '30'))
+REPLICA_RETRY_SECONDS = int(os.environ.get('REPLICA_RETRY_SECONDS', '30'))
 
 # --- CONFIGURAÇÕES ---
 raw_key = os.environ.get('BREVO_API_KEY', '')
@@ -58,6 +111,56 @@ BREVO_SENDER_NAME = "Agenda Facil"
 
 stripe.api_key = os.environ.get('STRIPE_API_KEY')
 STRIPE_PRICE_ID = os.environ.get('STRIPE_PRICE_ID')
+# STRIPE_API_BASE permite apontar para um servidor falso local (ex: stripe-mock)
+stripe_checkout = StripeCheckout(
+    stripe.api_key, STRIPE_PRICE_ID,
+    timeout=(2.0, float(os.environ.get('STRIPE_TIMEOUT', '5'))),
+    api_base=os.environ.get('STRIPE_API_BASE'),
+    session_ttl=int(os.environ.get('STRIPE_SESSION_TTL', '3600')),
+)
+
+# Limite de requisições nas rotas públicas (memory = por worker, sqlite = compartilhado)
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') != '0'
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_SQLITE_PATH = os.environ.get('RATE_LIMIT_SQLITE_PATH', os.path.join(basedir, 'ratelimit.db'))
+MAX_CONCURRENT_PUBLIC = int(os.environ.get('MAX_CONCURRENT_PUBLIC', '8'))
+
+# Cache compartilhado entre workers (memory = valores por worker, invalidação pelo arquivo
+# SQLite; sqlite = valores e invalidação no arquivo; redis = tudo no Redis). Uma
+# invalidação feita num worker chega aos outros em até CACHE_STAMP_TTL segundos.
+shared_cache = make_cache(
+    os.environ.get('CACHE_BACKEND', 'memory'),
+    os.environ.get('CACHE_SQLITE_PATH', os.path.join(basedir, 'cache.db')),
+    redis_url=os.environ.get('CACHE_REDIS_URL'),
+    max_entries=int(os.environ.get('CACHE_MAX_ENTRIES', '5000')),
+    stamp_ttl=float(os.environ.get('CACHE_STAMP_TTL', '2')),
+)
+AVAILABILITY_CACHE_TTL = int(os.environ.get('AVAILABILITY_CACHE_TTL', '300'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Perfil sob demanda: cabeçalho X-Profile (admin logado ou METRICS_TOKEN) ou amostragem
+profiler = RequestProfiler(
+    os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'agenda-facil-perfis')),
+    max_files=int(os.environ.get('PROFILE_MAX_FILES', '50')),
+    sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', '0')),
+)
+
+# Hash de senhas: método werkzeug completo (ex: scrypt:32768:8:1, pbkdf2:sha256:600000).
+# Senhas com outro método são refeitas no próximo login correto.
+password_hasher = PasswordHasher(
+    method=os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1'),
+    workers=int(os.environ.get('PASSWORD_HASH_WORKERS', '2')),
+    max_pending=int(os.environ.get('PASSWORD_HASH_QUEUE', '8')),
+)
+login_latency = LatencyWindow()
+
+# Excluir serviço: 1 = só marca deleted_at (histórico preservado); 0 = apaga serviço e agendamentos em lotes
+SERVICE_SOFT_DELETE = os.environ.get('SERVICE_SOFT_DELETE', '0') == '1'
+DELETE_CHUNK = int(os.environ.get('DELETE_CHUNK', '1000'))
+
+# Lembretes: minutos antes do horário, do maior para o menor (padrão 24h e 1h)
+REMINDER_OFFSETS = sorted((int(m) for m in os.environ.get('REMINDER_OFFSETS', '1440,60').split(',') if m.strip()), reverse=True)
+REMINDER_RECONCILE_SECONDS = int(os.environ.get('REMINDER_RECONCILE_SECONDS', '600'))
 
 UPLOAD_FOLDER = os.path.join(basedir, 'static', 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
@@ -66,7 +169,72 @@ if not os.path.exists(UPLOAD_FOLDER):
     try: os.makedirs(UPLOAD_FOLDER)
     except OSError: pass
 
-db = SQLAlchemy(app)
+# --- TEMPLATES (CACHE DE BYTECODE E DE FRAGMENTOS) ---
+# Bytecode compilado fica em disco e é reaproveitado por todos os workers no boot
+JINJA_CACHE_DIR = os.environ.get('JINJA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'agenda-facil-jinja'))
+try:
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache(JINJA_CACHE_DIR)}
+except OSError: pass
+app.jinja_options = {**app.jinja_options, 'extensions': [*app.jinja_options.get('extensions', ()), FragmentCacheExtension]}
+fragment_cache = LRUCache(int(os.environ.get('FRAGMENT_CACHE_SIZE', '2000')))
+if os.environ.get('FRAGMENT_CACHE', '1') != '0': app.jinja_env.fragment_cache = fragment_cache
+
+template_latency = {}
+_render_started = threading.local()
+
+@before_render_template.connect_via(app)
+def _template_start(sender, template, context, **extra):
+    _render_started.at = time_module.perf_counter()
+
+@template_rendered.connect_via(app)
+def _template_done(sender, template, context, **extra):
+    started = getattr(_render_started, 'at', None)
+    if started is None: return
+    _render_started.at = None
+    template_latency.setdefault(template.name, LatencyWindow(512)).observe(time_module.perf_counter() - started)
+
+# --- PERFIL DE REQUISIÇÕES ---
+def metrics_token_ok(token):
+    return bool(METRICS_TOKEN) and hmac.compare_digest(token or '', METRICS_TOKEN)
+
+event.listen(Engine, 'before_cursor_execute', profiler.sql_start)
+event.listen(Engine, 'after_cursor_execute', profiler.sql_end)
+
+@app.before_request
+def _profile_start():
+    header = request.headers.get('X-Profile')
+    if not header and not profiler.sample_rate: return
+    forced = bool(header) and (metrics_token_ok(header) or current_user.is_authenticated)
+    if not profiler.wants(forced): return
+    est_id = current_user.establishment_id if current_user.is_authenticated else None
+    profiler.start({'path': request.path, 'metodo': request.method, 'est': est_id, 'amostra': not forced, 'em': datetime.utcnow().isoformat(timespec='seconds')})
+
+@app.after_request
+def _profile_finish(response):
+    if profiler.active():
+        name = profiler.finish(response.status_code)
+        if name: response.headers['X-Profile-Id'] = name
+    return response
+
+@app.teardown_request
+def _profile_abort(exc):
+    # Exceção sem tratamento: after_request não roda, mas o perfil ainda é salvo
+    if profiler.active(): profiler.finish(500)
+
+# --- ROTEAMENTO PRIMÁRIO/RÉPLICA ---
+replica_state = {'down_until': 0.0, 'leituras': 0, 'fallbacks': 0}
+
+class RoutingSession(FlaskSQLAlchemySession):
+    # Dentro de uma rota marcada com @read_replica, SELECTs vão para a réplica.
+    # Flush e qualquer outra instrução continuam no primário.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and has_app_context() and g.get('db_route') == 'replica'
+                and clause is not None and getattr(clause, 'is_select', False)):
+            return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Faça login.'
@@ -78,10 +246,22 @@ def get_now_brazil():
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def normalize_phone(phone):
+    # Só dígitos, sem zeros à esquerda nem o DDI 55: "+55 (11) 99999-0000" -> "11999990000"
+    digits = re.sub(r'\D', '', phone or '').lstrip('0')
+    return digits[2:] if len(digits) > 11 and digits.startswith('55') else digits
+
+def local_phone(phone_norm):
+    # Número sem o DDD (2 dígitos) quando há DDD: "11999990000" -> "999990000"
+    return phone_norm[2:] if len(phone_norm) >= 10 else phone_norm
+
+def normalize_email(email):
+    return (email or '').strip().lower()
+
 # --- ENVIO DE EMAIL (BREVO) ---
 def send_email(subject, recipient, body):
     if not BREVO_API_KEY:
-        print(f"\n⚠️ [EMAIL VIRTUAL] Sem chave API. Para: {recipient}")
+        log_email.info("E-mail não enviado: BREVO_API_KEY ausente.", extra={'destinatario': recipient, 'assunto': subject})
         return
 
     def _send_thread():
@@ -102,9 +282,11 @@ def send_email(subject, recipient, body):
         try:
             r = requests.post(url, json=payload, headers=headers)
             if r.status_code not in [200, 201, 202]:
-                print(f"\n❌ [BREVO ERRO] {r.text}")
+                log_email.error("Brevo recusou o e-mail.", extra={'status': r.status_code, 'resposta': r.text[:500], 'destinatario': recipient})
+            else:
+                log_email.debug("E-mail enviado.", extra={'destinatario': recipient, 'assunto': subject})
         except Exception as e:
-            print(f"\n❌ [ERRO CONEXÃO] {e}")
+            log_email.error("Falha de conexão com a Brevo.", extra={'erro': str(e), 'destinatario': recipient})
 
     threading.Thread(target=_send_thread).start()
 
@@ -118,21 +300,52 @@ class Establishment(db.Model):
     contact_email = db.Column(db.String(120), nullable=True)
     logo_filename = db.Column(db.String(100), nullable=True)
     is_active = db.Column(db.Boolean, default=False) 
+    content_version = db.Column(db.Integer, nullable=False, default=0)  # serviços/horários/recursos; chave do cache de fragmentos
+    ics_token = db.Column(db.String(64), unique=True, index=True, nullable=True)  # link secreto do feed .ics
     schedules = db.relationship('DaySchedule', backref='establishment', lazy=True, cascade="all, delete-orphan")
+    resources = db.relationship('Resource', backref='establishment', lazy=True, order_by='Resource.id')
     admins = db.relationship('Admin', backref='establishment', lazy=True)
     services = db.relationship('Service', backref='establishment', lazy=True)
     appointments = db.relationship('Appointment', backref='establishment', lazy=True)
 
+# Cadeira/profissional que atende em paralelo. Sem recursos cadastrados, o
+# estabelecimento atende um cliente por vez com o horário padrão.
+class Resource(db.Model):
+    __tablename__ = 'resources'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False)
+
 class DaySchedule(db.Model):
     __tablename__ = 'day_schedules'
     id = db.Column(db.Integer, primary_key=True)
     establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False)
+    resource_id = db.Column(db.Integer, db.ForeignKey('resources.id'), nullable=True)  # None = horário padrão
     day_index = db.Column(db.Integer, nullable=False)
     is_active = db.Column(db.Boolean, default=True)
     work_start = db.Column(db.Time, nullable=False, default=time(9, 0))
     work_end = db.Column(db.Time, nullable=False, default=time(18, 0))
     lunch_start = db.Column(db.Time, nullable=True)
     lunch_end = db.Column(db.Time, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Exceção do padrão semanal numa data: 'fechado' (dia todo), 'horario' (expediente
+# diferente, abre até dia normalmente fechado) ou 'bloqueio' (faixa indisponível).
+# resource_id nulo vale para todos os recursos.
+EXCEPTION_KINDS = {'fechado': 'Fechado', 'horario': 'Horário especial', 'bloqueio': 'Bloqueio'}
+
+class ScheduleException(db.Model):
+    __tablename__ = 'schedule_exceptions'
+    id = db.Column(db.Integer, primary_key=True)
+    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False)
+    resource_id = db.Column(db.Integer, db.ForeignKey('resources.id'), nullable=True)
+    date = db.Column(db.Date, nullable=False)
+    kind = db.Column(db.String(10), nullable=False)
+    start_time = db.Column(db.Time, nullable=True)
+    end_time = db.Column(db.Time, nullable=True)
+    reason = db.Column(db.String(100), nullable=True)
+    resource = db.relationship('Resource', lazy=True)
+    __table_args__ = (db.Index('ix_schedule_exceptions_est_date', 'establishment_id', 'date'),)
 
 class Admin(UserMixin, db.Model):
     __tablename__ = 'admins'
@@ -140,8 +353,16 @@ class Admin(UserMixin, db.Model):
     username = db.Column(db.String(50), unique=True, nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
     establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False)
-    def set_password(self, password): self.password_hash = generate_password_hash(password)
-    def check_password(self, password): return check_password_hash(self.password_hash, password)
+    def set_password(self, password): self.password_hash = password_hasher.hash(password)
+    def check_password(self, password): return password_hasher.verify(self.password_hash, password)
+    def unit_ids(self): return [self.establishment_id, *db.session.execute(select(OwnerUnit.establishment_id).where(OwnerUnit.admin_id == self.id)).scalars()]
+
+# Dono de rede: além da própria unidade, o admin acompanha outras no painel consolidado
+class OwnerUnit(db.Model):
+    __tablename__ = 'owner_units'
+    admin_id = db.Column(db.Integer, db.ForeignKey('admins.id'), primary_key=True)
+    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), primary_key=True, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Service(db.Model):
     __tablename__ = 'services'
@@ -150,66 +371,635 @@ class Service(db.Model):
     duration = db.Column(db.Integer, nullable=False)
     price = db.Column(db.Float, nullable=False, default=0.0)
     establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False)
-    appointments = db.relationship('Appointment', backref='service_info', lazy=True, cascade="all, delete-orphan")
-
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    deleted_at = db.Column(db.DateTime, nullable=True)  # exclusão lógica (SERVICE_SOFT_DELETE)
+    # passive_deletes: excluir o serviço não carrega o histórico; os agendamentos saem antes, em lotes
+    appointments = db.relationship('Appointment', backref='service_info', lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+
+def live_services():
+    return Service.query.filter(Service.deleted_at.is_(None))
+
+# Cliente do estabelecimento, identificado pelo telefone + e-mail normalizados. Os campos
+# client_* do agendamento continuam como registro do que foi digitado em cada reserva.
+class Client(db.Model):
+    __tablename__ = 'clients'
+    id = db.Column(db.Integer, primary_key=True)
+    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False)
+    name = db.Column(db.String(150), nullable=False)
+    phone = db.Column(db.String(20), nullable=False)
+    email = db.Column(db.String(120), nullable=False)
+    phone_norm = db.Column(db.String(20), nullable=False)
+    phone_local = db.Column(db.String(20))  # phone_norm sem o DDD: busca por "98888" sem digitar a área
+    email_norm = db.Column(db.String(120), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.UniqueConstraint('establishment_id', 'phone_norm', 'email_norm', name='uq_clients_est_contact'), db.Index('ix_clients_est_email', 'establishment_id', 'email_norm'),
+                      db.Index('ix_clients_est_phone_local', 'establishment_id', 'phone_local'))
+
+# Nome, telefone e e-mail do cliente ficam só em clients (client_id)
 class Appointment(db.Model):
     __tablename__ = 'appointments'
     id = db.Column(db.Integer, primary_key=True)
-    client_name = db.Column(db.String(150), nullable=False)
-    client_phone = db.Column(db.String(20), nullable=False)
-    client_email = db.Column(db.String(120), nullable=False)
     appointment_date = db.Column(db.Date, nullable=False)
     appointment_time = db.Column(db.Time, nullable=False)
-    notified = db.Column(db.Boolean, default=False)
-    service_id = db.Column(db.Integer, db.ForeignKey('services.id'), nullable=False)
+    notified = db.Column(db.Boolean, default=False)  # lembrete final (menor antecedência) enviado
+    reminders_sent = db.Column(db.Integer, nullable=False, default=0)  # bit i = REMINDER_OFFSETS[i]
+    service_id = db.Column(db.Integer, db.ForeignKey('services.id', ondelete='CASCADE'), nullable=False)
     establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False)
+    resource_id = db.Column(db.Integer, db.ForeignKey('resources.id'), nullable=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True)  # nulo só até o backfill
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    resource = db.relationship('Resource', lazy=True)
+    client = db.relationship('Client', lazy=True)
+    __table_args__ = (db.Index('ix_appointments_est_date', 'establishment_id', 'appointment_date'), db.Index('ix_appointments_date', 'appointment_date'),
+                      db.Index('ix_appointments_client_date', 'client_id', 'appointment_date'))
+
+# Lista de espera: o cliente pede um serviço num período (e opcionalmente numa faixa
+# de horário); quando um agendamento é cancelado, a primeira inscrição que couber
+# recebe a oferta. status: aguardando -> ofertado.
+class WaitlistEntry(db.Model):
+    __tablename__ = 'waitlist'
+    id = db.Column(db.Integer, primary_key=True)
+    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False)
+    service_id = db.Column(db.Integer, db.ForeignKey('services.id', ondelete='CASCADE'), nullable=False)
+    client_name = db.Column(db.String(150), nullable=False)
+    client_phone = db.Column(db.String(20), nullable=False)
+    client_email = db.Column(db.String(120), nullable=False)
+    date_from = db.Column(db.Date, nullable=False)
+    date_to = db.Column(db.Date, nullable=False)
+    window_start = db.Column(db.Time, nullable=True)  # None = qualquer horário
+    window_end = db.Column(db.Time, nullable=True)
+    status = db.Column(db.String(10), nullable=False, default='aguardando')
+    offered_date = db.Column(db.Date, nullable=True)
+    offered_time = db.Column(db.Time, nullable=True)
+    offered_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # date_to na chave: inscrições de datas passadas (o histórico que cresce) ficam fora da faixa lida
+    __table_args__ = (db.Index('ix_waitlist_est_date', 'establishment_id', 'date_to'),)
+
+# Vaga liberada a casar com a lista de espera. Gravada na mesma transação do
+# cancelamento: qualquer processo com os serviços de fundo consome, não só o que
+# atendeu a requisição. claimed_at marca quem pegou (e libera de novo se travar).
+class WaitlistJob(db.Model):
+    __tablename__ = 'waitlist_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    establishment_id = db.Column(db.Integer, nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    base_url = db.Column(db.String(255), nullable=False)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Registro de alterações por estabelecimento (id = versão). op: insert/update/delete;
+# exclusões ficam como lápide, então o painel sincroniza só o que mudou desde a última versão.
+class ChangeLog(db.Model):
+    __tablename__ = 'change_log'
+    id = db.Column(db.Integer, primary_key=True)
+    establishment_id = db.Column(db.Integer, nullable=False)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)
+    data = db.Column(db.Text, nullable=True)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (db.Index('ix_change_log_est_version', 'establishment_id', 'id'), db.Index('ix_change_log_changed_at', 'changed_at'))
+
+def _snapshot_appointment(session, a):
+    svc = session.get(Service, int(a.service_id))
+    res = session.get(Resource, a.resource_id) if a.resource_id else None
+    client = a.client or (session.get(Client, a.client_id) if a.client_id else None)
+    return {'date': a.appointment_date.isoformat(), 'time': a.appointment_time.strftime('%H:%M'), 'client_name': client.name if client else '', 'client_phone': client.phone if client else '',
+            'service_name': svc.name if svc else '', 'resource_name': res.name if res else ''}
+
+def _snapshot_service(session, s):
+    return {'name': s.name, 'duration': s.duration, 'price': s.price}
+
+def _snapshot_schedule(session, d):
+    fmt = lambda t: t.strftime('%H:%M') if t else ''
+    return {'resource_id': d.resource_id, 'day_index': d.day_index, 'is_active': bool(d.is_active), 'work_start': fmt(d.work_start), 'work_end': fmt(d.work_end), 'lunch_start': fmt(d.lunch_start), 'lunch_end': fmt(d.lunch_end)}
+
+CONTENT_MODELS = (Establishment, Service, DaySchedule, Resource)
+AVAILABILITY_MODELS = (Appointment, Service, DaySchedule, Resource, ScheduleException)
+DIRECTORY_MODELS = (Establishment, Service)
+TRACKED_MODELS = {Appointment: ('appointment', _snapshot_appointment), Service: ('service', _snapshot_service), DaySchedule: ('schedule', _snapshot_schedule)}
+
+@event.listens_for(db.session, 'after_flush')
+def track_changes(session, flush_context):
+    rows = []
+    def add(obj, op):
+        entity, snapshot = TRACKED_MODELS[type(obj)]
+        data = json.dumps(snapshot(session, obj)) if op != 'delete' else None
+        rows.append({'establishment_id': obj.establishment_id, 'entity': entity, 'entity_id': obj.id, 'op': op, 'data': data, 'changed_at': datetime.utcnow()})
+    for obj in session.new:
+        if type(obj) in TRACKED_MODELS: add(obj, 'insert')
+    for obj in session.dirty:
+        # Exclusão lógica chega ao painel como exclusão
+        if type(obj) in TRACKED_MODELS and session.is_modified(obj, include_collections=False): add(obj, 'delete' if getattr(obj, 'deleted_at', None) else 'update')
+    for obj in session.deleted:
+        if type(obj) in TRACKED_MODELS: add(obj, 'delete')
+    if rows: session.connection().execute(ChangeLog.__table__.insert(), rows)
+    # Dados do estabelecimento, serviços, horários ou recursos mudaram: nova versão de conteúdo
+    changed = [*session.new, *session.deleted, *(o for o in session.dirty if session.is_modified(o, include_collections=False))]
+    touched = {obj.id if type(obj) is Establishment else obj.establishment_id for obj in changed if type(obj) in CONTENT_MODELS}
+    if touched:
+        est = Establishment.__table__
+        session.connection().execute(est.update().where(est.c.id.in_(touched)).values(content_version=est.c.content_version + 1))
+    # Agenda ou diretório mudaram: os namespaces do cache são invalidados quando a transação confirmar
+    stale = {f"disponibilidade:{obj.establishment_id}" for obj in changed if type(obj) in AVAILABILITY_MODELS}
+    if any(type(obj) in DIRECTORY_MODELS for obj in changed): stale.add('diretorio')
+    # Serviço removido: o id pode ser reaproveitado (SQLite) por outro estabelecimento
+    if any(type(obj) is Service for obj in session.deleted) or any(type(obj) is Service and obj.deleted_at for obj in session.dirty): stale.add('servicos')
+    if stale: session.info.setdefault('cache_stale', set()).update(stale)
+
+def invalidate_availability(*est_ids):
+    for est_id in est_ids: shared_cache.invalidate(f"disponibilidade:{est_id}")
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_after_commit(session):
+    for ns in session.info.pop('cache_stale', ()): shared_cache.invalidate(ns)
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_invalidations(session, previous_transaction):
+    session.info.pop('cache_stale', None)
+
+# --- LEITURAS POR PROJEÇÃO ---
+# Telas, exportações e worker só leem: SELECT apenas das colunas usadas (serviço e
+# recurso no mesmo JOIN) direto em tuplas nomeadas, sem identity map nem carregamento
+# preguiçoso. Escritas continuam pelo ORM.
+AppointmentRow = namedtuple('AppointmentRow', 'id appointment_date appointment_time client_name client_phone client_email updated_at service_name duration resource_name')
+
+def appointment_rows(*criteria, yield_per=None):
+    A, S, R, C = Appointment.__table__, Service.__table__, Resource.__table__, Client.__table__
+    stmt = select(A.c.id, A.c.appointment_date, A.c.appointment_time, C.c.name, C.c.phone, C.c.email, A.c.updated_at, S.c.name, S.c.duration, R.c.name).select_from(
+        A.join(S, A.c.service_id == S.c.id).outerjoin(R, A.c.resource_id == R.c.id).outerjoin(C, A.c.client_id == C.c.id)).where(*criteria).order_by(A.c.appointment_date, A.c.appointment_time)
+    return map(AppointmentRow._make, db.session.execute(stmt, execution_options={'yield_per': yield_per} if yield_per else {}))
 
 @login_manager.user_loader
 def load_user(user_id): return Admin.query.get(int(user_id))
 
+# --- LEITURA NA RÉPLICA ---
+def read_replica(f):
+    # Usa a réplica, exceto logo após o visitante agendar (lê o que acabou de gravar)
+    # ou enquanto a réplica estiver marcada como fora do ar; se ela falhar no meio,
+    # a rota (somente leitura) é repetida no primário.
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not replica_url or cookie_session.get('rw_until', 0) > time_module.time() or time_module.monotonic() < replica_state['down_until']:
+            return f(*args, **kwargs)
+        g.db_route = 'replica'
+        try:
+            replica_state['leituras'] += 1
+            return f(*args, **kwargs)
+        except OperationalError as e:
+            log_db.warning("Réplica indisponível, usando o primário.", extra={'erro': str(e).splitlines()[0], 'pausa_s': REPLICA_RETRY_SECONDS})
+            replica_state['down_until'] = time_module.monotonic() + REPLICA_RETRY_SECONDS
+            replica_state['fallbacks'] += 1
+            db.session.rollback()
+            g.db_route = None
+            return f(*args, **kwargs)
+        finally:
+            g.db_route = None
+    return wrapper
+
+# --- LIMITE DE REQUISIÇÕES (ROTAS PÚBLICAS) ---
+# (taxa por segundo, rajada) por IP e por estabelecimento
+RATE_RULES = {
+    'horarios:ip': (2.0, 20), 'horarios:est': (20.0, 100),
+    'agendar:ip': (0.2, 5), 'agendar:est': (2.0, 20),
+    'login:ip': (0.2, 10), 'login:user': (0.05, 5),
+    'diretorio:ip': (5.0, 40),
+}
+rate_limiter = RateLimiter(make_store(RATE_LIMIT_BACKEND, RATE_LIMIT_SQLITE_PATH), RATE_RULES, max_concurrent=MAX_CONCURRENT_PUBLIC, enabled=RATE_LIMIT_ENABLED)
+
+def client_ip():
+    # Já resolvido pelo ProxyFix conforme TRUSTED_PROXIES
+    return request.remote_addr or '-'
+
+SERVICE_OWNER_TTL = 3600
+
+def establishment_of_service(sid):
+    # O dono de um serviço não muda, mas o id pode voltar em outro estabelecimento depois
+    # de excluído: exclusões invalidam 'servicos' e o TTL cobre o que escapar disso
+    if sid is None: return None
+    return shared_cache.get_or_set('servicos', sid, lambda: db.session.query(Service.establishment_id).filter_by(id=sid).scalar(), SERVICE_OWNER_TTL)
+
+def limitar(endpoint, est_key=None):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            status, wait = rate_limiter.check(endpoint, client_ip(), est_key(**kwargs) if est_key else None)
+            if status is None:
+                if rate_limiter.enter(endpoint):
+                    rate_limiter.metrics.ok(endpoint)
+                    try: return f(*args, **kwargs)
+                    finally: rate_limiter.leave()
+                status, wait = 503, 1
+            headers = {'Retry-After': str(max(1, int(wait + 0.999)))}
+            msg = 'Muitas requisições. Tente novamente em instantes.' if status == 429 else 'Sistema ocupado. Tente novamente em instantes.'
+            if request.path.startswith('/api/'): return jsonify({'erro': msg}), status, headers
+            return render_template('error_inactive.html', message=msg), status, headers
+        return wrapper
+    return decorator
+
+# --- DISPONIBILIDADE (RECURSOS EM PARALELO) ---
+def load_capacity(est_id, first, last):
+    # Quatro consultas fixas (recursos, horários da semana, exceções e agendamentos do
+    # período com duração), independente do número de recursos e de dias. Bloqueios
+    # entram na mesma lista de ocupação dos agendamentos. Agendamentos sem recurso
+    # (anteriores ao cadastro de cadeiras) contam para o primeiro recurso.
+    resource_ids = [r.id for r in db.session.query(Resource.id).filter_by(establishment_id=est_id).order_by(Resource.id)] or [None]
+    default, own = {}, {}
+    for ds in DaySchedule.query.filter_by(establishment_id=est_id).all():
+        if ds.resource_id is None: default[ds.day_index] = ds
+        else: own[ds.day_index, ds.resource_id] = ds
+    busy, closed, hours = {}, set(), {}
+    exceptions = db.session.query(ScheduleException.date, ScheduleException.resource_id, ScheduleException.kind, ScheduleException.start_time, ScheduleException.end_time).filter(
+        ScheduleException.establishment_id == est_id, ScheduleException.date >= first, ScheduleException.date <= last).all()
+    for d, rid, kind, st, et in exceptions:
+        for target in (resource_ids if rid is None else [rid]):
+            if kind == 'fechado': closed.add((d, target))
+            elif kind == 'horario': hours[d, target] = (to_minutes(st), to_minutes(et))
+            elif kind == 'bloqueio': busy.setdefault((d, target), []).append((to_minutes(st), to_minutes(et)))
+    rows = db.session.query(Appointment.appointment_date, Appointment.appointment_time, Appointment.resource_id, Service.duration).join(Service, Appointment.service_id == Service.id).filter(
+        Appointment.establishment_id == est_id, Appointment.appointment_date >= first, Appointment.appointment_date <= last).all()
+    for d, t, rid, duration in rows:
+        start = to_minutes(t)
+        busy.setdefault((d, rid if rid in resource_ids else resource_ids[0]), []).append((start, start + duration))
+    capacity, d = {}, first
+    while d <= last:
+        days = []
+        for rid in resource_ids:
+            if (d, rid) in closed: continue
+            ds = own.get((d.weekday(), rid), default.get(d.weekday()))
+            special = hours.get((d, rid))
+            if special is None and (not ds or not ds.is_active): continue
+            work_start, work_end = special or (to_minutes(ds.work_start), to_minutes(ds.work_end))
+            day_busy = busy.get((d, rid), [])
+            if ds and ds.lunch_start and ds.lunch_end: day_busy = day_busy + [(to_minutes(ds.lunch_start), to_minutes(ds.lunch_end))]
+            days.append(ResourceDay(rid, work_start, work_end, day_busy))
+        capacity[d] = days
+        d += timedelta(days=1)
+    return capacity
+
+def load_day_capacity(est_id, sel_date):
+    return load_capacity(est_id, sel_date, sel_date)[sel_date]
+
+def upsert_client(est_id, name, phone, email):
+    # Chamado com o estabelecimento já travado (lock_establishment): select + insert não disputam
+    phone_norm, email_norm = normalize_phone(phone), normalize_email(email)
+    client = Client.query.filter_by(establishment_id=est_id, phone_norm=phone_norm, email_norm=email_norm).first()
+    if client is None:
+        client = Client(establishment_id=est_id, phone_norm=phone_norm, phone_local=local_phone(phone_norm), email_norm=email_norm); db.session.add(client)
+    client.name, client.phone, client.email = name, phone, email
+    return client
+
+def lock_establishment(est_id):
+    # Serializa reservas do mesmo estabelecimento entre a checagem de horário e o insert
+    if db.engine.dialect.name == 'sqlite':
+        # SQLite não tem FOR UPDATE: uma escrita nula já pega o lock de escrita do banco
+        db.session.execute(text('UPDATE establishments SET id = id WHERE id = :id'), {'id': est_id})
+    else:
+        db.session.query(Establishment.id).filter_by(id=est_id).with_for_update().scalar()
+
+# --- EXCLUSÕES EM LOTE ---
+# DELETE por lotes de ids, cada lote na sua transação: memória constante, nenhum lock
+# longo e nada carregado na sessão. Bancos antigos não têm ON DELETE nas FKs (e o
+# SQLite nem as aplica por padrão), então os filhos saem explicitamente antes do pai.
+def delete_in_chunks(model, *criteria, before_delete=None):
+    table, total = model.__table__, 0
+    while True:
+        ids = db.session.execute(select(table.c.id).where(*criteria).limit(DELETE_CHUNK)).scalars().all()
+        if not ids: return total
+        if before_delete: before_delete(ids)
+        db.session.execute(table.delete().where(table.c.id.in_(ids)))
+        db.session.commit()
+        total += len(ids)
+
+def _appointment_tombstones(ids):
+    # Só agendamentos futuros aparecem no painel: lápide no change_log e lembrete cancelado
+    today = get_now_brazil().date()
+    rows = db.session.query(Appointment.id, Appointment.establishment_id).filter(Appointment.id.in_(ids), Appointment.appointment_date >= today).all()
+    if rows:
+        db.session.execute(ChangeLog.__table__.insert(), [{'establishment_id': r.establishment_id, 'entity': 'appointment', 'entity_id': r.id, 'op': 'delete', 'data': None, 'changed_at': datetime.utcnow()} for r in rows])
+    for r in rows: reminder_scheduler.cancel(r.id)
+
+def purge_establishment(est_id):
+    est = db.session.get(Establishment, est_id)
+    if est is None: return None
+    logo = est.logo_filename
+    est.is_active = False; db.session.commit()  # fecha a agenda pública antes de começar
+    counts = {
+        'agendamentos': delete_in_chunks(Appointment, Appointment.establishment_id == est_id),
+        'clientes': delete_in_chunks(Client, Client.establishment_id == est_id),
+        'alteracoes': delete_in_chunks(ChangeLog, ChangeLog.establishment_id == est_id),
+        'horarios': delete_in_chunks(DaySchedule, DaySchedule.establishment_id == est_id),
+        'excecoes': delete_in_chunks(ScheduleException, ScheduleException.establishment_id == est_id),
+        'recursos': delete_in_chunks(Resource, Resource.establishment_id == est_id),
+        'espera': delete_in_chunks(WaitlistEntry, WaitlistEntry.establishment_id == est_id),
+        'fila_espera': delete_in_chunks(WaitlistJob, WaitlistJob.establishment_id == est_id),
+        'servicos': delete_in_chunks(Service, Service.establishment_id == est_id),
+        'redes': db.session.execute(OwnerUnit.__table__.delete().where(or_(OwnerUnit.establishment_id == est_id, OwnerUnit.admin_id.in_(select(Admin.id).where(Admin.establishment_id == est_id))))).rowcount,
+        'admins': delete_in_chunks(Admin, Admin.establishment_id == est_id),
+    }
+    db.session.execute(Establishment.__table__.delete().where(Establishment.id == est_id)); db.session.commit()
+    invalidate_availability(est_id); shared_cache.invalidate('servicos')
+    if logo:
+        try: os.remove(os.path.join(app.config['UPLOAD_FOLDER'], logo))
+        except OSError: pass
+    log_db.info("Estabelecimento removido.", extra={'estabelecimento': est_id, **counts})
+    return counts
+
+@app.cli.command('purgar-estabelecimento')
+@click.argument('est_id', type=int)
+def purge_establishment_command(est_id):
+    # flask --app app purgar-estabelecimento <id>
+    counts = purge_establishment(est_id)
+    click.echo(f"Estabelecimento {est_id} não encontrado." if counts is None else f"Removido: {counts}")
+
+# --- LIMPEZA DO CHANGE_LOG ---
+# O painel só precisa das alterações desde que foi aberto; o que passou do horizonte
+# sai em lotes. A linha mais nova sempre fica: o menor id retido é o que diz ao
+# cliente se a versão dele ainda está coberta (senão, ressincronização completa).
+CHANGE_LOG_RETENTION_DAYS = int(os.environ.get('CHANGE_LOG_RETENTION_DAYS', '30'))
+CHANGE_LOG_PRUNE_SECONDS = 3600
+
+def prune_change_log():
+    newest = db.session.query(func.max(ChangeLog.id)).scalar()
+    if newest is None: return 0
+    return delete_in_chunks(ChangeLog, ChangeLog.changed_at < datetime.utcnow() - timedelta(days=CHANGE_LOG_RETENTION_DAYS), ChangeLog.id < newest)
+
+def change_log_worker():
+    while True:
+        try:
+            with app.app_context():
+                removed = prune_change_log()
+                if removed: log_db.info("Change log podado.", extra={'linhas': removed, 'retencao_dias': CHANGE_LOG_RETENTION_DAYS})
+        except Exception:
+            log_db.exception("Erro ao podar o change log.")
+        time_module.sleep(CHANGE_LOG_PRUNE_SECONDS)
+
 # --- WORKER DE NOTIFICAÇÕES ---
+def _reminder_label(minutes):
+    return f"{minutes // 60}h" if minutes % 60 == 0 else f"{minutes} min"
+
+def _load_pending_reminders(until):
+    with app.app_context():
+        today = get_now_brazil().date()
+        A = Appointment.__table__
+        rows = db.session.execute(select(A.c.id, A.c.appointment_date, A.c.appointment_time, A.c.reminders_sent).where(
+            A.c.appointment_date >= today, A.c.appointment_date <= until.date(), A.c.notified.isnot(True)))
+        return [(r.id, datetime.combine(r.appointment_date, r.appointment_time), r.reminders_sent or 0) for r in rows]
+
+def _send_reminder(appt_id, idx):
+    bit, final = 1 << idx, idx == len(REMINDER_OFFSETS) - 1
+    with app.app_context():
+        # Reserva atômica do lembrete: com vários workers, só um envia. O lembrete final
+        # já marca notified no mesmo UPDATE (não é alteração da agenda: fica fora do change_log)
+        A, E, C = Appointment.__table__, Establishment.__table__, Client.__table__
+        claimed = db.session.execute(A.update().where(A.c.id == appt_id, A.c.reminders_sent.op('&')(bit) == 0).values(
+            reminders_sent=A.c.reminders_sent.op('|')(bit), **({'notified': True} if final else {}))).rowcount
+        if not claimed: db.session.rollback(); return
+        db.session.commit()
+        appt = db.session.execute(select(A.c.id, A.c.appointment_date, A.c.appointment_time, C.c.name.label('client_name'), C.c.email.label('client_email'), A.c.establishment_id, E.c.name, E.c.contact_email).select_from(
+            A.join(E, A.c.establishment_id == E.c.id).join(C, A.c.client_id == C.c.id)).where(A.c.id == appt_id)).first()
+        label = _reminder_label(REMINDER_OFFSETS[idx])
+        when = appt.appointment_time.strftime('%H:%M') if final else f"{appt.appointment_date.strftime('%d/%m')} às {appt.appointment_time.strftime('%H:%M')}"
+        log_reminders.info("Enviando lembrete.", extra={'agendamento': appt.id, 'lembrete': label, 'estabelecimento': appt.establishment_id})
+        subj = f"Lembrete: {appt.name}"
+        body = f"Olá {appt.client_name},\n\nLembrete do seu horário: {when}."
+        send_email(subj, appt.client_email, body)
+        if appt.contact_email:
+             send_email("Alerta", appt.contact_email, f"Cliente {appt.client_name} em {label}.")
+
+reminder_scheduler = ReminderScheduler(REMINDER_OFFSETS, _load_pending_reminders, _send_reminder, get_now_brazil, reconcile_every=REMINDER_RECONCILE_SECONDS)
+
 def notification_worker():
-    print(">>> Robô de Notificações INICIADO (Background) <<<")
+    log_reminders.info("Robô de notificações iniciado.", extra={'pid': os.getpid(), 'antecedencias_min': REMINDER_OFFSETS})
+    reminder_scheduler.run()
+
+# --- LISTA DE ESPERA ---
+# Cancelamentos só gravam (est, data) em waitlist_jobs; a busca e o e-mail rodam na
+# thread da fila, fora da requisição do admin.
+WAITLIST_MAX_DAYS = 14
+WAITLIST_SCAN = 50  # inscrições avaliadas por vaga liberada
+WAITLIST_POLL_SECONDS = 5
+WAITLIST_CLAIM_SECONDS = 300  # job pego e não concluído nesse prazo volta para a fila
+waitlist_wake = threading.Event()  # atalho no mesmo processo; os outros veem no próximo ciclo
+
+def match_waitlist(est_id, d, base_url):
+    # Inscrições que cobrem `d`, pela ordem de chegada; a primeira cujo serviço cabe
+    # na agenda atual, dentro da faixa pedida, recebe a oferta. A marcação é atômica
+    # (UPDATE condicionado ao status): dois workers nunca ofertam a mesma inscrição.
+    now, W = get_now_brazil(), WaitlistEntry
+    if d < now.date(): return None
+    entries = W.query.filter(W.establishment_id == est_id, W.date_to >= d, W.date_from <= d, W.status == 'aguardando').order_by(W.id).limit(WAITLIST_SCAN).all()
+    if not entries: return None
+    services = {s.id: s for s in live_services().filter(Service.id.in_({e.service_id for e in entries}))}
+    days = load_day_capacity(est_id, d)
+    cut = to_minutes(now) + 1 if d == now.date() else None
+    starts = {}
+    for e in entries:
+        svc = services.get(e.service_id)
+        if svc is None: continue
+        if svc.id not in starts: starts[svc.id] = available_starts(days, svc.duration, step=15, not_before=cut)
+        lo, hi = to_minutes(e.window_start) if e.window_start else 0, to_minutes(e.window_end) if e.window_end else 24 * 60
+        m = next((m for m in starts[svc.id] if lo <= m <= hi), None)
+        if m is None: continue
+        t = time(m // 60, m % 60)
+        claimed = db.session.execute(W.__table__.update().where(W.id == e.id, W.status == 'aguardando').values(
+            status='ofertado', offered_date=d, offered_time=t, offered_at=datetime.utcnow())).rowcount
+        db.session.commit()
+        if not claimed: continue
+        est = db.session.get(Establishment, est_id)
+        log_waitlist.info("Vaga ofertada.", extra={'inscricao': e.id, 'estabelecimento': est_id, 'data': d.isoformat(), 'hora': t.strftime('%H:%M')})
+        send_email(f"Vagou um horário: {est.name}", e.client_email,
+                   f"Olá {e.client_name},\n\nVagou um horário para {svc.name} em {d.strftime('%d/%m')} às {t.strftime('%H:%M')}.\n"
+                   f"Quem agendar primeiro fica com a vaga: {base_url}b/{est.url_prefix}/agendar/{svc.id}")
+        return e.id
+    return None
+
+def claim_waitlist_job():
+    # UPDATE condicionado ao claimed_at lido: dois workers nunca pegam o mesmo job
+    J = WaitlistJob
+    stale = datetime.utcnow() - timedelta(seconds=WAITLIST_CLAIM_SECONDS)
+    job = J.query.filter(or_(J.claimed_at.is_(None), J.claimed_at < stale)).order_by(J.id).first()
+    if job is None: return None
+    claimed = db.session.execute(J.__table__.update().where(J.id == job.id, J.claimed_at.is_(None) if job.claimed_at is None else J.claimed_at == job.claimed_at).values(
+        claimed_at=datetime.utcnow())).rowcount
+    db.session.commit()
+    return job if claimed else claim_waitlist_job()
+
+def run_waitlist_jobs():
+    while True:
+        job = claim_waitlist_job()
+        if job is None: return
+        try: match_waitlist(job.establishment_id, job.date, job.base_url)
+        except Exception:
+            db.session.rollback()
+            log_waitlist.exception("Erro na lista de espera.", extra={'estabelecimento': job.establishment_id, 'data': job.date.isoformat()})
+        db.session.execute(WaitlistJob.__table__.delete().where(WaitlistJob.id == job.id)); db.session.commit()
+
+def waitlist_worker():
     while True:
         try:
-            with app.app_context():
-                inspector = inspect(db.engine)
-                if not inspector.has_table("appointments"): 
-                    time_module.sleep(10)
-                    continue
-                
-                upcoming = Appointment.query.filter(Appointment.notified == False).all()
-                now = get_now_brazil()
-                
-                for appt in upcoming:
-                    appt_dt = datetime.combine(appt.appointment_date, appt.appointment_time)
-                    time_diff = appt_dt - now
-                    minutes = time_diff.total_seconds() / 60
-                    
-                    if 50 <= minutes <= 70:
-                        print(f"⏰ Enviando e-mail para {appt.client_name} (Faltam {int(minutes)} min)")
-                        subj = f"Lembrete: {appt.establishment.name}"
-                        body = f"Olá {appt.client_name},\n\nLembrete do seu horário: {appt.appointment_time.strftime('%H:%M')}."
-                        send_email(subj, appt.client_email, body)
-                        if appt.establishment.contact_email:
-                             send_email("Alerta", appt.establishment.contact_email, f"Cliente {appt.client_name} em 1h.")
-                        appt.notified = True
-                        db.session.commit()
-        except Exception as e:
-            print(f"Erro Worker: {e}")
-        
-        time_module.sleep(60)
+            with app.app_context(): run_waitlist_jobs()
+        except Exception:
+            log_waitlist.exception("Erro ao ler a fila da lista de espera.")
+        waitlist_wake.wait(WAITLIST_POLL_SECONDS); waitlist_wake.clear()
+
+# --- MIGRAÇÕES LEVES ---
+# create_all() só cria tabelas novas; colunas e índices em tabelas existentes entram aqui.
+SCHEMA_COLUMNS = [
+    ('establishments', 'content_version', 'INTEGER NOT NULL DEFAULT 0'),
+    ('appointments', 'updated_at', 'TIMESTAMP'),
+    ('services', 'updated_at', 'TIMESTAMP'),
+    ('day_schedules', 'updated_at', 'TIMESTAMP'),
+    ('day_schedules', 'resource_id', 'INTEGER'),
+    ('appointments', 'resource_id', 'INTEGER'),
+    # Quem já tinha 'notified' recebeu o lembrete de 1h; não reenviar nenhum
+    ('appointments', 'reminders_sent', 'INTEGER NOT NULL DEFAULT 0', f"UPDATE appointments SET reminders_sent = {(1 << len(REMINDER_OFFSETS)) - 1} WHERE notified = :yes"),
+    ('appointments', 'client_id', 'INTEGER REFERENCES clients (id)'),
+    ('services', 'deleted_at', 'TIMESTAMP'),
+    ('establishments', 'ics_token', 'VARCHAR(64)'),
+    ('clients', 'phone_local', 'VARCHAR(20)'),
+]
+SCHEMA_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS ix_appointments_est_date ON appointments (establishment_id, appointment_date)',
+    'CREATE INDEX IF NOT EXISTS ix_appointments_date ON appointments (appointment_date)',
+    'CREATE INDEX IF NOT EXISTS ix_appointments_client_date ON appointments (client_id, appointment_date)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_establishments_ics_token ON establishments (ics_token)',
+    'CREATE INDEX IF NOT EXISTS ix_change_log_changed_at ON change_log (changed_at)',
+    'CREATE INDEX IF NOT EXISTS ix_clients_est_phone_local ON clients (establishment_id, phone_local)',
+]
+# A busca saiu de appointments para clients; remove os índices antigos e depois as colunas
+SCHEMA_DROPS = {
+    'postgresql': ['DROP INDEX IF EXISTS ix_appointments_est_phone', 'DROP INDEX IF EXISTS ix_appointments_est_email', 'DROP INDEX IF EXISTS ix_appointments_name_trgm'],
+    'sqlite': ['DROP INDEX IF EXISTS ix_appointments_est_phone', 'DROP INDEX IF EXISTS ix_appointments_est_email', 'DROP TRIGGER IF EXISTS appointments_fts_ai',
+               'DROP TRIGGER IF EXISTS appointments_fts_ad', 'DROP TRIGGER IF EXISTS appointments_fts_au', 'DROP TABLE IF EXISTS appointments_fts'],
+}
+SCHEMA_DROP_COLUMNS = [('appointments', 'phone_norm'), ('appointments', 'email_norm')]  # SQLite 3.35+
+# Cópias do cliente em cada agendamento: removidas depois que backfill_clients liga todos a clients
+LEGACY_CLIENT_COLUMNS = ['client_name', 'client_phone', 'client_email']
+# Busca por nome: trigramas no Postgres (LIKE '%...%' usa o índice GIN), FTS5 no SQLite
+# (tabela externa sincronizada por gatilhos). Se a extensão não estiver disponível a
+# busca continua funcionando, só que sem índice.
+SEARCH_INDEXES = {
+    'postgresql': [
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        'CREATE INDEX IF NOT EXISTS ix_clients_name_trgm ON clients USING gin (lower(name) gin_trgm_ops)',
+    ],
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS clients_fts USING fts5(name, content='clients', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        'CREATE TRIGGER IF NOT EXISTS clients_fts_ai AFTER INSERT ON clients BEGIN INSERT INTO clients_fts(rowid, name) VALUES (new.id, new.name); END',
+        "CREATE TRIGGER IF NOT EXISTS clients_fts_ad AFTER DELETE ON clients BEGIN INSERT INTO clients_fts(clients_fts, rowid, name) VALUES ('delete', old.id, old.name); END",
+        "CREATE TRIGGER IF NOT EXISTS clients_fts_au AFTER UPDATE OF name ON clients BEGIN INSERT INTO clients_fts(clients_fts, rowid, name) VALUES ('delete', old.id, old.name); INSERT INTO clients_fts(rowid, name) VALUES (new.id, new.name); END",
+    ],
+}
+search_state = {'fts': False}
+
+def detect_search_index():
+    # Olha o banco, não o resultado da migração: vale também para processos que não
+    # migram (AUTO_MIGRATE=0). Só o FTS5 do SQLite muda a consulta; trigramas são transparentes
+    search_state['fts'] = db.engine.dialect.name == 'sqlite' and inspect(db.engine).has_table('clients_fts')
+BACKFILL_BATCH = 1000
+
+def _client_ids(conn, keys):
+    clients, ids = Client.__table__, {}
+    for est_id in {k[0] for k in keys}:
+        phones = {k[1] for k in keys if k[0] == est_id}
+        for c in conn.execute(select(clients.c.id, clients.c.phone_norm, clients.c.email_norm).where(clients.c.establishment_id == est_id, clients.c.phone_norm.in_(phones))):
+            ids[est_id, c.phone_norm, c.email_norm] = c.id
+    return ids
+
+def backfill_clients():
+    # Agendamentos antigos viram clientes em lotes curtos, cada um na sua transação,
+    # para não segurar lock na tabela inteira. No lote, o nome mais recente vence.
+    # Lê as colunas client_* antigas por SQL: elas saíram do modelo e são removidas depois
+    appts, clients = Appointment.__table__, Client.__table__
+    link = appts.update().where(appts.c.id == bindparam('b_id')).values(client_id=bindparam('b_client'))
+    pending = text('SELECT id, establishment_id, client_name, client_phone, client_email FROM appointments WHERE client_id IS NULL ORDER BY id LIMIT :n')
+    while True:
+        with db.engine.begin() as conn:
+            rows = conn.execute(pending, {'n': BACKFILL_BATCH}).all()
+            if not rows: return
+            keys = {(r.establishment_id, normalize_phone(r.client_phone), normalize_email(r.client_email)): r for r in rows}
+            ids = _client_ids(conn, keys)
+            new = [{'establishment_id': k[0], 'phone_norm': k[1], 'phone_local': local_phone(k[1]), 'email_norm': k[2], 'name': r.client_name, 'phone': r.client_phone, 'email': r.client_email, 'created_at': datetime.utcnow()}
+                   for k, r in keys.items() if k not in ids]
+            if new:
+                conn.execute(clients.insert(), new)
+                ids = _client_ids(conn, keys)
+            conn.execute(link, [{'b_id': r.id, 'b_client': ids[r.establishment_id, normalize_phone(r.client_phone), normalize_email(r.client_email)]} for r in rows])
+
+def backfill_phone_local():
+    # Clientes de antes da coluna, em lotes curtos como backfill_clients
+    clients = Client.__table__
+    stmt = clients.update().where(clients.c.id == bindparam('b_id')).values(phone_local=bindparam('b_local'))
+    while True:
+        with db.engine.begin() as conn:
+            rows = conn.execute(select(clients.c.id, clients.c.phone_norm).where(clients.c.phone_local.is_(None)).order_by(clients.c.id).limit(BACKFILL_BATCH)).all()
+            if not rows: return
+            conn.execute(stmt, [{'b_id': r.id, 'b_local': local_phone(r.phone_norm)} for r in rows])
+
+def run_migrations():
+    insp = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table, column, ddl, *backfill in SCHEMA_COLUMNS:
+            if insp.has_table(table) and column not in {c['name'] for c in insp.get_columns(table)}:
+                conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+                for sql in backfill: conn.execute(text(sql), {'yes': True})
+        for ddl in SCHEMA_INDEXES: conn.execute(text(ddl))
+        for ddl in SCHEMA_DROPS.get(db.engine.dialect.name, []): conn.execute(text(ddl))
+        for table, column in SCHEMA_DROP_COLUMNS:
+            if insp.has_table(table) and column in {c['name'] for c in insp.get_columns(table)}:
+                conn.execute(text(f'ALTER TABLE {table} DROP COLUMN {column}'))
+    fts_existed = insp.has_table('clients_fts')
+    try:
+        with db.engine.begin() as conn:
+            for ddl in SEARCH_INDEXES.get(db.engine.dialect.name, []): conn.execute(text(ddl))
+            if db.engine.dialect.name == 'sqlite' and not fts_existed:
+                conn.execute(text("INSERT INTO clients_fts(clients_fts) VALUES ('rebuild')"))
+    except Exception as e:
+        log_db.warning("Índice de busca por nome indisponível; usando LIKE.", extra={'erro': str(e).splitlines()[0]})
+    if insp.has_table('appointments') and 'client_name' in {c['name'] for c in insp.get_columns('appointments')}:
+        backfill_clients()
+        with db.engine.begin() as conn:
+            for column in LEGACY_CLIENT_COLUMNS: conn.execute(text(f'ALTER TABLE appointments DROP COLUMN {column}'))
+    backfill_phone_local()
+
+def migrate():
+    # Entrada explícita (instalador, deploy): o erro propaga e o processo sai com código != 0.
+    # DDL só no primário: a réplica recebe o esquema pela replicação e, fora do ar, não
+    # pode impedir a migração (bind_key=None ignora SQLALCHEMY_BINDS)
+    with app.app_context():
+        db.create_all(bind_key=None)
+        run_migrations()
+        detect_search_index()
 
 # --- INICIALIZAÇÃO UNIVERSAL ---
+# No import a falha só é registrada para o app subir; AUTO_MIGRATE=0 deixa a migração para migrate()
+if os.environ.get('AUTO_MIGRATE', '1') != '0':
+    try: migrate()
+    except Exception as e:
+        log_db.exception("Erro na migração.")
 try:
-    with app.app_context():
-        db.create_all()
-except:
-    pass 
+    with app.app_context(): detect_search_index()
+except Exception as e:
+    log_db.warning("Não foi possível verificar o índice de busca; usando LIKE.", extra={'erro': str(e).splitlines()[0]})
 
-if not os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+# --- SERVIÇOS EM SEGUNDO PLANO ---
+def start_background_services():
     t = threading.Thread(target=notification_worker, daemon=True)
     t.start()
+    threading.Thread(target=waitlist_worker, daemon=True).start()
+    threading.Thread(target=change_log_worker, daemon=True).start()
+
+def dispose_engines():
+    # Depois do fork: descarta as conexões herdadas do master sem fechá-las (o socket é do master)
+    with app.app_context():
+        for engine in db.engines.values(): engine.dispose(close=False)
+
+# Com o gunicorn.conf.py o master só importa o app (preload); cada worker inicia os seus no post_fork.
+# BACKGROUND_SERVICES=off: nenhum (scripts que só importam o app, como a migração do instalador)
+if not os.environ.get('WERKZEUG_RUN_MAIN') == 'true' and os.environ.get('BACKGROUND_SERVICES') not in ('post_fork', 'off'):
+    start_background_services()
 
 
 # --- ROTAS DE PAGAMENTO ---
@@ -217,19 +1007,18 @@ if not os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
 @login_required
 def payment():
     if current_user.establishment.is_active: return redirect(url_for('admin_dashboard'))
-    if not stripe.api_key: flash('Erro Config: Chave Stripe ausente.', 'danger'); return redirect(url_for('login'))
+    if not stripe_checkout.configured: flash('Erro Config: Chave Stripe ausente.', 'danger'); return redirect(url_for('login'))
     try:
         domain = request.host_url
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{'price': STRIPE_PRICE_ID, 'quantity': 1}],
-            mode='subscription',
-            allow_promotion_codes=True,
+        checkout_url = stripe_checkout.checkout_url(
+            current_user.establishment_id,
+            current_user.establishment.contact_email,
             success_url=domain + 'pagamento/sucesso',
             cancel_url=domain + 'pagamento/cancelado',
-            customer_email=current_user.establishment.contact_email,
         )
-        return redirect(session.url, code=303)
+        return redirect(checkout_url, code=303)
+    except CircuitOpenError:
+        flash('Pagamento temporariamente indisponível. Tente novamente em alguns minutos.', 'warning'); return render_template('login.html')
     except Exception as e:
         flash(f'Erro Stripe: {str(e)}', 'danger'); return render_template('login.html')
 
@@ -237,6 +1026,7 @@ def payment():
 @login_required
 def payment_success():
     est = current_user.establishment; est.is_active = True; db.session.commit()
+    stripe_checkout.forget(est.id)
     flash('Assinatura Ativa!', 'success'); return redirect(url_for('admin_dashboard'))
 
 @app.route('/pagamento/cancelado')
@@ -254,6 +1044,11 @@ def register_business():
     if request.method == 'POST':
         username = request.form.get('username')
         is_master = (username == 'admin_demo') 
+        # Hash antes de gravar qualquer coisa: pool cheio não deixa estabelecimento sem admin
+        adm = Admin(username=username)
+        try: adm.set_password(request.form.get('password'))
+        except HashPoolBusy:
+            flash('Sistema ocupado. Tente novamente em instantes.', 'warning'); return render_template('register.html'), 503
         est = Establishment(
             name=request.form.get('business_name'),
             url_prefix=request.form.get('url_prefix').lower().strip(),
@@ -263,51 +1058,138 @@ def register_business():
         )
         db.session.add(est); db.session.commit()
         for i in range(7): db.session.add(DaySchedule(establishment_id=est.id, day_index=i, is_active=(i < 5), work_start=time(9,0), work_end=time(18,0)))
-        adm = Admin(username=username, establishment_id=est.id)
-        adm.set_password(request.form.get('password'))
+        adm.establishment_id = est.id
         db.session.add(adm); db.session.commit()
         login_user(adm)
         if is_master: return redirect(url_for('admin_dashboard'))
         return redirect(url_for('payment'))
     return render_template('register.html')
 
+# --- DIRETÓRIO PÚBLICO ---
+# Índice em memória por worker, só com estabelecimentos ativos; é reconstruído quando
+# o carimbo 'diretorio' do cache compartilhado muda (qualquer alteração em
+# estabelecimento ou serviço), então todos os workers se atualizam em até CACHE_STAMP_TTL.
+DIRECTORY_LIMIT = 20
+directory_index = DirectoryIndex()
+
+def _directory_entries():
+    # Pode rodar na thread de reconstrução: contexto próprio
+    with app.app_context(): return _load_directory()
+
+def _load_directory():
+    listings = [Listing(*r) for r in db.session.execute(select(Establishment.id, Establishment.name, Establishment.url_prefix).where(Establishment.is_active.is_(True)))]
+    services = {}
+    for est_id, name in db.session.execute(select(Service.establishment_id, Service.name).join(Establishment, Service.establishment_id == Establishment.id).where(
+            Establishment.is_active.is_(True), Service.deleted_at.is_(None))):
+        services.setdefault(est_id, []).append(name)
+    return [(l, services.get(l.id, [])) for l in listings]
+
+def search_directory(q):
+    directory_index.ensure(shared_cache.version('diretorio'), _directory_entries)
+    return directory_index.search(q, DIRECTORY_LIMIT)
+
+@app.route('/diretorio')
+def public_directory():
+    return render_template('diretorio.html', q=request.args.get('q', ''))
+
+@app.route('/api/diretorio')
+@limitar('diretorio')
+@read_replica
+def directory_api():
+    found = search_directory(request.args.get('q', '')[:100])
+    resp = jsonify([{'nome': l.name, 'url': url_for('establishment_services', url_prefix=l.url_prefix)} for l in found])
+    resp.headers['Cache-Control'] = 'public, max-age=30'
+    return resp
+
 @app.route('/b/<url_prefix>')
+@read_replica
 def establishment_services(url_prefix):
     est = Establishment.query.filter_by(url_prefix=url_prefix).first_or_404()
     if not est.is_active: return render_template('error_inactive.html', message="Estabelecimento temporariamente indisponível."), 403
-    services = Service.query.filter_by(establishment_id=est.id).order_by(Service.name).all()
+    services = live_services().filter_by(establishment_id=est.id).order_by(Service.name).all()
     return render_template('lista_servicos.html', services=services, establishment=est)
 
 @app.route('/b/<url_prefix>/agendar/<int:service_id>')
+@read_replica
 def schedule_service(url_prefix, service_id):
     est = Establishment.query.filter_by(url_prefix=url_prefix).first_or_404()
     if not est.is_active: return "Inativo", 403
-    service = Service.query.get_or_404(service_id)
+    service = live_services().filter_by(id=service_id, establishment_id=est.id).first_or_404()
     return render_template('agendamento.html', service=service, establishment=est)
 
 @app.route('/b/<url_prefix>/confirmar', methods=['POST'])
+@limitar('agendar', est_key=lambda url_prefix: url_prefix)
 def create_appointment(url_prefix):
     est = Establishment.query.filter_by(url_prefix=url_prefix).first_or_404()
+    if not est.is_active: return "Inativo", 403
+    lock_establishment(est.id)
     d = datetime.strptime(request.form.get('appointment_date'), '%Y-%m-%d').date()
     t = datetime.strptime(request.form.get('appointment_time'), '%H:%M').time()
     if datetime.combine(d, t) < get_now_brazil():
         flash('Horário inválido.', 'danger'); return redirect(url_for('schedule_service', url_prefix=url_prefix, service_id=request.form.get('service_id')))
-    appt = Appointment(client_name=request.form.get('client_name'), client_phone=request.form.get('client_phone'), client_email=request.form.get('client_email'), service_id=request.form.get('service_id'), appointment_date=d, appointment_time=t, establishment_id=est.id)
+    svc = live_services().filter_by(id=request.form.get('service_id', type=int), establishment_id=est.id).first_or_404()
+    slot = find_free_resource(load_day_capacity(est.id, d), to_minutes(t), svc.duration)
+    if slot is None:
+        db.session.rollback()
+        flash('Horário indisponível. Escolha outro.', 'danger'); return redirect(url_for('schedule_service', url_prefix=url_prefix, service_id=svc.id))
+    name, phone, email = request.form.get('client_name'), request.form.get('client_phone'), request.form.get('client_email')
+    appt = Appointment(client=upsert_client(est.id, name, phone, email), service_id=svc.id, resource_id=slot.resource_id, appointment_date=d, appointment_time=t, establishment_id=est.id)
     db.session.add(appt); db.session.commit()
+    reminder_scheduler.schedule(appt.id, datetime.combine(d, t))
+    if replica_url: cookie_session['rw_until'] = time_module.time() + READ_YOUR_WRITES_SECONDS
     
     zap_msg = f"Olá, confirmo agendamento: {d.strftime('%d/%m')} às {t.strftime('%H:%M')}."
     zap_link = f"https://wa.me/55{est.contact_phone}?text={zap_msg}" if est.contact_phone else "#"
     
-    send_email(f"Confirmado: {est.name}", appt.client_email, f"Agendado para {d.strftime('%d/%m')} às {t.strftime('%H:%M')}")
-    if est.contact_email: send_email(f"Novo Cliente: {appt.client_name}", est.contact_email, f"Novo agendamento.")
+    send_email(f"Confirmado: {est.name}", email, f"Agendado para {d.strftime('%d/%m')} às {t.strftime('%H:%M')}")
+    if est.contact_email: send_email(f"Novo Cliente: {name}", est.contact_email, f"Novo agendamento.")
     
     return render_template('success_appointment.html', appointment=appt, zap_link=zap_link)
 
+@app.route('/b/<url_prefix>/lista-espera', methods=['POST'])
+@limitar('agendar', est_key=lambda url_prefix: url_prefix)
+def join_waitlist(url_prefix):
+    est = Establishment.query.filter_by(url_prefix=url_prefix).first_or_404()
+    if not est.is_active: return "Inativo", 403
+    svc = live_services().filter_by(id=request.form.get('service_id', type=int), establishment_id=est.id).first_or_404()
+    back = redirect(url_for('schedule_service', url_prefix=url_prefix, service_id=svc.id))
+    parse_time = lambda v: datetime.strptime(v, '%H:%M').time() if v else None
+    try:
+        first = datetime.strptime(request.form.get('appointment_date') or '', '%Y-%m-%d').date()
+        last = datetime.strptime(request.form.get('date_to'), '%Y-%m-%d').date() if request.form.get('date_to') else first
+        ws, we = parse_time(request.form.get('window_start')), parse_time(request.form.get('window_end'))
+    except ValueError:
+        flash('Data ou horário inválido.', 'danger'); return back
+    name, phone, email = request.form.get('client_name'), request.form.get('client_phone'), request.form.get('client_email')
+    if first < get_now_brazil().date() or not first <= last <= first + timedelta(days=WAITLIST_MAX_DAYS) or (ws and we and ws >= we) or not (name and phone and email):
+        flash('Data ou horário inválido.', 'danger'); return back
+    db.session.add(WaitlistEntry(establishment_id=est.id, service_id=svc.id, client_name=name, client_phone=phone, client_email=email, date_from=first, date_to=last, window_start=ws, window_end=we))
+    db.session.commit()
+    flash('Você está na lista de espera! Avisaremos por e-mail se um horário vagar.', 'success')
+    return back
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
-        adm = Admin.query.filter_by(username=request.form.get('username')).first()
-        if adm and adm.check_password(request.form.get('password')):
+        username, password = request.form.get('username') or '', request.form.get('password') or ''
+        # Tentativas em excesso são recusadas antes de qualquer hash
+        status, wait = rate_limiter.check('login', client_ip(), username.strip().lower(), scope='user')
+        if status:
+            flash('Muitas tentativas. Aguarde alguns minutos.', 'danger')
+            return render_template('login.html'), status, {'Retry-After': str(max(1, int(wait + 0.999)))}
+        started = time_module.perf_counter()
+        try:
+            adm = Admin.query.filter_by(username=username).first()
+            ok = adm is not None and adm.check_password(password)
+        except HashPoolBusy:
+            flash('Sistema ocupado. Tente novamente em instantes.', 'warning'); return render_template('login.html'), 503
+        finally:
+            login_latency.observe(time_module.perf_counter() - started)
+        if ok:
+            if password_hasher.needs_rehash(adm.password_hash):
+                # Atualizar o hash é oportunista: com o pool cheio fica para o próximo login
+                try: adm.set_password(password); db.session.commit()
+                except HashPoolBusy: pass
             login_user(adm)
             if not adm.establishment.is_active: return redirect(url_for('payment'))
             return redirect(url_for('admin_dashboard'))
@@ -324,11 +1206,283 @@ def admin_dashboard():
     if not current_user.establishment.is_active: return redirect(url_for('payment'))
     est = current_user.establishment
     today = get_now_brazil().date()
-    appts = Appointment.query.filter(Appointment.establishment_id == est.id, Appointment.appointment_date >= today).order_by(Appointment.appointment_date, Appointment.appointment_time).all()
-    services = Service.query.filter_by(establishment_id=est.id).all()
-    schedules = DaySchedule.query.filter_by(establishment_id=est.id).order_by(DaySchedule.day_index).all()
+    appts = list(appointment_rows(Appointment.establishment_id == est.id, Appointment.appointment_date >= today))
+    services = live_services().filter_by(establishment_id=est.id).all()
+    resources = Resource.query.filter_by(establishment_id=est.id).order_by(Resource.id).all()
+    resource = next((r for r in resources if r.id == request.args.get('recurso', type=int)), None)
+    schedules = DaySchedule.query.filter_by(establishment_id=est.id, resource_id=resource.id if resource else None).order_by(DaySchedule.day_index).all()
     today_count = Appointment.query.filter(Appointment.establishment_id == est.id, Appointment.appointment_date == today).count()
-    return render_template('admin.html', appointments=appts, services=services, establishment=est, schedules=schedules, today_count=today_count)
+    # Versão global (não só do estabelecimento): fica acima do menor id retido mesmo
+    # para quem não muda nada há mais tempo que a retenção do change_log
+    sync_version = db.session.query(func.max(ChangeLog.id)).scalar() or 0
+    exceptions = ScheduleException.query.filter(ScheduleException.establishment_id == est.id, ScheduleException.date >= today).order_by(ScheduleException.date, ScheduleException.start_time).all()
+    return render_template('admin.html', appointments=appts, services=services, establishment=est, schedules=schedules, resources=resources, resource=resource, today_count=today_count, sync_version=sync_version,
+                           exceptions=exceptions, exception_kinds=EXCEPTION_KINDS)
+
+# --- PAINEL DA REDE (DONO DE VÁRIAS UNIDADES) ---
+# Uma consulta agrupada por métrica, para todas as unidades de uma vez: o custo não
+# cresce com o número de unidades (usa ix_appointments_est_date).
+def network_metrics(est_ids, today):
+    A, S = Appointment, Service
+    month_start = today.replace(day=1)
+    next_month = (month_start + timedelta(days=32)).replace(day=1)
+    def grouped(*cols, where):
+        q = db.session.query(A.establishment_id, *cols).join(S, A.service_id == S.id).filter(A.establishment_id.in_(est_ids), *where).group_by(A.establishment_id)
+        return {r[0]: r[1:] for r in q}
+    revenue = func.coalesce(func.sum(S.price), 0)
+    return {
+        'hoje': grouped(func.count(A.id), revenue, where=[A.appointment_date == today]),
+        'proximos': grouped(func.count(A.id), func.sum(case((A.appointment_date <= today + timedelta(days=7), 1), else_=0)), where=[A.appointment_date > today]),
+        'mes': grouped(revenue, where=[A.appointment_date >= month_start, A.appointment_date < next_month]),
+    }
+
+@app.route('/rede')
+@login_required
+def network_dashboard():
+    if not current_user.establishment.is_active: return redirect(url_for('payment'))
+    today = get_now_brazil().date()
+    ids = current_user.unit_ids()
+    units = Establishment.query.filter(Establishment.id.in_(ids)).order_by(Establishment.name).all()
+    m = network_metrics(ids, today)
+    rows = []
+    for e in units:
+        today_n, today_rev = m['hoje'].get(e.id, (0, 0))
+        future_n, week_n = m['proximos'].get(e.id, (0, 0))
+        rows.append({'est': e, 'propria': e.id == current_user.establishment_id, 'hoje': today_n, 'receita_hoje': float(today_rev),
+                     'semana': int(week_n or 0), 'futuros': future_n, 'receita_mes': float(m['mes'].get(e.id, (0,))[0])})
+    totals = {k: sum(r[k] for r in rows) for k in ('hoje', 'receita_hoje', 'semana', 'futuros', 'receita_mes')}
+    return render_template('rede.html', rows=rows, totals=totals, today=today)
+
+@app.route('/rede/vincular', methods=['POST'])
+@login_required
+def link_unit():
+    # O dono prova que controla a unidade com o login do admin dela
+    username, password = request.form.get('username') or '', request.form.get('password') or ''
+    status, _ = rate_limiter.check('login', client_ip(), username.strip().lower(), scope='user')
+    if status:
+        flash('Muitas tentativas. Aguarde alguns minutos.', 'danger'); return redirect(url_for('network_dashboard'))
+    adm = Admin.query.join(Establishment).filter(Admin.username == username, Establishment.url_prefix == (request.form.get('url_prefix') or '').lower().strip()).first()
+    try: ok = adm is not None and adm.check_password(password)
+    except HashPoolBusy:
+        flash('Sistema ocupado. Tente novamente em instantes.', 'warning'); return network_dashboard(), 503
+    if not ok:
+        flash('Unidade ou login inválido.', 'danger'); return redirect(url_for('network_dashboard'))
+    if adm.establishment_id != current_user.establishment_id and not db.session.get(OwnerUnit, (current_user.id, adm.establishment_id)):
+        db.session.add(OwnerUnit(admin_id=current_user.id, establishment_id=adm.establishment_id)); db.session.commit()
+    flash('Unidade vinculada!', 'success')
+    return redirect(url_for('network_dashboard'))
+
+@app.route('/rede/desvincular/<int:est_id>', methods=['POST'])
+@login_required
+def unlink_unit(est_id):
+    OwnerUnit.query.filter_by(admin_id=current_user.id, establishment_id=est_id).delete(); db.session.commit()
+    return redirect(url_for('network_dashboard'))
+
+# Sincronização incremental do painel: devolve só as alterações após `since`.
+# O id é reservado no INSERT, mas a transação pode confirmar depois de outra com id
+# maior que o cliente já leu. Por isso também relê as linhas gravadas nos últimos
+# SYNC_OVERLAP_SECONDS com id <= since (changed_at é a hora do INSERT; transações
+# aqui duram milissegundos). Cada alteração leva a própria versão e o cliente só
+# aplica a de versão maior que a última aplicada para aquela entidade.
+SYNC_OVERLAP_SECONDS = int(os.environ.get('SYNC_OVERLAP_SECONDS', '30'))
+SYNC_BATCH = 500
+
+def changes_after(est_id, since, *criteria):
+    cols = (ChangeLog.id, ChangeLog.entity, ChangeLog.entity_id, ChangeLog.op, ChangeLog.data)
+    rows = db.session.query(*cols).filter(ChangeLog.establishment_id == est_id, ChangeLog.id > since, *criteria).order_by(ChangeLog.id).limit(SYNC_BATCH).all()
+    recent = db.session.query(*cols).filter(ChangeLog.establishment_id == est_id, ChangeLog.id <= since, *criteria,
+                                            ChangeLog.changed_at >= datetime.utcnow() - timedelta(seconds=SYNC_OVERLAP_SECONDS)).order_by(ChangeLog.id).all() if since else []
+    return recent, rows
+
+def needs_resync(since):
+    # `since` anterior ao menor id retido: alterações no meio podem ter sido podadas
+    oldest = db.session.query(func.min(ChangeLog.id)).scalar()
+    return bool(since) and oldest is not None and since < oldest - 1
+
+@app.route('/admin/api/changes')
+@login_required
+def admin_changes():
+    since = max(0, request.args.get('since', 0, type=int))
+    today = get_now_brazil().date().isoformat()
+    if needs_resync(since): return jsonify({'resync': True, 'version': since, 'more': False, 'today': today, 'changes': []})
+    recent, rows = changes_after(current_user.establishment_id, since)
+    latest = {}
+    for r in recent + rows:
+        key = (r.entity, r.entity_id)
+        latest.pop(key, None)
+        latest[key] = _change_event(r)
+    return jsonify({
+        'version': max(since, rows[-1].id) if rows else since,
+        'more': len(rows) == SYNC_BATCH,
+        'today': today,
+        'changes': list(latest.values()),
+    })
+
+# --- FEED ICALENDAR (.ics) ---
+# Calendários consultam o link a cada poucos minutos. O feed renderizado fica em cache
+# pela versão dos agendamentos (último id do change_log do estabelecimento), pela
+# versão de conteúdo (nomes de serviço/recurso) e pela janela; o ETag é essa mesma
+# chave, então um cliente com o feed atual recebe 304 sem gerar nada.
+ICS_PAST_DAYS = int(os.environ.get('ICS_PAST_DAYS', '30'))
+ICS_FUTURE_DAYS = int(os.environ.get('ICS_FUTURE_DAYS', '180'))
+ics_cache = LRUCache(int(os.environ.get('ICS_CACHE_SIZE', '200')))
+
+def _ics_events(est, first, last):
+    yield icsfeed.header(est.name)
+    for r in appointment_rows(Appointment.establishment_id == est.id, Appointment.appointment_date >= first, Appointment.appointment_date <= last, yield_per=500):
+        summary = f"{r.service_name} - {r.client_name}"
+        description = f"Cliente: {r.client_name}\nWhatsApp: {r.client_phone}" + (f"\nProfissional: {r.resource_name}" if r.resource_name else '')
+        yield icsfeed.event(f"agendamento-{r.id}@{est.url_prefix}", datetime.combine(r.appointment_date, r.appointment_time), r.duration, summary, description, r.updated_at)
+    yield icsfeed.footer()
+
+@app.route('/calendario/<token>.ics')
+def calendar_feed(token):
+    est = Establishment.query.filter_by(ics_token=token).first() if token else None
+    if est is None or not est.is_active: return "Not Found", 404
+    today = get_now_brazil().date()
+    first, last = today - timedelta(days=ICS_PAST_DAYS), today + timedelta(days=ICS_FUTURE_DAYS)
+    booking_version = db.session.query(func.max(ChangeLog.id)).filter(ChangeLog.establishment_id == est.id).scalar() or 0
+    etag = f"{est.id}-{booking_version}-{est.content_version}-{first.isoformat()}"
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'private, max-age=300'}
+    if request.if_none_match.contains(etag): return Response(status=304, headers=headers)
+    cached = ics_cache.get(etag)
+    if cached is not None: return Response(cached, mimetype='text/calendar', headers=headers)
+    def generate():
+        parts = []
+        for chunk in _ics_events(est, first, last):
+            parts.append(chunk); yield chunk
+        ics_cache.set(etag, ''.join(parts))
+    return Response(stream_with_context(generate()), mimetype='text/calendar', headers=headers)
+
+@app.route('/admin/calendario/link', methods=['POST'])
+@login_required
+def rotate_calendar_token():
+    # Gera (ou troca, invalidando o anterior) o link secreto do feed
+    current_user.establishment.ics_token = secrets.token_urlsafe(32); db.session.commit()
+    flash('Link do calendário atualizado.', 'success')
+    return redirect(url_for('admin_dashboard'))
+
+# --- BUSCA DE CLIENTES ---
+# Procura em clients (telefone/e-mail normalizados em btree por prefixo; nome em
+# FTS5/trigramas) e segue client_id até os agendamentos. Paginação por cursor (data, id).
+SEARCH_PAGE = 20
+
+def _prefix_range(column, prefix):
+    # "col LIKE 'abc%'" como intervalo, para qualquer btree usar o índice
+    return (column >= prefix) & (column < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+def client_search_filter(q):
+    digits = normalize_phone(q)
+    if '@' in q: return _prefix_range(Client.email_norm, normalize_email(q))
+    # Com ou sem DDD: prefixo no número completo ou no local (os dois indexados)
+    if len(digits) >= 4 and not re.search(r'[^\d\s()+.-]', q): return or_(_prefix_range(Client.phone_norm, digits), _prefix_range(Client.phone_local, digits))
+    if search_state['fts']:
+        tokens = re.findall(r'\w+', q)
+        if not tokens: return None
+        match = ' '.join(f'"{t}"*' for t in tokens)
+        return Client.id.in_(select(literal_column('rowid')).select_from(text('clients_fts')).where(text('clients_fts MATCH :m').bindparams(m=match)))
+    pattern = '%' + q.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    return func.lower(Client.name).like(pattern, escape='\\')
+
+@app.route('/admin/api/clientes')
+@login_required
+@read_replica
+def search_clients():
+    q = (request.args.get('q') or '').strip()[:100]
+    if len(q) < 2: return jsonify({'resultados': [], 'proximo': None})
+    cond = client_search_filter(q)
+    if cond is None: return jsonify({'resultados': [], 'proximo': None})
+    query = db.session.query(Appointment.id, Appointment.appointment_date, Appointment.appointment_time, Client.name.label('client_name'), Client.phone.label('client_phone'),
+                             Client.email.label('client_email'), Service.name).join(Service, Appointment.service_id == Service.id).join(Client, Appointment.client_id == Client.id).filter(
+        Client.establishment_id == current_user.establishment_id, cond)
+    cursor = request.args.get('cursor', '')
+    if cursor:
+        try:
+            c_date, c_id = cursor.split('.')
+            query = query.filter(tuple_(Appointment.appointment_date, Appointment.id) < (datetime.strptime(c_date, '%Y-%m-%d').date(), int(c_id)))
+        except ValueError: return jsonify({'erro': 'cursor inválido'}), 400
+    rows = query.order_by(Appointment.appointment_date.desc(), Appointment.id.desc()).limit(SEARCH_PAGE + 1).all()
+    today = get_now_brazil().date()
+    results = [{'id': r.id, 'date': r.appointment_date.isoformat(), 'time': r.appointment_time.strftime('%H:%M'), 'client_name': r.client_name,
+                'client_phone': r.client_phone, 'client_email': r.client_email, 'service_name': r.name, 'upcoming': r.appointment_date >= today} for r in rows[:SEARCH_PAGE]]
+    more = len(rows) > SEARCH_PAGE
+    return jsonify({'resultados': results, 'proximo': f"{rows[SEARCH_PAGE - 1].appointment_date.isoformat()}.{rows[SEARCH_PAGE - 1].id}" if more else None})
+
+# --- PUSH DE ALTERAÇÕES (SSE) ---
+# Tudo que o change_log registra (agendamentos, serviços, horários) vai pelo stream;
+# com ele conectado o painel não precisa do polling.
+SSE_HEARTBEAT = 15
+SSE_MAX_SECONDS = 300  # o navegador reconecta sozinho com Last-Event-ID
+# Cada stream prende uma thread do worker gthread enquanto está aberto: limite por
+# worker para sobrar thread às demais rotas (dimensionamento em gunicorn.conf.py)
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS') or max(1, int(os.environ.get('WEB_THREADS', '8')) // 2))
+SSE_BUSY_RETRY = 30
+sse_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+SSE_EVENTS = {'insert': 'booking-created', 'update': 'booking-updated', 'delete': 'booking-deleted'}  # agendamentos; o resto vai como 'change'
+
+def _change_event(r):
+    return {'entity': r.entity, 'id': r.entity_id, 'op': r.op, 'data': json.loads(r.data) if r.data else None, 'version': r.id}
+
+def _fetch_change_events(after_id, gap_ids=()):
+    with app.app_context():
+        rows = db.session.query(ChangeLog.id, ChangeLog.establishment_id, ChangeLog.entity, ChangeLog.entity_id, ChangeLog.op, ChangeLog.data).filter(
+            or_(ChangeLog.id > after_id, ChangeLog.id.in_(gap_ids))).order_by(ChangeLog.id).limit(SYNC_BATCH).all()
+        return [(r.id, r.establishment_id, _change_event(r)) for r in rows]
+
+def _latest_change_id():
+    with app.app_context(): return db.session.query(func.max(ChangeLog.id)).scalar() or 0
+
+event_hub = EventHub(_fetch_change_events, _latest_change_id, interval=float(os.environ.get('SSE_POLL_INTERVAL', '1')), buffer_size=100, gap_ttl=SYNC_OVERLAP_SECONDS)
+
+def _sse(event):
+    payload = dict(event, today=get_now_brazil().date().isoformat())
+    name = SSE_EVENTS[event['op']] if event['entity'] == 'appointment' else 'change'
+    return f"id: {event['version']}\nevent: {name}\ndata: {json.dumps(payload)}\n\n"
+
+@app.route('/admin/api/stream')
+@login_required
+def admin_stream():
+    # Sem vaga neste worker: 503 encerra o EventSource e o painel segue no polling
+    # (e tenta o stream de novo depois de Retry-After)
+    if not sse_slots.acquire(blocking=False):
+        return Response(f"retry: {SSE_BUSY_RETRY * 1000}\n\n", status=503, mimetype='text/event-stream', headers={'Retry-After': str(SSE_BUSY_RETRY), 'Cache-Control': 'no-cache'})
+    est_id = current_user.establishment_id
+    since = request.headers.get('Last-Event-ID', type=int) or request.args.get('since', 0, type=int)
+    try:
+        sub = event_hub.subscribe(est_id)
+        resync, backlog = needs_resync(since), []
+        if since and not resync:
+            recent, rows = changes_after(est_id, since)
+            backlog = [_change_event(r) for r in recent + rows]
+        db.session.close()  # devolve a conexão ao pool antes de manter o stream aberto
+    except Exception:
+        sse_slots.release(); raise
+
+    def stream():
+        yield "retry: 3000\n\n"
+        if resync:
+            yield "event: resync\ndata: {}\n\n"; return
+        # O hub pode entregar de novo o que já veio na leitura de recuperação;
+        # eventos atrasados (id menor) passam, o painel compara versões por entidade
+        sent = set()
+        for event in backlog:
+            sent.add(event['version']); yield _sse(event)
+        deadline = time_module.monotonic() + SSE_MAX_SECONDS
+        while time_module.monotonic() < deadline:
+            event = sub.get(SSE_HEARTBEAT)
+            if sub.overflowed:
+                yield "event: resync\ndata: {}\n\n"; return
+            if event is None:
+                yield ": ping\n\n"; continue
+            if event['version'] in sent: continue
+            yield _sse(event)
+
+    def close():
+        # Chamado uma vez quando o servidor fecha a resposta, mesmo se o stream nem começou
+        event_hub.unsubscribe(sub); sse_slots.release()
+    response = Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(close)
+    return response
 
 @app.route('/admin/configurar', methods=['POST'])
 @login_required
@@ -358,7 +1512,7 @@ def update_settings():
                 else: ds.lunch_start = None; ds.lunch_end = None
         flash('Atualizado!', 'success')
     db.session.commit()
-    return redirect(url_for('admin_dashboard'))
+    return redirect(url_for('admin_dashboard', recurso=request.form.get('recurso') or None))
 
 @app.route('/admin/servicos/novo', methods=['POST'])
 @login_required
@@ -372,42 +1526,148 @@ def add_service():
 @app.route('/admin/servicos/excluir/<int:id>', methods=['POST'])
 @login_required
 def delete_service(id):
-    s = Service.query.get(id); db.session.delete(s); db.session.commit()
+    s = Service.query.filter_by(id=id, establishment_id=current_user.establishment_id, deleted_at=None).first_or_404()
+    if SERVICE_SOFT_DELETE:
+        s.deleted_at = datetime.utcnow(); db.session.commit()
+    else:
+        delete_in_chunks(Appointment, Appointment.service_id == s.id, before_delete=_appointment_tombstones)
+        delete_in_chunks(WaitlistEntry, WaitlistEntry.service_id == s.id)
+        db.session.delete(s); db.session.commit()
+        invalidate_availability(s.establishment_id)  # DELETE em lote não passa pelo after_flush
+    return redirect(url_for('admin_dashboard'))
+
+@app.route('/admin/recursos/novo', methods=['POST'])
+@login_required
+def add_resource():
+    est_id = current_user.establishment_id
+    res = Resource(name=request.form.get('name'), establishment_id=est_id)
+    db.session.add(res); db.session.flush()
+    # O novo recurso começa com uma cópia do horário padrão
+    for ds in DaySchedule.query.filter_by(establishment_id=est_id, resource_id=None).all():
+        db.session.add(DaySchedule(establishment_id=est_id, resource_id=res.id, day_index=ds.day_index, is_active=ds.is_active, work_start=ds.work_start, work_end=ds.work_end, lunch_start=ds.lunch_start, lunch_end=ds.lunch_end))
+    db.session.commit()
+    return redirect(url_for('admin_dashboard'))
+
+@app.route('/admin/recursos/excluir/<int:id>', methods=['POST'])
+@login_required
+def delete_resource(id):
+    res = Resource.query.filter_by(id=id, establishment_id=current_user.establishment_id).first_or_404()
+    today = get_now_brazil().date()
+    if Appointment.query.filter(Appointment.resource_id == res.id, Appointment.appointment_date >= today).first():
+        flash('Este recurso tem agendamentos futuros. Cancele-os antes de remover.', 'warning'); return redirect(url_for('admin_dashboard'))
+    Appointment.query.filter_by(resource_id=res.id).update({'resource_id': None})
+    DaySchedule.query.filter_by(resource_id=res.id).delete()
+    ScheduleException.query.filter_by(resource_id=res.id).delete()
+    db.session.delete(res); db.session.commit()
+    return redirect(url_for('admin_dashboard'))
+
+@app.route('/admin/excecoes/nova', methods=['POST'])
+@login_required
+def add_exception():
+    est_id = current_user.establishment_id
+    kind = request.form.get('kind')
+    try:
+        d = datetime.strptime(request.form.get('date') or '', '%Y-%m-%d').date()
+        st = datetime.strptime(request.form.get('start_time'), '%H:%M').time() if kind != 'fechado' else None
+        et = datetime.strptime(request.form.get('end_time'), '%H:%M').time() if kind != 'fechado' else None
+    except (TypeError, ValueError):
+        flash('Data ou horário inválido.', 'danger'); return redirect(url_for('admin_dashboard'))
+    if kind not in EXCEPTION_KINDS or (st and et and st >= et):
+        flash('Data ou horário inválido.', 'danger'); return redirect(url_for('admin_dashboard'))
+    rid = request.form.get('resource_id', type=int)
+    if rid and not Resource.query.filter_by(id=rid, establishment_id=est_id).first(): rid = None
+    db.session.add(ScheduleException(establishment_id=est_id, resource_id=rid, date=d, kind=kind, start_time=st, end_time=et, reason=(request.form.get('reason') or '')[:100] or None))
+    db.session.commit()
+    flash('Exceção salva!', 'success')
+    return redirect(url_for('admin_dashboard'))
+
+@app.route('/admin/excecoes/excluir/<int:id>', methods=['POST'])
+@login_required
+def delete_exception(id):
+    ScheduleException.query.filter_by(id=id, establishment_id=current_user.establishment_id).delete(); db.session.commit()
+    invalidate_availability(current_user.establishment_id)
     return redirect(url_for('admin_dashboard'))
 
 @app.route('/admin/agendamentos/excluir/<int:id>', methods=['POST'])
 @login_required
 def delete_appointment(id):
-    a = Appointment.query.get(id); db.session.delete(a); db.session.commit()
+    a = Appointment.query.filter_by(id=id, establishment_id=current_user.establishment_id).first_or_404()
+    est_id, d = a.establishment_id, a.appointment_date
+    db.session.delete(a)
+    if d >= get_now_brazil().date(): db.session.add(WaitlistJob(establishment_id=est_id, date=d, base_url=request.host_url))
+    db.session.commit()
+    reminder_scheduler.cancel(id); waitlist_wake.set()
     return redirect(url_for('admin_dashboard'))
 
+SLOT_CELL_MINUTES = 5
+SLOT_MAX_DAYS = 31  # teto de `dias` no formato mascara: um mês por consulta (era 14 até as exceções de agenda)
+
 @app.route('/api/horarios_disponiveis')
+@limitar('horarios', est_key=lambda: establishment_of_service(request.args.get('service_id', type=int)))
+@read_replica
 def get_available_times():
+    # Padrão: lista "HH:MM" de um dia. Com formato=mascara devolve `dias` dias a partir
+    # de `date`, cada um como [minuto inicial, bitmask base64 em células de 5 min].
+    # Erros: lista vazia no formato antigo (compatível); no compacto, status e {'erro'}
     sid, d_str = request.args.get('service_id'), request.args.get('date')
-    if not sid or not d_str: return jsonify([])
+    compact = request.args.get('formato') == 'mascara'
+    fail = lambda msg, status: (jsonify({'erro': msg}), status) if compact else jsonify([])
+    if not sid or not d_str: return fail('service_id e date são obrigatórios', 400)
     try: sel_date = datetime.strptime(d_str, '%Y-%m-%d').date()
-    except: return jsonify([])
-    svc = Service.query.get(sid)
-    est = svc.establishment
-    day_sched = DaySchedule.query.filter_by(establishment_id=est.id, day_index=sel_date.weekday()).first()
-    if not day_sched or not day_sched.is_active: return jsonify([])
-    appts = Appointment.query.filter_by(appointment_date=sel_date, establishment_id=est.id).all()
-    busy = []
-    if day_sched.lunch_start and day_sched.lunch_end: busy.append((datetime.combine(sel_date, day_sched.lunch_start), datetime.combine(sel_date, day_sched.lunch_end)))
-    for a in appts: busy.append((datetime.combine(sel_date, a.appointment_time), datetime.combine(sel_date, a.appointment_time) + timedelta(minutes=a.service_info.duration)))
-    avail = []
-    curr = datetime.combine(sel_date, day_sched.work_start)
-    limit = datetime.combine(sel_date, day_sched.work_end)
+    except ValueError: return fail('data inválida', 400)
+    svc = live_services().filter_by(id=sid).first()
+    if not svc: return fail('serviço não encontrado', 404)
+    n_days = max(1, min(request.args.get('dias', 1, type=int), SLOT_MAX_DAYS)) if compact else 1
+    last = sel_date + timedelta(days=n_days - 1)
+    # Cache por estabelecimento, invalidado a cada mudança na agenda; se o período
+    # inclui hoje, o minuto de corte entra na chave
     now = get_now_brazil()
-    while curr + timedelta(minutes=svc.duration) <= limit:
-        end = curr + timedelta(minutes=svc.duration)
-        if sel_date == now.date() and curr < now: curr += timedelta(minutes=15); continue
-        collision = False
-        for bs, be in busy:
-            if max(curr, bs) < min(end, be): collision = True; break
-        if not collision: avail.append(curr.strftime('%H:%M'))
-        curr += timedelta(minutes=15)
-    return jsonify(avail)
+    cut = to_minutes(now) + (1 if now.second or now.microsecond else 0) if sel_date <= now.date() <= last else None
+    ns, key = f"disponibilidade:{svc.establishment_id}", f"{svc.id}:{svc.duration}:{sel_date}:{n_days}:{int(compact)}:{cut}"
+    load = lambda: _available_payload(svc, sel_date, last, now.date(), cut, compact)
+    # Lido na réplica (que pode estar atrasada) só consulta o cache: gravar ali poria um
+    # resultado antigo sob a versão já invalidada pelo primário
+    if g.get('db_route') == 'replica':
+        payload = shared_cache.get(ns, key)
+        if payload is None: payload = load()
+    else:
+        payload = shared_cache.get_or_set(ns, key, load, AVAILABILITY_CACHE_TTL)
+    return jsonify(payload)
+
+def _available_payload(svc, first, last, today, cut, compact):
+    result = {}
+    for d, days in load_capacity(svc.establishment_id, first, last).items():
+        starts = available_starts(days, svc.duration, step=15, not_before=cut if d == today else None)
+        if not compact: return [f"{m // 60:02d}:{m % 60:02d}" for m in starts]
+        origin = min((day.work_start for day in days), default=0)
+        result[d.isoformat()] = [origin, encode_starts(starts, origin, SLOT_CELL_MINUTES)] if starts else None
+    return {'celula': SLOT_CELL_MINUTES, 'dias': result}
+
+@app.route('/interno/metricas')
+def internal_metrics():
+    if not metrics_token_ok(request.headers.get('X-Metrics-Token')): return "Not Found", 404
+    return jsonify({'limite': rate_limiter.metrics.snapshot(), 'stripe': stripe_checkout.breaker.state, 'login': login_latency.snapshot(),
+                    'templates': {name: w.snapshot() for name, w in template_latency.items()}, 'fragmentos': fragment_cache.stats(),
+                    'cache': shared_cache.stats(), 'ics': ics_cache.stats(), 'sse': {'conexoes': event_hub.subscriber_count(), 'limite': SSE_MAX_STREAMS},
+                    'replica': {k: v for k, v in replica_state.items() if k != 'down_until'} if replica_url else None})
+
+# Admin vê os perfis do próprio estabelecimento; com X-Metrics-Token, todos (inclusive amostras)
+def _visible_profile(data):
+    if metrics_token_ok(request.headers.get('X-Metrics-Token')): return True
+    return current_user.is_authenticated and data.get('est') == current_user.establishment_id
+
+@app.route('/admin/perfis')
+def list_profiles():
+    if not current_user.is_authenticated and not metrics_token_ok(request.headers.get('X-Metrics-Token')): return redirect(url_for('login'))
+    return jsonify([p for p in profiler.list() if _visible_profile(p)])
+
+@app.route('/admin/perfis/<nome>')
+def show_profile(nome):
+    data = profiler.load(nome)
+    if data is None or not _visible_profile(data): return "Not Found", 404
+    if request.args.get('formato') == 'prof':
+        return send_from_directory(profiler.directory, nome + '.prof', as_attachment=True)
+    return jsonify(data)
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -440,6 +1700,9 @@ INDEX_HTML = r'''{% extends 'layout.html' %}
                     <a href="{{ url_for('login') }}" class="px-8 py-4 rounded-xl font-bold text-gray-700 hover:bg-gray-200 transition border border-gray-300">
                         Já sou Cliente
                     </a>
+                    <a href="{{ url_for('public_directory') }}" class="px-8 py-4 rounded-xl font-bold text-gray-700 hover:bg-gray-200 transition border border-gray-300">
+                        Quero Agendar
+                    </a>
                 </div>
                 <p class="mt-4 text-xs text-gray-500">Gestão simplificada para o seu crescimento.</p>
             </div>
@@ -558,6 +1821,7 @@ LAYOUT_HTML = r'''<!DOCTYPE html>
                 <ul class="navbar-nav ms-auto align-items-center">
                     {% if current_user.is_authenticated %}
                         <li class="nav-item"><a class="nav-link fw-bold" href="{{ url_for('admin_dashboard') }}">Painel</a></li>
+                        <li class="nav-item"><a class="nav-link" href="{{ url_for('network_dashboard') }}">Rede</a></li>
                         <li class="nav-item"><a class="nav-link text-danger" href="{{ url_for('logout') }}">Sair</a></li>
                     {% else %}
                         <li class="nav-item"><a class="nav-link" href="{{ url_for('login') }}">Login</a></li>
@@ -644,9 +1908,7 @@ ADMIN_HTML = r'''{% extends 'layout.html' %}
             <div><h1 class="h3 mb-0">Painel: {{ establishment.name }}</h1><a href="{{ url_for('establishment_services', url_prefix=establishment.url_prefix) }}" target="_blank" class="text-decoration-none small">Ver Página <i class="bi bi-box-arrow-up-right"></i></a></div>
         </div>
     </div>
-    {% if today_count > 0 %}
-    <div class="alert alert-info d-flex align-items-center mb-4 shadow-sm" role="alert"><i class="bi bi-bell-fill me-2 fs-4"></i><div><strong>Atenção!</strong> Você tem <strong>{{ today_count }}</strong> agendamento(s) para hoje.</div></div>
-    {% endif %}
+    <div id="today-alert" class="alert alert-info d-flex align-items-center mb-4 shadow-sm {% if today_count == 0 %}d-none{% endif %}" role="alert"><i class="bi bi-bell-fill me-2 fs-4"></i><div><strong>Atenção!</strong> Você tem <strong id="today-count">{{ today_count }}</strong> agendamento(s) para hoje.</div></div>
     <div class="card shadow-sm border-0 mb-4 p-3 bg-light">
         <form action="{{ url_for('update_settings') }}" method="POST" enctype="multipart/form-data" class="row align-items-center g-2">
             <input type="hidden" name="form_type" value="contact"> 
@@ -655,21 +1917,36 @@ ADMIN_HTML = r'''{% extends 'layout.html' %}
             <div class="col-md-3"><label class="small fw-bold">Logo:</label><input type="file" name="logo" class="form-control form-control-sm" accept="image/*"></div>
             <div class="col-md-2 text-end pt-4"><button class="btn btn-primary btn-sm w-100">Salvar</button></div>
         </form>
+        <div class="d-flex align-items-center gap-2 mt-3 small">
+            <i class="bi bi-calendar3"></i>
+            {% if establishment.ics_token %}<input type="text" class="form-control form-control-sm" readonly value="{{ url_for('calendar_feed', token=establishment.ics_token, _external=True) }}" onclick="this.select()" title="Assine no Google/Apple Calendar">{% else %}<span class="text-muted">Veja seus agendamentos no Google/Apple Calendar.</span>{% endif %}
+            <form action="{{ url_for('rotate_calendar_token') }}" method="POST" {% if establishment.ics_token %}onsubmit="return confirm('O link atual deixará de funcionar. Continuar?');"{% endif %}><button class="btn btn-outline-secondary btn-sm text-nowrap">{{ 'Novo link' if establishment.ics_token else 'Gerar link' }}</button></form>
+        </div>
     </div>
     <div class="row">
         <div class="col-12 mb-4">
             <div class="card shadow-sm border-0">
-                <div class="card-header bg-white fw-bold">Horários de Funcionamento</div>
+                <div class="card-header bg-white fw-bold d-flex justify-content-between align-items-center">
+                    <span>Horários de Funcionamento{% if resource %}: {{ resource.name }}{% endif %}</span>
+                    {% if resources %}
+                    <div class="btn-group btn-group-sm">
+                        <a href="{{ url_for('admin_dashboard') }}" class="btn {% if not resource %}btn-dark{% else %}btn-outline-dark{% endif %}">Padrão</a>
+                        {% for r in resources %}<a href="{{ url_for('admin_dashboard', recurso=r.id) }}" class="btn {% if resource and resource.id == r.id %}btn-dark{% else %}btn-outline-dark{% endif %}">{{ r.name }}</a>{% endfor %}
+                    </div>
+                    {% endif %}
+                </div>
                 <div class="card-body p-0">
                     <form action="{{ url_for('update_settings') }}" method="POST">
                         <input type="hidden" name="form_type" value="schedule">
+                        {% if resource %}<input type="hidden" name="recurso" value="{{ resource.id }}">{% endif %}
                         <div class="table-responsive">
                             <table class="table table-bordered mb-0 align-middle text-center">
                                 <thead class="table-light"><tr><th style="width: 50px;">Ativo</th><th>Dia</th><th>Abertura</th><th>Fechamento</th><th>Almoço Início</th><th>Almoço Fim</th></tr></thead>
                                 <tbody>
+                                    {% cache 'admin-horarios', establishment.id, resource.id if resource else 0, establishment.content_version %}
                                     {% set day_names = ['Segunda', 'Terça', 'Quarta', 'Quinta', 'Sexta', 'Sábado', 'Domingo'] %}
                                     {% for d in schedules %}
-                                    <tr class="{% if not d.is_active %}bg-light text-muted{% endif %}">
+                                    <tr data-schedule-id="{{ d.id }}" class="{% if not d.is_active %}bg-light text-muted{% endif %}">
                                         <input type="hidden" name="schedule_id" value="{{ d.id }}">
                                         <td><div class="form-check d-flex justify-content-center"><input class="form-check-input" type="checkbox" name="active_{{ d.id }}" {% if d.is_active %}checked{% endif %}></div></td>
                                         <td class="fw-bold text-start">{{ day_names[d.day_index] }}</td>
@@ -679,6 +1956,7 @@ ADMIN_HTML = r'''{% extends 'layout.html' %}
                                         <td><input type="time" class="form-control form-control-sm" name="lunch_end_{{ d.id }}" value="{{ d.lunch_end.strftime('%H:%M') if d.lunch_end else '' }}"></td>
                                     </tr>
                                     {% endfor %}
+                                    {% endcache %}
                                 </tbody>
                             </table>
                         </div>
@@ -693,18 +1971,27 @@ ADMIN_HTML = r'''{% extends 'layout.html' %}
                 <div class="card-body p-0">
                     <table class="table table-hover mb-0">
                         <thead><tr><th>Data/Hora</th><th>Cliente</th><th>Ação</th></tr></thead>
-                        <tbody>
+                        <tbody id="appts-body">
                             {% for a in appointments %}
-                            <tr>
-                                <td><b>{{ a.appointment_date.strftime('%d/%m') }}</b> {{ a.appointment_time.strftime('%H:%M') }}<br><small>{{ a.service_info.name }}</small></td>
+                            <tr data-appt-id="{{ a.id }}" data-key="{{ a.appointment_date.isoformat() }} {{ a.appointment_time.strftime('%H:%M') }}">
+                                <td><b>{{ a.appointment_date.strftime('%d/%m') }}</b> {{ a.appointment_time.strftime('%H:%M') }}<br><small>{{ a.service_name }}{% if a.resource_name %} · {{ a.resource_name }}{% endif %}</small></td>
                                 <td>{{ a.client_name }}<br><small class="text-success"><i class="bi bi-whatsapp"></i> {{ a.client_phone }}</small></td>
                                 <td><form method="POST" action="{{ url_for('delete_appointment', id=a.id) }}" onsubmit="return confirm('Cancelar?');"><button class="btn btn-sm btn-danger"><i class="bi bi-trash"></i></button></form></td>
                             </tr>
-                            {% else %}<tr><td colspan="3" class="text-center py-4">Agenda livre.</td></tr>{% endfor %}
+                            {% endfor %}
+                            <tr id="appts-empty" class="{% if appointments %}d-none{% endif %}"><td colspan="3" class="text-center py-4">Agenda livre.</td></tr>
                         </tbody>
                     </table>
                 </div>
             </div>
+            <div class="card shadow-sm border-0 mb-4">
+                <div class="card-header bg-white fw-bold">Buscar Cliente</div>
+                <div class="card-body">
+                    <input type="search" id="client-q" class="form-control form-control-sm mb-2" placeholder="Nome, WhatsApp ou e-mail" autocomplete="off">
+                    <ul id="client-results" class="list-group list-group-flush small"></ul>
+                    <button id="client-more" type="button" class="btn btn-link btn-sm d-none">Carregar mais</button>
+                </div>
+            </div>
         </div>
         <div class="col-lg-6">
             <div class="card shadow-sm border-0">
@@ -718,9 +2005,49 @@ ADMIN_HTML = r'''{% extends 'layout.html' %}
                             <button class="btn btn-success">+</button>
                         </div>
                     </form>
-                    <ul class="list-group list-group-flush small">
+                    <ul id="services-list" class="list-group list-group-flush small">
+                        {% cache 'admin-servicos', establishment.id, establishment.content_version %}
                         {% for s in services %}
-                        <li class="list-group-item d-flex justify-content-between px-0"><span>{{ s.name }} ({{ s.duration }}min) - <span class="fw-bold text-success">R$ {{ "%.2f"|format(s.price) }}</span></span><form method="POST" action="{{ url_for('delete_service', id=s.id) }}" onsubmit="return confirm('Excluir?');"><button class="btn btn-link text-danger p-0 border-0"><i class="bi bi-trash"></i></button></form></li>
+                        <li data-service-id="{{ s.id }}" class="list-group-item d-flex justify-content-between px-0"><span>{{ s.name }} ({{ s.duration }}min) - <span class="fw-bold text-success">R$ {{ "%.2f"|format(s.price) }}</span></span><form method="POST" action="{{ url_for('delete_service', id=s.id) }}" onsubmit="return confirm('Excluir?');"><button class="btn btn-link text-danger p-0 border-0"><i class="bi bi-trash"></i></button></form></li>
+                        {% endfor %}
+                        {% endcache %}
+                    </ul>
+                </div>
+            </div>
+            <div class="card shadow-sm border-0 mt-4">
+                <div class="card-header bg-white fw-bold">Profissionais / Cadeiras</div>
+                <div class="card-body">
+                    <p class="small text-muted mb-2">Cada um atende um cliente por vez, com horário próprio. Sem cadastro, a agenda atende um cliente por vez.</p>
+                    <form action="{{ url_for('add_resource') }}" method="POST" class="mb-3">
+                        <div class="input-group input-group-sm">
+                            <input type="text" name="name" class="form-control" placeholder="Nome (ex: Cadeira 1, João)" required>
+                            <button class="btn btn-success">+</button>
+                        </div>
+                    </form>
+                    <ul class="list-group list-group-flush small">
+                        {% for r in resources %}
+                        <li class="list-group-item d-flex justify-content-between px-0"><span>{{ r.name }} <a href="{{ url_for('admin_dashboard', recurso=r.id) }}" class="ms-2 small">Horários</a></span><form method="POST" action="{{ url_for('delete_resource', id=r.id) }}" onsubmit="return confirm('Remover?');"><button class="btn btn-link text-danger p-0 border-0"><i class="bi bi-trash"></i></button></form></li>
+                        {% endfor %}
+                    </ul>
+                </div>
+            </div>
+            <div class="card shadow-sm border-0 mt-4">
+                <div class="card-header bg-white fw-bold">Feriados e Bloqueios</div>
+                <div class="card-body">
+                    <form action="{{ url_for('add_exception') }}" method="POST" class="row g-2 mb-3 small">
+                        <div class="col-6"><input type="date" name="date" class="form-control form-control-sm" required></div>
+                        <div class="col-6"><select name="kind" class="form-select form-select-sm">{% for k, label in exception_kinds.items() %}<option value="{{ k }}">{{ label }}</option>{% endfor %}</select></div>
+                        <div class="col-6"><input type="time" name="start_time" class="form-control form-control-sm" title="Início (horário especial/bloqueio)"></div>
+                        <div class="col-6"><input type="time" name="end_time" class="form-control form-control-sm" title="Fim (horário especial/bloqueio)"></div>
+                        <div class="col-6"><select name="resource_id" class="form-select form-select-sm"><option value="">Todos</option>{% for r in resources %}<option value="{{ r.id }}">{{ r.name }}</option>{% endfor %}</select></div>
+                        <div class="col-6"><input type="text" name="reason" class="form-control form-control-sm" placeholder="Motivo (opcional)" maxlength="100"></div>
+                        <div class="col-12"><button class="btn btn-success btn-sm w-100">Adicionar</button></div>
+                    </form>
+                    <ul class="list-group list-group-flush small">
+                        {% for x in exceptions %}
+                        <li class="list-group-item d-flex justify-content-between px-0"><span><b>{{ x.date.strftime('%d/%m/%Y') }}</b> {{ exception_kinds[x.kind] }}{% if x.start_time %} {{ x.start_time.strftime('%H:%M') }}–{{ x.end_time.strftime('%H:%M') }}{% endif %}{% if x.resource %} · {{ x.resource.name }}{% endif %}{% if x.reason %} <span class="text-muted">({{ x.reason }})</span>{% endif %}</span><form method="POST" action="{{ url_for('delete_exception', id=x.id) }}" onsubmit="return confirm('Remover?');"><button class="btn btn-link text-danger p-0 border-0"><i class="bi bi-trash"></i></button></form></li>
+                        {% else %}
+                        <li class="list-group-item px-0 text-muted">Nenhuma exceção futura.</li>
                         {% endfor %}
                     </ul>
                 </div>
@@ -729,6 +2056,149 @@ ADMIN_HTML = r'''{% extends 'layout.html' %}
     </div>
 </div>
 {% endblock %}
+{% block scripts %}
+<script>
+// Sincronização incremental: busca só o que mudou desde a última versão e aplica no lugar.
+const sync = {version: {{ sync_version }}, url: "{{ url_for('admin_changes') }}", busy: false, live: false, applied: new Map()};
+const apptDeleteUrl = "{{ url_for('delete_appointment', id=0) }}".replace(/0$/, '');
+const serviceDeleteUrl = "{{ url_for('delete_service', id=0) }}".replace(/0$/, '');
+const dirtySchedules = new Set();
+
+function el(tag, attrs, ...children) {
+    const node = document.createElement(tag);
+    Object.entries(attrs || {}).forEach(([k, v]) => k === 'class' ? node.className = v : node.setAttribute(k, v));
+    children.forEach(c => node.append(c));
+    return node;
+}
+function deleteForm(action, message, btnClass) {
+    const form = el('form', {method: 'POST', action: action});
+    form.onsubmit = () => confirm(message);
+    form.append(el('button', {class: btnClass}, el('i', {class: 'bi bi-trash'})));
+    return form;
+}
+// O servidor relê uma janela recente (transações confirmadas fora de ordem): a mesma
+// alteração pode chegar de novo, e uma mais antiga depois de uma mais nova.
+function isNewer(ch) {
+    const key = `${ch.entity}:${ch.id}`;
+    if ((sync.applied.get(key) || 0) >= ch.version) return false;
+    sync.applied.set(key, ch.version);
+    return true;
+}
+function applyAppointment(ch, today) {
+    const body = document.getElementById('appts-body');
+    const old = body.querySelector(`tr[data-appt-id="${ch.id}"]`);
+    if (old) old.remove();
+    if (ch.op === 'delete' || ch.data.date < today) return;
+    const d = ch.data, key = `${d.date} ${d.time}`;
+    const row = el('tr', {'data-appt-id': ch.id, 'data-key': key},
+        el('td', {}, el('b', {}, d.date.slice(8, 10) + '/' + d.date.slice(5, 7)), ' ' + d.time, el('br'), el('small', {}, d.service_name + (d.resource_name ? ' · ' + d.resource_name : ''))),
+        el('td', {}, d.client_name, el('br'), el('small', {class: 'text-success'}, el('i', {class: 'bi bi-whatsapp'}), ' ' + d.client_phone)),
+        el('td', {}, deleteForm(apptDeleteUrl + ch.id, 'Cancelar?', 'btn btn-sm btn-danger')));
+    const next = [...body.querySelectorAll('tr[data-appt-id]')].find(r => r.dataset.key > key);
+    body.insertBefore(row, next || document.getElementById('appts-empty'));
+}
+function applyService(ch) {
+    const list = document.getElementById('services-list');
+    const old = list.querySelector(`li[data-service-id="${ch.id}"]`);
+    if (ch.op === 'delete') { if (old) old.remove(); return; }
+    const d = ch.data;
+    const item = el('li', {'data-service-id': ch.id, class: 'list-group-item d-flex justify-content-between px-0'},
+        el('span', {}, `${d.name} (${d.duration}min) - `, el('span', {class: 'fw-bold text-success'}, 'R$ ' + Number(d.price).toFixed(2))),
+        deleteForm(serviceDeleteUrl + ch.id, 'Excluir?', 'btn btn-link text-danger p-0 border-0'));
+    if (old) old.replaceWith(item); else list.append(item);
+}
+function applySchedule(ch) {
+    const row = document.querySelector(`tr[data-schedule-id="${ch.id}"]`);
+    if (!row || ch.op === 'delete' || dirtySchedules.has(String(ch.id))) return;
+    const d = ch.data;
+    row.querySelector(`[name="active_${ch.id}"]`).checked = d.is_active;
+    ['work_start', 'work_end', 'lunch_start', 'lunch_end'].forEach(f => row.querySelector(`[name="${f}_${ch.id}"]`).value = d[f]);
+    row.classList.toggle('bg-light', !d.is_active); row.classList.toggle('text-muted', !d.is_active);
+}
+function refreshToday(today) {
+    const n = [...document.querySelectorAll('#appts-body tr[data-appt-id]')].filter(r => r.dataset.key.startsWith(today)).length;
+    document.getElementById('today-count').innerText = n;
+    document.getElementById('today-alert').classList.toggle('d-none', n === 0);
+    document.getElementById('appts-empty').classList.toggle('d-none', document.querySelector('#appts-body tr[data-appt-id]') !== null);
+}
+// A versão só anda para frente: um pull em curso ou um evento atrasado (id menor)
+// não a faz voltar; a releitura recente do servidor cobre as lacunas abaixo dela
+function advance(version) { sync.version = Math.max(sync.version, Number(version) || 0); }
+function applyChange(ch, today) {
+    if (ch.entity === 'appointment') applyAppointment(ch, today);
+    else if (ch.entity === 'service') applyService(ch);
+    else if (ch.entity === 'schedule') applySchedule(ch);
+}
+async function pullChanges() {
+    if (sync.busy) return;
+    sync.busy = true;
+    try {
+        let more = true;
+        while (more) {
+            const res = await fetch(`${sync.url}?since=${sync.version}`, {headers: {'Accept': 'application/json'}});
+            if (!res.ok || res.redirected) return;
+            const delta = await res.json();
+            if (delta.resync) { location.reload(); return; }  // versão anterior ao histórico retido
+            delta.changes.filter(isNewer).forEach(ch => applyChange(ch, delta.today));
+            refreshToday(delta.today);
+            advance(delta.version); more = delta.more;
+        }
+    } catch (e) { /* rede instável: tenta de novo no próximo ciclo */ }
+    finally { sync.busy = false; }
+}
+document.querySelectorAll('tr[data-schedule-id] input').forEach(i => i.addEventListener('input', () => dirtySchedules.add(i.closest('tr').dataset.scheduleId)));
+
+// Alterações (agendamentos, serviços, horários) chegam por SSE; a consulta periódica só roda sem o stream.
+function openStream() {
+    const stream = new EventSource(`{{ url_for('admin_stream') }}?since=${sync.version}`);
+    const onBooking = (e) => {
+        const ch = JSON.parse(e.data);
+        advance(e.lastEventId);
+        if (!isNewer(ch)) return;
+        applyAppointment(ch, ch.today);
+        refreshToday(ch.today);
+        if (ch.op === 'insert') document.querySelector(`tr[data-appt-id="${ch.id}"]`)?.classList.add('table-success');
+    };
+    ['booking-created', 'booking-updated', 'booking-deleted'].forEach(name => stream.addEventListener(name, onBooking));
+    stream.addEventListener('change', (e) => { const ch = JSON.parse(e.data); advance(e.lastEventId); if (isNewer(ch)) applyChange(ch, ch.today); });
+    stream.addEventListener('resync', () => pullChanges());
+    stream.onopen = () => { sync.live = true; };
+    stream.onerror = () => {
+        sync.live = false;
+        // Servidor sem vaga (503) fecha o EventSource de vez: fica no polling e tenta de novo
+        if (stream.readyState === EventSource.CLOSED) setTimeout(openStream, 30000);
+    };
+}
+if (window.EventSource) openStream();
+// Busca de clientes (histórico e próximos), paginada por cursor
+const search = {url: "{{ url_for('search_clients') }}", q: '', cursor: null, timer: null};
+async function runSearch(append) {
+    const list = document.getElementById('client-results'), more = document.getElementById('client-more');
+    const q = search.q, params = new URLSearchParams({q});
+    if (append && search.cursor) params.set('cursor', search.cursor);
+    if (!append) list.replaceChildren();
+    if (q.length < 2) { more.classList.add('d-none'); return; }
+    const res = await fetch(`${search.url}?${params}`);
+    if (!res.ok || q !== search.q) return;
+    const data = await res.json();
+    data.resultados.forEach(r => list.append(el('li', {class: 'list-group-item px-0'},
+        el('b', {}, r.date.slice(8, 10) + '/' + r.date.slice(5, 7) + '/' + r.date.slice(0, 4)), ' ' + r.time + ' · ' + r.service_name,
+        r.upcoming ? el('span', {class: 'badge bg-success ms-1'}, 'próximo') : '', el('br'),
+        r.client_name + ' · ' + r.client_phone + ' · ' + r.client_email)));
+    if (!list.children.length) list.append(el('li', {class: 'list-group-item px-0 text-muted'}, 'Nenhum agendamento encontrado.'));
+    search.cursor = data.proximo;
+    more.classList.toggle('d-none', !data.proximo);
+}
+document.getElementById('client-q').addEventListener('input', e => {
+    clearTimeout(search.timer);
+    search.timer = setTimeout(() => { search.q = e.target.value.trim(); search.cursor = null; runSearch(false); }, 250);
+});
+document.getElementById('client-more').addEventListener('click', () => runSearch(true));
+
+setInterval(() => { if (!sync.live && document.visibilityState === 'visible') pullChanges(); }, 15000);
+document.addEventListener('visibilitychange', () => { if (!sync.live && document.visibilityState === 'visible') pullChanges(); });
+</script>
+{% endblock %}
 '''
 
 LISTA_SERVICOS_HTML = r'''{% extends 'layout.html' %}
@@ -741,6 +2211,7 @@ LISTA_SERVICOS_HTML = r'''{% extends 'layout.html' %}
         <h1 class="display-5 fw-bold">{{ establishment.name }}</h1>
         {% if establishment.contact_phone %}<p class="text-muted"><i class="bi bi-whatsapp text-success"></i> {{ establishment.contact_phone }}</p>{% endif %}
     </div>
+    {% cache 'servicos', establishment.id, establishment.content_version %}
     <div class="row justify-content-center gap-3">
         {% for s in services %}
         <div class="col-md-4">
@@ -753,6 +2224,7 @@ LISTA_SERVICOS_HTML = r'''{% extends 'layout.html' %}
         </div>
         {% else %}<div class="text-center text-muted">Sem serviços cadastrados.</div>{% endfor %}
     </div>
+    {% endcache %}
 </div>
 {% endblock %}
 '''
@@ -764,12 +2236,14 @@ AGENDAMENTO_HTML = r'''{% extends 'layout.html' %}
     <div class="row justify-content-center">
         <div class="col-lg-6">
             <div class="card shadow-sm border-0 p-4">
+                {% cache 'agendar', establishment.id, service.id, establishment.content_version %}
                 <div class="text-center mb-4">
                     {% if establishment.logo_filename %}<img src="{{ url_for('static', filename='uploads/' + establishment.logo_filename) }}" class="rounded-circle shadow-sm mb-2" style="width: 60px; height: 60px; object-fit: cover;">{% endif %}
                     <h4 class="fw-bold">{{ establishment.name }}</h4>
                     <h5 class="text-muted">{{ service.name }}</h5>
                     <p class="text-success fw-bold">Valor: R$ {{ "%.2f"|format(service.price) }}</p>
                 </div>
+                {% endcache %}
                 <form id="form" method="POST" action="{{ url_for('create_appointment', url_prefix=establishment.url_prefix) }}">
                     <input type="hidden" name="service_id" value="{{ service.id }}">
                     <div class="mb-2"><label class="fw-bold small">Seu Nome</label><input type="text" name="client_name" class="form-control" required></div>
@@ -780,6 +2254,14 @@ AGENDAMENTO_HTML = r'''{% extends 'layout.html' %}
                     <div class="mb-3"><label class="fw-bold small">Data</label><input type="date" id="date" name="appointment_date" class="form-control" required></div>
                     <div class="mb-4"><label class="fw-bold small">Horários Disponíveis</label><div id="slots" class="d-flex flex-wrap gap-2 mt-2"><small class="text-muted">Selecione a data...</small></div><input type="hidden" id="time" name="appointment_time" required></div>
                     <button id="btn" class="btn btn-primary w-100 fw-bold" disabled>Confirmar Agendamento</button>
+                    <div id="waitlist" class="border rounded p-3 mt-3 d-none">
+                        <div class="small fw-bold mb-2"><i class="bi bi-hourglass-split"></i> Dia cheio? Entre na lista de espera e avisamos se vagar.</div>
+                        <div class="row g-2 mb-2">
+                            <div class="col-6"><label class="small">A partir de (opcional)</label><input type="time" name="window_start" class="form-control form-control-sm"></div>
+                            <div class="col-6"><label class="small">Até (opcional)</label><input type="time" name="window_end" class="form-control form-control-sm"></div>
+                        </div>
+                        <button formaction="{{ url_for('join_waitlist', url_prefix=establishment.url_prefix) }}" class="btn btn-outline-secondary btn-sm w-100">Avise-me se vagar</button>
+                    </div>
                 </form>
             </div>
         </div>
@@ -794,14 +2276,58 @@ const month = String(today.getMonth() + 1).padStart(2, '0');
 const day = String(today.getDate()).padStart(2, '0');
 document.getElementById('date').min = `${year}-${month}-${day}`;
 
-document.getElementById('date').addEventListener('change', async (e) => {
-    if(!e.target.value) return;
-    const div = document.getElementById('slots');
-    div.innerHTML = 'Carregando...';
-    const res = await fetch(`/api/horarios_disponiveis?service_id={{ service.id }}&date=${e.target.value}`);
-    const times = await res.json();
-    div.innerHTML = '';
-    if(times.length === 0) div.innerHTML = '<span class="text-danger small">Indisponível.</span>';
+// Horários em cache por data: cada consulta traz vários dias em formato compacto
+// (bitmask base64) e os dias seguintes são buscados em segundo plano.
+const WINDOW = 7, CACHE_MAX = 42, CACHE_TTL = 60000;
+const cache = new Map(), inflight = new Map();
+const slotsDiv = document.getElementById('slots');
+
+function addDays(iso, n) {
+    const d = new Date(iso + 'T12:00:00'); d.setDate(d.getDate() + n);
+    return d.toISOString().slice(0, 10);
+}
+function decode(entry, cell) {
+    if(!entry) return [];
+    const [origin, mask] = entry, bytes = atob(mask), times = [];
+    for(let i = 0; i < bytes.length * 8; i++) {
+        if(bytes.charCodeAt(i >> 3) & (1 << (i & 7))) {
+            const m = origin + i * cell;
+            times.push(String(Math.floor(m / 60)).padStart(2, '0') + ':' + String(m % 60).padStart(2, '0'));
+        }
+    }
+    return times;
+}
+function cached(iso) {
+    const hit = cache.get(iso);
+    return hit && Date.now() - hit.at < CACHE_TTL ? hit.times : null;
+}
+// Resolve com null (ok) ou com a mensagem de erro a mostrar
+function fetchWindow(iso) {
+    if(inflight.has(iso)) return inflight.get(iso);
+    const p = fetch(`/api/horarios_disponiveis?service_id={{ service.id }}&date=${iso}&dias=${WINDOW}&formato=mascara`).then(async res => {
+        const data = await res.json().catch(() => ({})), at = Date.now();
+        if(res.status === 429) return 'Muitas consultas. Aguarde alguns segundos e tente novamente.';
+        if(!res.ok || !data.dias) return data.erro || 'Não foi possível carregar os horários.';
+        for(const [d, entry] of Object.entries(data.dias)) {
+            cache.delete(d); cache.set(d, {times: decode(entry, data.celula), at});
+        }
+        while(cache.size > CACHE_MAX) cache.delete(cache.keys().next().value);
+        return null;
+    }).catch(() => 'Sem conexão. Tente novamente.').finally(() => inflight.delete(iso));
+    inflight.set(iso, p);
+    return p;
+}
+function prefetch(iso) {
+    // Mantém a próxima janela aquecida sem bloquear a tela
+    const ahead = addDays(iso, WINDOW - 1);
+    if(!cached(ahead)) fetchWindow(addDays(iso, 1));
+}
+function render(times) {
+    slotsDiv.innerHTML = '';
+    document.getElementById('time').value = '';
+    document.getElementById('btn').disabled = true;
+    if(times.length === 0) slotsDiv.innerHTML = '<span class="text-danger small">Indisponível.</span>';
+    document.getElementById('waitlist').classList.toggle('d-none', times.length > 0);
     times.forEach(t => {
         const b = document.createElement('button');
         b.type='button'; b.className='btn btn-outline-dark btn-sm'; b.innerText=t;
@@ -811,9 +2337,29 @@ document.getElementById('date').addEventListener('change', async (e) => {
             document.getElementById('time').value=t;
             document.getElementById('btn').disabled=false;
         };
-        div.appendChild(b);
+        slotsDiv.appendChild(b);
     });
+}
+
+document.getElementById('date').addEventListener('change', async (e) => {
+    const iso = e.target.value;
+    if(!iso) return;
+    let times = cached(iso);
+    if(!times) {
+        slotsDiv.innerHTML = 'Carregando...';
+        const error = await fetchWindow(iso);
+        if(e.target.value !== iso) return;  // o usuário já trocou de data
+        times = cached(iso);
+        if(error || !times) {
+            const span = document.createElement('span');
+            span.className = 'text-warning small'; span.innerText = error || 'Não foi possível carregar os horários.';
+            slotsDiv.replaceChildren(span); return;
+        }
+    }
+    render(times);
+    prefetch(iso);
 });
+fetchWindow(document.getElementById('date').min);
 </script>
 {% endblock %}
 '''
@@ -861,14 +2407,1379 @@ ERROR_INACTIVE_HTML = r'''{% extends 'layout.html' %}
 {% endblock %}
 '''
 
+# --- LIMITADOR DE REQUISIÇÕES (ratelimit.py) ---
+RATELIMIT_PY = r'''import os
+import sqlite3
+import threading
+import time as time_module
+from collections import OrderedDict, defaultdict
+
+
+# --- ARMAZENAMENTO DOS BALDES (TOKEN BUCKET) ---
+class MemoryBucketStore:
+    # Baldes no próprio processo. Rápido, mas cada worker do gunicorn tem o seu.
+    def __init__(self, max_keys=50000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, capacity, cost=1.0):
+        now = time_module.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - last) * rate)
+            allowed = tokens >= cost
+            if allowed: tokens -= cost
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys: self._buckets.popitem(last=False)
+        return allowed, (0.0 if allowed else (cost - tokens) / rate)
+
+
+class SQLiteBucketStore:
+    # Baldes compartilhados entre workers via arquivo SQLite local (WAL).
+    def __init__(self, path, prune_every=1000):
+        self.path = path
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._calls = 0
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def take(self, key, rate, capacity, cost=1.0):
+        now = time_module.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, last = row if row else (capacity, now)
+            tokens = min(capacity, tokens + max(0.0, now - last) * rate)
+            allowed = tokens >= cost
+            if allowed: tokens -= cost
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._calls += 1
+        if self._calls % self.prune_every == 0: self.prune(now - 3600)
+        return allowed, (0.0 if allowed else (cost - tokens) / rate)
+
+    def prune(self, older_than):
+        self._conn().execute("DELETE FROM buckets WHERE updated < ?", (older_than,))
+
+
+def make_store(backend, sqlite_path=None):
+    if backend == 'sqlite': return SQLiteBucketStore(sqlite_path)
+    return MemoryBucketStore()
+
+
+# --- MÉTRICAS DE DESCARTE ---
+class ShedMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.allowed = defaultdict(int)
+        self.shed = defaultdict(int)
+
+    def ok(self, endpoint):
+        with self._lock: self.allowed[endpoint] += 1
+
+    def drop(self, endpoint, reason):
+        with self._lock: self.shed[(endpoint, reason)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            shed = {}
+            for (endpoint, reason), n in self.shed.items(): shed.setdefault(endpoint, {})[reason] = n
+            return {'permitidas': dict(self.allowed), 'descartadas': shed}
+
+
+# --- LIMITE DE CONCORRÊNCIA (SEM FILA) ---
+class ConcurrencyGate:
+    def __init__(self, limit):
+        self.limit = limit
+        self._sem = threading.BoundedSemaphore(limit) if limit > 0 else None
+
+    def try_enter(self):
+        return self._sem is None or self._sem.acquire(blocking=False)
+
+    def leave(self):
+        if self._sem is not None: self._sem.release()
+
+
+# --- LIMITADOR ---
+SCOPE_NAMES = {'est': 'estabelecimento', 'user': 'usuario'}
+
+class RateLimiter:
+    # Regras: "endpoint:escopo" -> (taxa por segundo, capacidade). Cada chamada consome
+    # um token do balde do IP e do balde do escopo (estabelecimento, usuário...);
+    # qualquer um vazio descarta.
+    def __init__(self, store, rules, max_concurrent=0, enabled=True):
+        self.store = store
+        self.rules = rules
+        self.gate = ConcurrencyGate(max_concurrent)
+        self.metrics = ShedMetrics()
+        self.enabled = enabled
+
+    def check(self, endpoint, client_ip, scope_key=None, scope='est'):
+        # Retorna (status_http, retry_after); status None significa liberado.
+        if not self.enabled: return None, 0
+        ip_rate, ip_cap = self.rules[endpoint + ':ip']
+        allowed, wait = self.store.take(f"{endpoint}:ip:{client_ip}", ip_rate, ip_cap)
+        if not allowed:
+            self.metrics.drop(endpoint, 'ip'); return 429, wait
+        if scope_key is not None:
+            rate, cap = self.rules[f"{endpoint}:{scope}"]
+            allowed, wait = self.store.take(f"{endpoint}:{scope}:{scope_key}", rate, cap)
+            if not allowed:
+                self.metrics.drop(endpoint, SCOPE_NAMES.get(scope, scope)); return 429, wait
+        return None, 0
+
+    def enter(self, endpoint):
+        if not self.enabled or self.gate.try_enter(): return True
+        self.metrics.drop(endpoint, 'concorrencia')
+        return False
+
+    def leave(self):
+        if self.enabled: self.gate.leave()
+'''
+
+# --- CLIENTE STRIPE (stripe_gateway.py) ---
+STRIPE_GATEWAY_PY = r'''import threading
+import time as time_module
+
+import stripe
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# --- DISJUNTOR (CIRCUIT BREAKER) ---
+class CircuitBreaker:
+    # Fechado: chamadas passam. Aberto: falha imediata até reset_timeout.
+    # Meio-aberto: uma única chamada de teste decide se fecha ou reabre.
+    def __init__(self, failure_threshold=3, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None: return 'fechado'
+        if time_module.monotonic() - self.opened_at >= self.reset_timeout: return 'meio-aberto'
+        return 'aberto'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'fechado': return True
+            if state == 'meio-aberto' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures, self.opened_at, self._probing = 0, None, False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_at = time_module.monotonic()
+            self._probing = False
+
+
+# --- CLIENTE DE CHECKOUT ---
+class StripeCheckout:
+    # Envolve stripe.checkout.Session.create com timeout curto, disjuntor e
+    # reaproveitamento da sessão aberta de cada estabelecimento até expirar.
+    def __init__(self, api_key, price_id, timeout=(2.0, 5.0), api_base=None, session_ttl=3600,
+                 failure_threshold=3, reset_timeout=30.0):
+        self.api_key = api_key
+        self.price_id = price_id
+        self.session_ttl = max(1800, min(session_ttl, 86400))  # limites aceitos pelo Stripe
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._sessions = {}
+        self._lock = threading.Lock()
+        stripe.default_http_client = stripe.RequestsClient(timeout=timeout)
+        stripe.max_network_retries = 0
+        if api_base: stripe.api_base = api_base.rstrip('/')
+
+    @property
+    def configured(self):
+        return bool(self.api_key)
+
+    def checkout_url(self, establishment_id, customer_email, success_url, cancel_url):
+        params = (customer_email, success_url, cancel_url)
+        now = time_module.time()
+        with self._lock:
+            cached = self._sessions.get(establishment_id)
+        # Margem de 60s para o cliente não cair numa sessão que expira no caminho
+        if cached and cached[1] - 60 > now and cached[2] == params: return cached[0]
+        if not self.breaker.allow(): raise CircuitOpenError('Stripe indisponível no momento.')
+        try:
+            session = stripe.checkout.Session.create(
+                api_key=self.api_key,
+                payment_method_types=['card'],
+                line_items=[{'price': self.price_id, 'quantity': 1}],
+                mode='subscription',
+                allow_promotion_codes=True,
+                success_url=success_url,
+                cancel_url=cancel_url,
+                customer_email=customer_email,
+                client_reference_id=str(establishment_id),
+                expires_at=int(now) + self.session_ttl,
+            )
+        except stripe.InvalidRequestError:
+            # Erro de parâmetros não indica API fora do ar
+            self.breaker.success()
+            raise
+        except Exception:
+            self.breaker.failure()
+            raise
+        self.breaker.success()
+        with self._lock:
+            self._sessions[establishment_id] = (session.url, int(now) + self.session_ttl, params)
+        return session.url
+
+    def forget(self, establishment_id):
+        with self._lock: self._sessions.pop(establishment_id, None)
+'''
+
+# --- INSTRUMENTAÇÃO (instrumentation.py) ---
+INSTRUMENTATION_PY = r'''import threading
+from collections import deque
+
+
+# --- LATÊNCIA (JANELA DESLIZANTE) ---
+class LatencyWindow:
+    # Guarda as últimas `size` medições e calcula percentis sob demanda.
+    def __init__(self, size=2048):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock: samples = sorted(self._samples)
+        if not samples: return {'n': self.count}
+        def pct(p): return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 2)
+        return {'n': self.count, 'p50_ms': pct(0.50), 'p95_ms': pct(0.95), 'p99_ms': pct(0.99), 'max_ms': round(samples[-1] * 1000, 2)}
+'''
+
+# --- HASH DE SENHAS (passwords.py) ---
+PASSWORDS_PY = r'''import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashPoolBusy(Exception):
+    pass
+
+
+# --- HASH DE SENHAS (POOL LIMITADO) ---
+class PasswordHasher:
+    # scrypt/pbkdf2 do hashlib liberam o GIL, então o pool roda hashes em paralelo
+    # sem travar a thread da requisição além do necessário. A fila é limitada:
+    # passou de max_pending, a verificação é recusada em vez de enfileirada.
+    def __init__(self, method='scrypt:32768:8:1', workers=2, max_pending=8, timeout=10.0):
+        self.method = method
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hash')
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False): raise HashPoolBusy()
+        try: future = self._pool.submit(fn, *args)
+        except Exception:
+            self._slots.release(); raise
+        future.add_done_callback(lambda _: self._slots.release())
+        # Fila parada além do prazo é o mesmo caso do pool cheio para quem chamou
+        try: return future.result(timeout=self.timeout)
+        except FutureTimeout: raise HashPoolBusy() from None
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        # Formato werkzeug: "metodo:parametros$salt$hash"
+        return pwhash.split('$', 1)[0] != self.method
+'''
+
+# --- HUB DE EVENTOS (events.py) ---
+EVENTS_PY = r'''import logging
+import queue
+import threading
+import time as time_module
+
+log = logging.getLogger('agenda.eventos')
+
+
+# --- ASSINATURA (UMA POR CONEXÃO SSE) ---
+class Subscription:
+    def __init__(self, establishment_id, buffer_size):
+        self.establishment_id = establishment_id
+        self.queue = queue.Queue(maxsize=buffer_size)
+        self.overflowed = False
+
+    def push(self, event):
+        try: self.queue.put_nowait(event)
+        except queue.Full:
+            # Cliente lento: em vez de crescer sem limite, pede ressincronização
+            self.overflowed = True
+
+    def get(self, timeout):
+        try: return self.queue.get(timeout=timeout)
+        except queue.Empty: return None
+
+
+# --- HUB PUBLICAR/ASSINAR ENTRE WORKERS ---
+class EventHub:
+    # Os workers do gunicorn não compartilham memória, então o hub de cada worker
+    # lê os eventos do banco (tabela de alterações) com UMA consulta por intervalo,
+    # independente do número de conexões, e distribui por estabelecimento.
+    # Sem assinantes, a thread fica parada e não consulta nada.
+    # Ids pulados pelo cursor são transações ainda não confirmadas (o id é reservado
+    # no INSERT, a confirmação pode vir depois de uma com id maior): ficam numa lista
+    # de lacunas relida a cada ciclo até aparecerem ou passarem `gap_ttl` segundos
+    # (transação desfeita).
+    def __init__(self, fetch_after, fetch_latest, interval=1.0, buffer_size=100, gap_ttl=30.0, max_gaps=1000):
+        self.fetch_after = fetch_after      # (after_id, gap_ids) -> [(id, establishment_id, event)]
+        self.fetch_latest = fetch_latest    # () -> id mais recente
+        self.interval = interval
+        self.buffer_size = buffer_size
+        self.gap_ttl = gap_ttl
+        self.max_gaps = max_gaps
+        self._gaps = {}  # id pulado -> quando foi visto (monotonic)
+        self._subs = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._cursor = None
+
+    def subscribe(self, establishment_id):
+        # O cursor é fixado aqui (e não na thread) para que a leitura de recuperação
+        # feita logo depois pela conexão cubra tudo que o hub ainda não entregou.
+        sub = Subscription(establishment_id, self.buffer_size)
+        with self._lock:
+            self._subs.setdefault(establishment_id, set()).add(sub)
+            if self._cursor is None: self._cursor = self.fetch_latest()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='event-hub', daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subs.get(sub.establishment_id)
+            if subs:
+                subs.discard(sub)
+                if not subs: del self._subs[sub.establishment_id]
+
+    def subscriber_count(self):
+        with self._lock: return sum(len(s) for s in self._subs.values())
+
+    def _run(self):
+        while True:
+            with self._lock:
+                idle = not self._subs
+                if idle: self._cursor = None; self._gaps.clear(); self._wake.clear()
+            if idle:
+                self._wake.wait()
+                continue
+            try:
+                self._poll()
+            except Exception:
+                log.exception("Erro no hub de eventos.")
+            time_module.sleep(self.interval)
+
+    def _poll(self):
+        now = time_module.monotonic()
+        for event_id, establishment_id, event in self.fetch_after(self._cursor, sorted(self._gaps)):
+            if event_id > self._cursor:
+                # Salto grande demais (sequência reiniciada, importação) não vira lacuna
+                if event_id - self._cursor <= self.max_gaps:
+                    for missing in range(self._cursor + 1, event_id): self._gaps[missing] = now
+                self._cursor = event_id
+            elif self._gaps.pop(event_id, None) is None:
+                continue
+            with self._lock: targets = list(self._subs.get(establishment_id, ()))
+            for sub in targets: sub.push(event)
+        for gap in [g for g, seen in self._gaps.items() if now - seen > self.gap_ttl]: del self._gaps[gap]
+        while len(self._gaps) > self.max_gaps: del self._gaps[min(self._gaps)]
+'''
+
+# --- MOTOR DE DISPONIBILIDADE (availability.py) ---
+AVAILABILITY_PY = r'''import base64
+from collections import namedtuple
+
+# Expediente de um recurso (cadeira/profissional) num dia, em minutos desde 00:00.
+# busy: lista de (inicio, fim) — agendamentos e almoço.
+ResourceDay = namedtuple('ResourceDay', 'resource_id work_start work_end busy')
+
+
+def to_minutes(t):
+    return t.hour * 60 + t.minute
+
+
+def start_ranges(day, duration):
+    # Faixas [a, b] de inícios possíveis: lacunas livres com pelo menos `duration`.
+    ranges, cursor = [], day.work_start
+    for bs, be in sorted(day.busy):
+        if be <= bs or be <= cursor: continue
+        gap_end = min(bs, day.work_end)
+        if gap_end - cursor >= duration: ranges.append((cursor, gap_end - duration))
+        cursor = be
+        if cursor >= day.work_end: return ranges
+    if day.work_end - cursor >= duration: ranges.append((cursor, day.work_end - duration))
+    return ranges
+
+
+def available_starts(days, duration, step=15, not_before=None):
+    # Varredura única: junta as faixas livres de todos os recursos, une as que se
+    # sobrepõem e percorre a grade de `step` minutos uma vez. Um horário está livre
+    # se pelo menos um recurso comporta o serviço inteiro a partir dele.
+    ranges = sorted(r for day in days for r in start_ranges(day, duration))
+    if not ranges: return []
+    merged = [list(ranges[0])]
+    for a, b in ranges[1:]:
+        if a <= merged[-1][1]: merged[-1][1] = max(merged[-1][1], b)
+        else: merged.append([a, b])
+    anchor = min(day.work_start for day in days)
+    starts = []
+    for a, b in merged:
+        if not_before is not None: a = max(a, not_before)
+        t = anchor + -(-(a - anchor) // step) * step
+        while t <= b:
+            starts.append(t); t += step
+    return starts
+
+
+def find_free_resource(days, start, duration):
+    end = start + duration
+    for day in days:
+        if start < day.work_start or end > day.work_end: continue
+        if all(not (max(start, bs) < min(end, be)) for bs, be in day.busy): return day
+    return None
+
+
+def encode_starts(starts, origin, cell=5):
+    # Formato compacto: bit i ligado = horário livre em origin + i*cell minutos,
+    # bits em ordem little-endian dentro de cada byte, tudo em base64.
+    if not starts: return ''
+    bits = bytearray((starts[-1] - origin) // cell // 8 + 1)
+    for m in starts:
+        i = (m - origin) // cell
+        bits[i // 8] |= 1 << (i % 8)
+    return base64.b64encode(bytes(bits)).decode('ascii')
+'''
+
+# --- AGENDADOR DE LEMBRETES (reminders.py) ---
+REMINDERS_PY = r'''import heapq
+import logging
+import threading
+import time as time_module
+from datetime import timedelta
+
+log = logging.getLogger('agenda.lembretes')
+
+
+# --- AGENDADOR DE LEMBRETES (HEAP DE PRAZOS) ---
+class ReminderScheduler:
+    # Mantém um min-heap (prazo, agendamento, índice do lembrete) e dorme exatamente
+    # até o próximo prazo. create/delete atualizam o heap na hora; a reconciliação
+    # periódica relê o banco para pegar o que outros workers gravaram.
+    # Cancelamento é preguiçoso: cada agendamento tem uma geração, e entradas de
+    # gerações antigas são descartadas ao sair do heap.
+    def __init__(self, offsets, load_pending, fire, now_fn, reconcile_every=600, grace=600):
+        self.offsets = [timedelta(minutes=m) for m in offsets]  # do maior para o menor
+        self.full_mask = (1 << len(offsets)) - 1
+        self.load_pending = load_pending  # (ate) -> [(id, datetime, mascara_enviados)]
+        self.fire = fire                  # (id, indice) -> None
+        self.now = now_fn
+        self.reconcile_every = reconcile_every
+        self.grace = timedelta(seconds=grace)
+        self._heap = []
+        self._gen = {}
+        self._cond = threading.Condition()
+        self._next_reconcile = 0.0
+
+    @property
+    def horizon(self):
+        # Só entra no heap o que vence antes da próxima reconciliação (com folga)
+        return self.now() + timedelta(seconds=2 * self.reconcile_every)
+
+    def _push(self, appt_id, appt_dt, sent_mask, now, horizon):
+        gen = self._gen.get(appt_id, 0) + 1
+        pushed = False
+        for idx, offset in enumerate(self.offsets):
+            if sent_mask & (1 << idx): continue
+            deadline = appt_dt - offset
+            # Prazo perdido além da tolerância (ex: agendado 30 min antes) não dispara
+            if deadline + self.grace < now or deadline > horizon: continue
+            heapq.heappush(self._heap, (deadline, appt_id, idx, gen)); pushed = True
+        if pushed: self._gen[appt_id] = gen
+        else: self._gen.pop(appt_id, None)
+
+    def schedule(self, appt_id, appt_dt, sent_mask=0):
+        with self._cond:
+            self._push(appt_id, appt_dt, sent_mask, self.now(), self.horizon)
+            self._cond.notify()
+
+    def cancel(self, appt_id):
+        with self._cond: self._gen.pop(appt_id, None)
+
+    def reconcile(self):
+        pending = self.load_pending(self.horizon + max(self.offsets, default=timedelta(0)))
+        now, horizon = self.now(), self.horizon
+        with self._cond:
+            self._heap, self._gen = [], {}
+            for appt_id, appt_dt, sent_mask in pending: self._push(appt_id, appt_dt, sent_mask, now, horizon)
+            self._cond.notify()
+
+    def size(self):
+        with self._cond: return len(self._heap)
+
+    def _pop_due(self):
+        # Espera até o próximo prazo ou a próxima reconciliação; devolve o que venceu
+        with self._cond:
+            while True:
+                while self._heap and self._gen.get(self._heap[0][1]) != self._heap[0][3]:
+                    heapq.heappop(self._heap)
+                until_reconcile = self._next_reconcile - time_module.monotonic()
+                if until_reconcile <= 0: return None
+                if self._heap:
+                    wait = (self._heap[0][0] - self.now()).total_seconds()
+                    if wait <= 0:
+                        _, appt_id, idx, _ = heapq.heappop(self._heap)
+                        return appt_id, idx
+                    self._cond.wait(min(wait, until_reconcile))
+                else:
+                    self._cond.wait(until_reconcile)
+
+    def run(self):
+        while True:
+            try:
+                if time_module.monotonic() >= self._next_reconcile:
+                    self.reconcile()
+                    self._next_reconcile = time_module.monotonic() + self.reconcile_every
+                due = self._pop_due()
+                if due: self.fire(*due)
+            except Exception:
+                log.exception("Erro no worker de lembretes.")
+                time_module.sleep(10)
+'''
+
+# --- CACHE DE FRAGMENTOS (fragcache.py) ---
+FRAGCACHE_PY = r'''from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+
+# --- {% cache %} PARA FRAGMENTOS DE TEMPLATE ---
+class FragmentCacheExtension(Extension):
+    # Uso: {% cache 'servicos', establishment.id, establishment.content_version %}...{% endcache %}
+    # A chave inclui a versão do estabelecimento, então uma alteração gera uma chave
+    # nova e o fragmento antigo simplesmente sai pelo LRU (sharedcache.LRUCache); não há
+    # invalidação explícita.
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'): parts.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cached', [nodes.List(parts)]), [], [], body).set_lineno(lineno)
+
+    def _cached(self, parts, caller):
+        cache = self.environment.fragment_cache
+        if cache is None: return caller()
+        key = 'fragmento:' + ':'.join(str(p) for p in parts)
+        html = cache.get(key)
+        if html is None:
+            html = str(caller())
+            cache.set(key, html)
+        return Markup(html)
+'''
+
+# --- CONFIGURAÇÃO DO GUNICORN (gunicorn.conf.py) ---
+GUNICORN_CONF = r'''import gc
+import os
+import sys
+import time as time_module
+
+# Configuração do gunicorn (Procfile: gunicorn app:app -c gunicorn.conf.py)
+# Com preload o master importa Flask, SQLAlchemy e stripe uma vez e os workers
+# compartilham essas páginas via copy-on-write. O que não pode atravessar o fork
+# (conexões do pool e a thread de lembretes) é tratado nos hooks abaixo.
+# Para comparar com o modo antigo: GUNICORN_PRELOAD=0.
+
+os.environ.setdefault('BACKGROUND_SERVICES', 'post_fork')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', '8'))
+# Cada aba do painel com o stream de agendamentos (SSE) ocupa uma thread por até
+# 5 min. Por worker, no máximo SSE_MAX_STREAMS streams (padrão: metade das threads);
+# acima disso o stream responde 503 e a aba cai para o polling de 15 s. Capacidade
+# total de streams = workers x SSE_MAX_STREAMS; para mais abas abertas, aumente
+# WEB_THREADS (threads são baratas aqui: o stream fica parado esperando eventos).
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+_forked_at = {}
+
+
+def _memory_mb():
+    # RSS total e a parte ainda compartilhada com o master (Linux); fora do Linux só o RSS
+    rss = shared = None
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                if name == 'Rss': rss = int(value.split()[0]) / 1024
+                elif name in ('Shared_Clean', 'Shared_Dirty'): shared = (shared or 0) + int(value.split()[0]) / 1024
+    except OSError:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return rss, shared
+
+
+def when_ready(server):
+    # App já carregado no master: congela os objetos atuais para o GC não tocar
+    # nessas páginas nos workers (o que quebraria o compartilhamento copy-on-write)
+    if preload_app: gc.freeze()
+    rss, _ = _memory_mb()
+    server.log.info("Master pronto (preload=%s): RSS %.1f MB", preload_app, rss or 0)
+
+
+def pre_fork(server, worker):
+    _forked_at[worker.age] = time_module.perf_counter()
+
+
+def post_fork(server, worker):
+    appmod = sys.modules.get('app')
+    if appmod: appmod.dispose_engines()
+
+
+def post_worker_init(worker):
+    appmod = sys.modules.get('app')
+    if appmod: appmod.start_background_services()
+    boot = (time_module.perf_counter() - _forked_at.get(worker.age, time_module.perf_counter())) * 1000
+    rss, shared = _memory_mb()
+    worker.log.info("Worker %s pronto em %.0f ms: RSS %.1f MB%s", worker.pid, boot, rss or 0,
+                    f" (compartilhado {shared:.1f} MB)" if shared is not None else '')
+'''
+
+# --- PERFIL DE REQUISIÇÕES (profiling.py) ---
+PROFILING_PY = r'''import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time as time_module
+from datetime import datetime
+
+log = logging.getLogger('agenda.perfil')
+
+
+# --- PERFIL SOB DEMANDA (cProfile + SQL) ---
+class RequestProfiler:
+    # Perfila uma requisição inteira com cProfile e anota cada SQL com sua duração.
+    # Liga por requisição (cabeçalho de admin) ou por amostragem (sample_rate). Só um
+    # perfil por processo de cada vez: o cProfile é global ao interpretador em versões
+    # novas do Python, então uma requisição concorrente simplesmente não é perfilada.
+    # Desligado, o custo é uma comparação por requisição e um getattr por SQL.
+    def __init__(self, directory, max_files=50, sample_rate=0.0, top=30):
+        self.directory = directory
+        self.max_files = max_files
+        self.sample_rate = sample_rate
+        self.top = top
+        self._busy = threading.Lock()
+        self._local = threading.local()
+
+    def wants(self, forced):
+        return forced or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def start(self, meta):
+        if not self._busy.acquire(blocking=False): return False
+        prof = cProfile.Profile()
+        self._local.run = {'prof': prof, 'sql': [], 'meta': meta, 'started': time_module.perf_counter()}
+        prof.enable()
+        return True
+
+    def active(self):
+        return getattr(self._local, 'run', None) is not None
+
+    # Ligados aos eventos before/after_cursor_execute do SQLAlchemy
+    def sql_start(self, conn, cursor, statement, parameters, context, executemany):
+        if getattr(self._local, 'run', None) is None: return
+        conn.info.setdefault('profile_started', []).append(time_module.perf_counter())
+
+    def sql_end(self, conn, cursor, statement, parameters, context, executemany):
+        run = getattr(self._local, 'run', None)
+        if run is None or not conn.info.get('profile_started'): return
+        elapsed = time_module.perf_counter() - conn.info['profile_started'].pop()
+        run['sql'].append({'ms': round(elapsed * 1000, 3), 'sql': ' '.join(statement.split())[:2000], 'lote': bool(executemany)})
+
+    def finish(self, status=None):
+        run = getattr(self._local, 'run', None)
+        if run is None: return None
+        self._local.run = None
+        try:
+            run['prof'].disable()
+            total = (time_module.perf_counter() - run['started']) * 1000
+            return self._save(run, total, status)
+        except OSError as e:
+            log.error("Erro ao salvar perfil.", extra={'erro': str(e)}); return None
+        finally:
+            self._busy.release()
+
+    def _save(self, run, total_ms, status):
+        os.makedirs(self.directory, exist_ok=True)
+        meta = run['meta']
+        slug = re.sub(r'[^a-zA-Z0-9]+', '-', meta.get('path', '')).strip('-')[:60] or 'raiz'
+        name = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}-{slug}-{int(total_ms)}ms"
+        run['prof'].dump_stats(os.path.join(self.directory, name + '.prof'))
+        text = io.StringIO()
+        pstats.Stats(run['prof'], stream=text).sort_stats('cumulative').print_stats(self.top)
+        sql_ms = sum(q['ms'] for q in run['sql'])
+        summary = {**meta, 'nome': name, 'status': status, 'total_ms': round(total_ms, 2), 'sql_ms': round(sql_ms, 2),
+                   'sql_qtd': len(run['sql']), 'sql': run['sql'], 'funcoes': text.getvalue()}
+        with open(os.path.join(self.directory, name + '.json'), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False)
+        self._rotate()
+        return name
+
+    def _rotate(self):
+        names = sorted(n[:-5] for n in os.listdir(self.directory) if n.endswith('.json'))
+        for old in names[:max(0, len(names) - self.max_files)]:
+            for ext in ('.json', '.prof'):
+                try: os.remove(os.path.join(self.directory, old + ext))
+                except OSError: pass
+
+    def list(self):
+        # Mais recentes primeiro, sem o texto das funções e a lista de SQL
+        try: names = sorted((n[:-5] for n in os.listdir(self.directory) if n.endswith('.json')), reverse=True)
+        except OSError: return []
+        out = []
+        for name in names:
+            try:
+                with open(os.path.join(self.directory, name + '.json'), encoding='utf-8') as f: data = json.load(f)
+            except (OSError, ValueError): continue
+            data.pop('funcoes', None); data.pop('sql', None)
+            out.append(data)
+        return out
+
+    def load(self, name):
+        if not re.fullmatch(r'[\w.-]+', name): return None
+        try:
+            with open(os.path.join(self.directory, name + '.json'), encoding='utf-8') as f: return json.load(f)
+        except (OSError, ValueError): return None
+'''
+
+# --- LOGS ESTRUTURADOS (logconfig.py) ---
+LOGCONFIG_PY = r'''import atexit
+import json
+import logging
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# Atributos padrão de LogRecord; o que vier a mais (extra=...) vira campo do JSON
+_STANDARD = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+
+# --- FORMATOS ---
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                'nivel': record.levelname, 'logger': record.name, 'msg': record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in _STANDARD: data[key] = value
+        if record.exc_info: data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        extra = ' '.join(f"{k}={v}" for k, v in vars(record).items() if k not in _STANDARD)
+        return f"{line} {extra}" if extra else line
+
+
+# --- FILA + THREAD DE ESCRITA ---
+class _State:
+    listener = None
+
+
+def setup_logging(level='INFO', levels='', fmt='json', root='agenda'):
+    # Quem loga só enfileira (QueueHandler, sem I/O); uma thread (QueueListener) escreve
+    # no stdout. levels: "agenda.email=DEBUG,agenda.lembretes=WARNING".
+    if _State.listener is not None: return logging.getLogger(root)
+    log_queue = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    logger = logging.getLogger(root)
+    logger.setLevel(level.upper())
+    logger.addHandler(QueueHandler(log_queue))
+    logger.propagate = False
+    for item in filter(None, (p.strip() for p in levels.split(','))):
+        name, _, lvl = item.partition('=')
+        logging.getLogger(name.strip()).setLevel(lvl.strip().upper())
+    _State.listener = QueueListener(log_queue, output, respect_handler_level=True)
+    _State.listener.start()
+    atexit.register(_stop)
+    # A thread de escrita não sobrevive ao fork (gunicorn --preload): cada filho inicia a sua
+    if hasattr(os, 'register_at_fork'): os.register_at_fork(after_in_child=_restart_in_child)
+    return logger
+
+
+def _restart_in_child():
+    if _State.listener is not None:
+        _State.listener._thread = None
+        _State.listener.start()
+
+
+def _stop():
+    if _State.listener is not None and _State.listener._thread is not None:
+        _State.listener.stop()
+'''
+
+# --- FEED ICALENDAR (icsfeed.py) ---
+ICSFEED_PY = r'''from datetime import datetime, timedelta
+
+# iCalendar (RFC 5545): linhas CRLF com no máximo 75 octetos, texto escapado.
+# Os horários do app são de Brasília (UTC-3 fixo, como get_now_brazil), então os
+# eventos saem em UTC e cada calendário converte para o fuso do usuário.
+BRAZIL_OFFSET = timedelta(hours=3)
+
+
+def escape_text(value):
+    return (value or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def fold(line):
+    data = line.encode('utf-8')
+    if len(data) <= 75: return line + '\r\n'
+    parts, start, limit = [], 0, 75
+    while start < len(data):
+        end = min(start + limit, len(data))
+        while end < len(data) and (data[end] & 0xC0) == 0x80: end -= 1  # não corta caractere UTF-8
+        parts.append(data[start:end].decode('utf-8'))
+        start, limit = end, 74  # linhas de continuação começam com um espaço
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def utc_stamp(local_dt):
+    return (local_dt + BRAZIL_OFFSET).strftime('%Y%m%dT%H%M%SZ')
+
+
+def header(calendar_name):
+    return ''.join(fold(line) for line in (
+        'BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Agenda Facil//Agendamentos//PT-BR', 'CALSCALE:GREGORIAN', 'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{escape_text(calendar_name)}', 'X-PUBLISHED-TTL:PT5M', 'REFRESH-INTERVAL;VALUE=DURATION:PT5M'))
+
+
+def footer():
+    return 'END:VCALENDAR\r\n'
+
+
+def event(uid, start, duration_minutes, summary, description, updated_at=None):
+    # start: datetime local (Brasília); updated_at: datetime UTC
+    stamp = (updated_at or datetime.utcnow()).strftime('%Y%m%dT%H%M%SZ')
+    return ''.join(fold(line) for line in (
+        'BEGIN:VEVENT', f'UID:{uid}', f'DTSTAMP:{stamp}', f'DTSTART:{utc_stamp(start)}',
+        f'DTEND:{utc_stamp(start + timedelta(minutes=duration_minutes))}',
+        f'SUMMARY:{escape_text(summary)}', f'DESCRIPTION:{escape_text(description)}', 'END:VEVENT'))
+'''
+
+# --- CACHE COMPARTILHADO (sharedcache.py) ---
+SHAREDCACHE_PY = r'''import json
+import logging
+import os
+import sqlite3
+import threading
+import time as time_module
+from collections import OrderedDict
+
+from instrumentation import LatencyWindow
+
+log = logging.getLogger('agenda.cache')
+
+
+# --- ESTATÍSTICAS COMUNS ---
+class _Stats:
+    def _init_stats(self):
+        self.hits = self.misses = self.sets = self.errors = 0
+        self.latency = LatencyWindow(1024)
+
+    def stats(self):
+        return {'backend': self.name, 'acertos': self.hits, 'faltas': self.misses, 'gravacoes': self.sets, 'erros': self.errors, 'leitura': self.latency.snapshot()}
+
+
+# --- LRU EM MEMÓRIA (POR PROCESSO) ---
+class LRUCache(_Stats):
+    name = 'memoria'
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._init_stats()
+
+    def get(self, key):
+        started = time_module.perf_counter()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] is not None and item[1] < time_module.monotonic():
+                del self._data[key]; item = None
+            if item is None: self.misses += 1
+            else:
+                self._data.move_to_end(key); self.hits += 1
+        self.latency.observe(time_module.perf_counter() - started)
+        return None if item is None else item[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time_module.monotonic() + ttl if ttl else None)
+            self._data.move_to_end(key)
+            self.sets += 1
+            while len(self._data) > self.max_entries: self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock: self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock: size = len(self._data)
+        return {**super().stats(), 'entradas': size}
+
+
+# --- ARQUIVO SQLITE LOCAL (COMPARTILHADO ENTRE WORKERS) ---
+class SQLiteCache(_Stats):
+    # Valores em JSON num arquivo WAL; também guarda os carimbos de versão dos namespaces.
+    name = 'sqlite'
+
+    def __init__(self, path, prune_every=1000):
+        self.path = path
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._init_stats()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS stamps (ns TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key):
+        started = time_module.perf_counter()
+        row = self._conn().execute("SELECT value, expires FROM entries WHERE key = ?", (key,)).fetchone()
+        if row and row[1] is not None and row[1] < time_module.time(): row = None
+        if row is None: self.misses += 1
+        else: self.hits += 1
+        self.latency.observe(time_module.perf_counter() - started)
+        return None if row is None else json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        self._conn().execute("INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)", (key, json.dumps(value), time_module.time() + ttl if ttl else None))
+        self.sets += 1
+        if self.sets % self.prune_every == 0: self._conn().execute("DELETE FROM entries WHERE expires < ?", (time_module.time(),))
+
+    def delete(self, key):
+        self._conn().execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def stamp(self, ns):
+        row = self._conn().execute("SELECT version FROM stamps WHERE ns = ?", (ns,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, ns):
+        conn = self._conn()
+        conn.execute("INSERT INTO stamps (ns, version) VALUES (?, 1) ON CONFLICT (ns) DO UPDATE SET version = version + 1", (ns,))
+        return self.stamp(ns)
+
+
+# --- REDIS (OPCIONAL) ---
+class RedisCache(_Stats):
+    name = 'redis'
+
+    def __init__(self, url, prefix='agenda:'):
+        import redis  # dependência opcional: só com CACHE_BACKEND=redis
+        self._redis = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.5)
+        self._redis.ping()
+        self.prefix = prefix
+        self._init_stats()
+
+    def get(self, key):
+        started = time_module.perf_counter()
+        raw = self._redis.get(self.prefix + key)
+        if raw is None: self.misses += 1
+        else: self.hits += 1
+        self.latency.observe(time_module.perf_counter() - started)
+        return None if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        self._redis.set(self.prefix + key, json.dumps(value), ex=int(ttl) if ttl else None)
+        self.sets += 1
+
+    def delete(self, key):
+        self._redis.delete(self.prefix + key)
+
+    def stamp(self, ns):
+        return int(self._redis.get(self.prefix + 'stamp:' + ns) or 0)
+
+    def bump(self, ns):
+        return int(self._redis.incr(self.prefix + 'stamp:' + ns))
+
+
+# --- NAMESPACES COM CARIMBO DE VERSÃO ---
+class VersionedCache:
+    # Chaves ficam em "ns@versao:chave". Invalidar um namespace incrementa o carimbo no
+    # armazenamento compartilhado (SQLite ou Redis); as entradas antigas ficam órfãs e
+    # saem por LRU/TTL. Cada worker relê o carimbo no máximo a cada `stamp_ttl`
+    # segundos, então uma invalidação feita em outro worker aparece em até stamp_ttl
+    # (no próprio worker, na hora). Erros do backend viram falta de cache.
+    def __init__(self, backend, stamps, stamp_ttl=2.0):
+        self.backend = backend
+        self.stamps = stamps
+        self.stamp_ttl = stamp_ttl
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def _version(self, ns):
+        now = time_module.monotonic()
+        cached = self._versions.get(ns)
+        if cached and now - cached[1] < self.stamp_ttl: return cached[0]
+        version = self.stamps.stamp(ns)
+        with self._lock:
+            if len(self._versions) > 10000: self._versions.clear()
+            self._versions[ns] = (version, now)
+        return version
+
+    def version(self, ns):
+        # Para quem mantém o próprio índice local: reconstruir quando a versão mudar
+        try: return self._version(ns)
+        except Exception as e:
+            self.backend.errors += 1; log.warning("Falha ao ler o carimbo.", extra={'erro': str(e), 'ns': ns}); return None
+
+    def get(self, ns, key):
+        try: return self.backend.get(f"{ns}@{self._version(ns)}:{key}")
+        except Exception as e:
+            self.backend.errors += 1; log.warning("Falha ao ler do cache.", extra={'erro': str(e)}); return None
+
+    def set(self, ns, key, value, ttl=None):
+        try: self.backend.set(f"{ns}@{self._version(ns)}:{key}", value, ttl)
+        except Exception as e:
+            self.backend.errors += 1; log.warning("Falha ao gravar no cache.", extra={'erro': str(e)})
+
+    def get_or_set(self, ns, key, loader, ttl=None):
+        # Lê o carimbo uma vez só, antes de carregar: se um commit invalidar o namespace
+        # enquanto `loader` roda, o resultado (já velho) fica na versão antiga, órfã,
+        # e não na nova. None não é guardado.
+        try:
+            full = f"{ns}@{self._version(ns)}:{key}"
+            value = self.backend.get(full)
+        except Exception as e:
+            self.backend.errors += 1; log.warning("Falha ao ler do cache.", extra={'erro': str(e)}); return loader()
+        if value is not None: return value
+        value = loader()
+        if value is not None:
+            try: self.backend.set(full, value, ttl)
+            except Exception as e:
+                self.backend.errors += 1; log.warning("Falha ao gravar no cache.", extra={'erro': str(e)})
+        return value
+
+    def invalidate(self, ns):
+        try: version = self.stamps.bump(ns)
+        except Exception as e:
+            self.backend.errors += 1; log.warning("Falha ao invalidar o cache.", extra={'erro': str(e), 'ns': ns}); return
+        with self._lock: self._versions[ns] = (version, time_module.monotonic())
+
+    def stats(self):
+        return {**self.backend.stats(), 'carimbos_ttl_s': self.stamp_ttl}
+
+
+def make_cache(backend, sqlite_path, redis_url=None, max_entries=5000, stamp_ttl=2.0):
+    # memory: valores no processo, carimbos no arquivo SQLite (invalidação chega aos outros workers)
+    # sqlite: valores e carimbos no arquivo; redis: tudo no Redis (cai para memory se indisponível)
+    if backend == 'redis':
+        try:
+            store = RedisCache(redis_url)
+            return VersionedCache(store, store, stamp_ttl)
+        except Exception as e:
+            log.warning("Redis indisponível; usando cache em memória.", extra={'erro': str(e)})
+    if backend == 'sqlite':
+        store = SQLiteCache(sqlite_path)
+        return VersionedCache(store, store, stamp_ttl)
+    return VersionedCache(LRUCache(max_entries), SQLiteCache(sqlite_path), stamp_ttl)
+'''
+
+# --- PAINEL DA REDE (templates/rede.html) ---
+REDE_HTML = r'''{% extends 'layout.html' %}
+{% block title %}Minha Rede{% endblock %}
+{% block content %}
+<div class="container py-4">
+    <div class="d-flex justify-content-between align-items-center mb-4">
+        <h1 class="h3 mb-0"><i class="bi bi-diagram-3"></i> Minha Rede</h1>
+        <span class="text-muted small">{{ rows|length }} unidade(s) · {{ today.strftime('%d/%m/%Y') }}</span>
+    </div>
+    <div class="row g-3 mb-4">
+        <div class="col-md-3"><div class="card shadow-sm border-0 p-3"><div class="small text-muted">Agendamentos hoje</div><div class="h4 mb-0">{{ totals.hoje }}</div></div></div>
+        <div class="col-md-3"><div class="card shadow-sm border-0 p-3"><div class="small text-muted">Próximos 7 dias</div><div class="h4 mb-0">{{ totals.semana }}</div></div></div>
+        <div class="col-md-3"><div class="card shadow-sm border-0 p-3"><div class="small text-muted">Faturamento hoje</div><div class="h4 mb-0 text-success">R$ {{ "%.2f"|format(totals.receita_hoje) }}</div></div></div>
+        <div class="col-md-3"><div class="card shadow-sm border-0 p-3"><div class="small text-muted">Faturamento do mês</div><div class="h4 mb-0 text-success">R$ {{ "%.2f"|format(totals.receita_mes) }}</div></div></div>
+    </div>
+    <div class="card shadow-sm border-0 mb-4">
+        <div class="card-header bg-white fw-bold">Unidades</div>
+        <div class="table-responsive">
+            <table class="table mb-0 align-middle">
+                <thead class="table-light"><tr><th>Unidade</th><th class="text-center">Hoje</th><th class="text-center">7 dias</th><th class="text-center">Futuros</th><th class="text-end">Fat. hoje</th><th class="text-end">Fat. mês</th><th></th></tr></thead>
+                <tbody>
+                    {% for r in rows %}
+                    <tr class="{% if not r.est.is_active %}text-muted{% endif %}">
+                        <td><a href="{{ url_for('establishment_services', url_prefix=r.est.url_prefix) }}" target="_blank" class="fw-bold">{{ r.est.name }}</a>
+                            {% if r.propria %}<span class="badge bg-primary ms-1">Sua unidade</span>{% endif %}{% if not r.est.is_active %}<span class="badge bg-secondary ms-1">Inativa</span>{% endif %}</td>
+                        <td class="text-center">{{ r.hoje }}</td>
+                        <td class="text-center">{{ r.semana }}</td>
+                        <td class="text-center">{{ r.futuros }}</td>
+                        <td class="text-end">R$ {{ "%.2f"|format(r.receita_hoje) }}</td>
+                        <td class="text-end">R$ {{ "%.2f"|format(r.receita_mes) }}</td>
+                        <td class="text-end">{% if not r.propria %}<form method="POST" action="{{ url_for('unlink_unit', est_id=r.est.id) }}" onsubmit="return confirm('Remover da rede?');"><button class="btn btn-link text-danger p-0 border-0"><i class="bi bi-x-circle"></i></button></form>{% endif %}</td>
+                    </tr>
+                    {% endfor %}
+                </tbody>
+                <tfoot class="table-light fw-bold"><tr><td>Total</td><td class="text-center">{{ totals.hoje }}</td><td class="text-center">{{ totals.semana }}</td><td class="text-center">{{ totals.futuros }}</td><td class="text-end">R$ {{ "%.2f"|format(totals.receita_hoje) }}</td><td class="text-end">R$ {{ "%.2f"|format(totals.receita_mes) }}</td><td></td></tr></tfoot>
+            </table>
+        </div>
+    </div>
+    <div class="card shadow-sm border-0 p-3">
+        <div class="fw-bold mb-2">Vincular unidade</div>
+        <form action="{{ url_for('link_unit') }}" method="POST" class="row g-2 align-items-end">
+            <div class="col-md-3"><label class="small fw-bold">Endereço (/b/...):</label><input type="text" name="url_prefix" class="form-control form-control-sm" required></div>
+            <div class="col-md-3"><label class="small fw-bold">Usuário do admin:</label><input type="text" name="username" class="form-control form-control-sm" required></div>
+            <div class="col-md-3"><label class="small fw-bold">Senha:</label><input type="password" name="password" class="form-control form-control-sm" required></div>
+            <div class="col-md-3"><button class="btn btn-primary btn-sm w-100">Vincular</button></div>
+        </form>
+    </div>
+</div>
+{% endblock %}
+'''
+
+# --- DIRETÓRIO PÚBLICO (directory.py) ---
+DIRECTORY_PY = r'''import threading
+import unicodedata
+from bisect import bisect_left
+from collections import namedtuple
+
+# Entrada do diretório: só estabelecimentos ativos entram no índice.
+Listing = namedtuple('Listing', 'id name url_prefix')
+
+
+def normalize(text):
+    # Minúsculas e sem acentos: "Salão" casa com "salao"
+    text = unicodedata.normalize('NFKD', (text or '').lower())
+    return ''.join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def tokens(text):
+    return [t for t in ''.join(ch if ch.isalnum() else ' ' for ch in normalize(text)).split() if t]
+
+
+# --- ÍNDICE DE PREFIXOS EM MEMÓRIA ---
+class DirectoryIndex:
+    # Lista ordenada de (termo, posição) com as palavras do nome, do url_prefix e dos
+    # serviços; uma busca é um bisect por palavra digitada (todas precisam casar com
+    # o prefixo de algum termo). Reconstruído inteiro quando a versão muda: a primeira
+    # carga bloqueia, as seguintes rodam numa thread e as buscas continuam no índice
+    # anterior até a troca.
+    def __init__(self, scan_limit=5000):
+        self.scan_limit = scan_limit
+        self.version, self._built = None, False
+        self._data = ([], [], [], [])  # (listings, nomes normalizados, termos, chaves)
+        self._lock = threading.Lock()
+
+    def ensure(self, version, load):
+        if self._built and version == self.version: return
+        if not self._lock.acquire(blocking=not self._built): return  # já há uma reconstrução em curso
+        if self._built:
+            threading.Thread(target=self._rebuild, args=(version, load), daemon=True).start()
+        else:
+            self._rebuild(version, load)
+
+    def _rebuild(self, version, load):
+        try:
+            if not self._built or version != self.version: self._build(load(), version)
+        finally:
+            self._lock.release()
+
+    def _build(self, entries, version):
+        # entries: [(Listing, [nomes de serviço])]
+        entries = sorted(entries, key=lambda e: normalize(e[0].name))
+        terms = set()
+        for pos, (listing, services) in enumerate(entries):
+            for text in (listing.name, listing.url_prefix, *services):
+                terms.update((t, pos) for t in tokens(text))
+        terms = sorted(terms)
+        # Troca atômica (uma atribuição): quem está lendo segue com o índice anterior
+        self._data = ([e[0] for e in entries], [normalize(e[0].name) for e in entries], terms, [t for t, _ in terms])
+        self.version, self._built = version, True
+
+    def _matches(self, keys, terms, prefix):
+        # (posições com algum termo começando por prefix, posições com o termo exato)
+        found, exact, i = set(), set(), bisect_left(keys, prefix)
+        while i < len(keys) and keys[i].startswith(prefix) and len(found) < self.scan_limit:
+            found.add(terms[i][1])
+            if keys[i] == prefix: exact.add(terms[i][1])
+            i += 1
+        return found, exact
+
+    def search(self, query, limit=20):
+        listings, names, terms, keys = self._data
+        words = tokens(query)
+        if not words: return listings[:limit]
+        hits, exact = None, {}
+        for word in sorted(words, key=len, reverse=True):  # a palavra mais longa filtra mais
+            found, whole = self._matches(keys, terms, word)
+            hits = found if hits is None else hits & found
+            if not hits: return []
+            for p in whole: exact[p] = exact.get(p, 0) + 1
+        # Nome começando pelo que foi digitado, depois mais palavras inteiras, depois alfabética
+        full = ' '.join(words)
+        return [listings[p] for p in sorted(hits, key=lambda p: (not names[p].startswith(full), -exact.get(p, 0), p))[:limit]]
+
+    def __len__(self):
+        return len(self._data[0])
+'''
+
+# --- DIRETÓRIO PÚBLICO (templates/diretorio.html) ---
+DIRETORIO_HTML = r'''{% extends 'layout.html' %}
+{% block title %}Encontre um Estabelecimento{% endblock %}
+{% block content %}
+<div class="container py-5">
+    <div class="row justify-content-center">
+        <div class="col-lg-7">
+            <h1 class="h3 fw-bold text-center mb-4"><i class="bi bi-search text-primary"></i> Encontre onde agendar</h1>
+            <input type="search" id="q" class="form-control form-control-lg shadow-sm mb-3" placeholder="Nome, endereço ou serviço (ex: corte, manicure)" value="{{ q }}" autocomplete="off" autofocus>
+            <div id="results" class="list-group shadow-sm"></div>
+            <p id="empty" class="text-center text-muted small mt-3 d-none">Nenhum estabelecimento encontrado.</p>
+        </div>
+    </div>
+</div>
+{% endblock %}
+{% block scripts %}
+<script>
+// Busca enquanto digita: espera uma pausa curta e descarta respostas atrasadas
+const input = document.getElementById('q'), results = document.getElementById('results'), empty = document.getElementById('empty');
+let timer = null, seq = 0;
+async function search() {
+    const mine = ++seq;
+    const res = await fetch('/api/diretorio?q=' + encodeURIComponent(input.value.trim())).catch(() => null);
+    if(!res || !res.ok || mine !== seq) return;
+    const items = await res.json();
+    if(mine !== seq) return;
+    results.innerHTML = '';
+    items.forEach(item => {
+        const a = document.createElement('a');
+        a.href = item.url; a.className = 'list-group-item list-group-item-action d-flex justify-content-between align-items-center';
+        a.textContent = item.nome;
+        const icon = document.createElement('i'); icon.className = 'bi bi-chevron-right text-muted';
+        a.appendChild(icon);
+        results.appendChild(a);
+    });
+    empty.classList.toggle('d-none', items.length > 0);
+}
+input.addEventListener('input', () => { clearTimeout(timer); timer = setTimeout(search, 150); });
+search();
+</script>
+{% endblock %}
+'''
+
+# --- INSTALAÇÃO ---
+def _hash(texto):
+    return hashlib.sha256(texto.encode('utf-8')).hexdigest()
+
+def escrever_arquivos(arquivos):
+    # Compara o hash de cada artefato com o que está em disco e só grava o que mudou
+    alterados = 0
+    for caminho, conteudo in arquivos.items():
+        novo = conteudo.strip()
+        if os.path.exists(caminho):
+            with open(caminho, encoding='utf-8') as f:
+                if _hash(f.read().strip()) == _hash(novo): continue
+        pasta = os.path.dirname(caminho)
+        if pasta: os.makedirs(pasta, exist_ok=True)
+        tmp = caminho + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(novo)
+        os.replace(tmp, caminho)
+        print(f"Atualizado: {caminho}")
+        alterados += 1
+    return alterados
+
+def dependencias_pendentes(requirements):
+    # Requisitos que não estão instalados ou cuja versão não satisfaz o especificador
+    try: from packaging.requirements import Requirement
+    except ImportError: Requirement = None
+    pendentes = []
+    for linha in requirements.splitlines():
+        linha = linha.split('#', 1)[0].strip()
+        if not linha: continue
+        if Requirement:
+            req = Requirement(linha); nome, spec = req.name, req.specifier
+        else:
+            nome, spec = re.split(r'[<>=!~\[; ]', linha, 1)[0], None
+        try: instalada = metadata.version(nome)
+        except metadata.PackageNotFoundError:
+            pendentes.append(linha); continue
+        if spec and not spec.contains(instalada, prereleases=True): pendentes.append(linha)
+    return pendentes
+
 def atualizar_sistema():
-    if not os.path.exists('templates'): os.makedirs('templates')
+    tempos = {}
+    inicio = time.perf_counter()
     uploads_path = os.path.join('static', 'uploads')
     if not os.path.exists(uploads_path): os.makedirs(uploads_path)
-    
-    if os.path.exists('agendamento.db'):
-        try: os.remove('agendamento.db')
-        except: pass
 
     arquivos = {
         'app.py': APP_PY,
@@ -882,23 +3793,62 @@ def atualizar_sistema():
         'templates/lista_servicos.html': LISTA_SERVICOS_HTML,
         'templates/agendamento.html': AGENDAMENTO_HTML,
         'templates/success_appointment.html': SUCCESS_APPOINTMENT_HTML,
-        'templates/error_inactive.html': ERROR_INACTIVE_HTML
+        'templates/error_inactive.html': ERROR_INACTIVE_HTML,
+        'ratelimit.py': RATELIMIT_PY,
+        'stripe_gateway.py': STRIPE_GATEWAY_PY,
+        'instrumentation.py': INSTRUMENTATION_PY,
+        'passwords.py': PASSWORDS_PY,
+        'events.py': EVENTS_PY,
+        'availability.py': AVAILABILITY_PY,
+        'reminders.py': REMINDERS_PY,
+        'fragcache.py': FRAGCACHE_PY,
+        'gunicorn.conf.py': GUNICORN_CONF,
+        'profiling.py': PROFILING_PY,
+        'logconfig.py': LOGCONFIG_PY,
+        'icsfeed.py': ICSFEED_PY,
+        'sharedcache.py': SHAREDCACHE_PY,
+        'templates/rede.html': REDE_HTML,
+        'directory.py': DIRECTORY_PY,
+        'templates/diretorio.html': DIRETORIO_HTML
     }
 
-    for caminho, conteudo in arquivos.items():
-        with open(caminho, 'w', encoding='utf-8') as f:
-            f.write(conteudo.strip())
-        print(f"Atualizado: {caminho}")
+    etapa = time.perf_counter()
+    alterados = escrever_arquivos(arquivos)
+    print(f"[INFO] {alterados} de {len(arquivos)} arquivo(s) alterado(s).")
+    tempos['arquivos'] = time.perf_counter() - etapa
 
-    print("\n[INFO] Instalando dependências...")
-    try:
-        subprocess.check_call([sys.executable, "-m", "pip", "install", "-r", "requirements.txt"])
-        print("[SUCESSO] Dependências instaladas!")
-    except Exception as e:
-        print(f"[ERRO] Instale manualmente: pip install -r requirements.txt")
+    etapa = time.perf_counter()
+    pendentes = dependencias_pendentes(REQUIREMENTS_TXT)
+    if pendentes:
+        print(f"\n[INFO] Instalando dependências: {', '.join(pendentes)}")
+        try:
+            subprocess.check_call([sys.executable, "-m", "pip", "install", *pendentes])
+            print("[SUCESSO] Dependências instaladas!")
+        except Exception as e:
+            print(f"[ERRO] Instale manualmente: pip install -r requirements.txt")
+    else:
+        print("[INFO] Dependências já satisfeitas; pip ignorado.")
+    tempos['dependências'] = time.perf_counter() - etapa
+
+    # O banco nunca é apagado: migrate() cria tabelas novas e roda run_migrations().
+    # Sem a migração automática do import (que só registra o erro) e sem os serviços
+    # de fundo (robô de lembretes, fila de espera); falhou, a atualização para aqui.
+    etapa = time.perf_counter()
+    print("\n[INFO] Aplicando migrações...")
+    env = dict(os.environ, AUTO_MIGRATE='0', BACKGROUND_SERVICES='off')
+    resultado = subprocess.run([sys.executable, "-c", "import app; app.migrate()"], env=env)
+    tempos['migrações'] = time.perf_counter() - etapa
+    if resultado.returncode != 0:
+        print(f"[ERRO] Falha nas migrações (código {resultado.returncode}). Atualização interrompida.")
+        sys.exit(resultado.returncode)
+    print("[SUCESSO] Banco atualizado!")
+
+    print("\n--- Tempo da instalação ---")
+    for nome, segundos in tempos.items(): print(f"{nome:<14} {segundos:6.2f}s")
+    print(f"{'total':<14} {time.perf_counter() - inicio:6.2f}s")
 
     print("\n[SUCESSO] Sistema V36 (Gold Restaurada) instalado!")
     print("Execute: python app.py")
 
 if __name__ == "__main__":
-    atualizar_sistema()
\ No newline at end of file
+    atualizar_sistema()
@@ -0,0 +1,22 @@
+import threading
+from collections import deque
+
+
+# --- LATÊNCIA (JANELA DESLIZANTE) ---
+class LatencyWindow:
+    # Guarda as últimas `size` medições e calcula percentis sob demanda.
+    def __init__(self, size=2048):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock: samples = sorted(self._samples)
+        if not samples: return {'n': self.count}
+        def pct(p): return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 2)
+        return {'n': self.count, 'p50_ms': pct(0.50), 'p95_ms': pct(0.95), 'p99_ms': pct(0.99), 'max_ms': round(samples[-1] * 1000, 2)}
@@ -0,0 +1,172 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time as time_module
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+# Teste de carga do fluxo de agendamento:
+#   /b/<prefixo>  ->  /api/horarios_disponiveis  ->  /b/<prefixo>/confirmar
+# Modo padrão: roda o app no próprio processo, com um SQLite temporário e dados de
+# exemplo. Com --url, dispara contra um servidor já rodando (ex: gunicorn local);
+# nesse caso inicie o servidor com RATE_LIMIT_ENABLED=0 e informe --database-url
+# para a checagem de sobreposição.
+
+STEPS = ('pagina', 'horarios', 'confirmar')
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Gerador de carga do fluxo de agendamento.')
+    p.add_argument('--clientes', type=int, default=50, help='clientes simultâneos')
+    p.add_argument('--agendamentos', type=int, default=4, help='tentativas de agendamento por cliente')
+    p.add_argument('--dias', type=int, default=1, help='quantos dias úteis disputar (menos dias = mais conflito)')
+    p.add_argument('--url', help='URL base de um servidor rodando (ex: http://127.0.0.1:8000)')
+    p.add_argument('--prefixo', default='carga', help='url_prefix do estabelecimento')
+    p.add_argument('--servico', type=int, help='id do serviço (padrão: o criado pelo teste)')
+    p.add_argument('--recursos', type=int, default=0, help='cadeiras criadas no estabelecimento de teste')
+    p.add_argument('--database-url', help='banco para semear/verificar (padrão: SQLite temporário)')
+    p.add_argument('--seed', type=int, default=42)
+    return p.parse_args()
+
+
+# --- CLIENTES HTTP ---
+class InProcessClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path, params=None):
+        r = self.client.get(path, query_string=params)
+        return r.status_code, (r.get_json(silent=True) if r.is_json else None)
+
+    def post(self, path, data):
+        r = self.client.post(path, data=data)
+        return r.status_code, None
+
+
+class HttpClient:
+    def __init__(self, base_url):
+        import requests
+        self.base = base_url.rstrip('/')
+        self.session = requests.Session()
+
+    def get(self, path, params=None):
+        r = self.session.get(self.base + path, params=params, timeout=30)
+        return r.status_code, (r.json() if 'json' in r.headers.get('Content-Type', '') else None)
+
+    def post(self, path, data):
+        r = self.session.post(self.base + path, data=data, allow_redirects=False, timeout=30)
+        return r.status_code, None
+
+
+# --- DADOS DE EXEMPLO ---
+def next_weekdays(n):
+    days, d = [], date.today() + timedelta(days=1)
+    while len(days) < n:
+        if d.weekday() < 5: days.append(d)
+        d += timedelta(days=1)
+    return days
+
+
+def seed(appmod, prefix, resources):
+    with appmod.app.app_context():
+        est = appmod.Establishment.query.filter_by(url_prefix=prefix).first()
+        if est is None:
+            est = appmod.Establishment(name='Teste de Carga', url_prefix=prefix, is_active=True)
+            appmod.db.session.add(est); appmod.db.session.flush()
+            for i in range(7):
+                appmod.db.session.add(appmod.DaySchedule(establishment_id=est.id, day_index=i, is_active=(i < 5), work_start=appmod.time(9, 0), work_end=appmod.time(18, 0)))
+            appmod.db.session.add(appmod.Service(name='Corte', duration=30, price=40.0, establishment_id=est.id))
+            appmod.db.session.commit()
+            for n in range(resources):
+                res = appmod.Resource(name=f'Cadeira {n + 1}', establishment_id=est.id)
+                appmod.db.session.add(res); appmod.db.session.flush()
+                for ds in appmod.DaySchedule.query.filter_by(establishment_id=est.id, resource_id=None).all():
+                    appmod.db.session.add(appmod.DaySchedule(establishment_id=est.id, resource_id=res.id, day_index=ds.day_index, is_active=ds.is_active, work_start=ds.work_start, work_end=ds.work_end))
+            appmod.db.session.commit()
+        return appmod.Service.query.filter_by(establishment_id=est.id).order_by(appmod.Service.id).first().id
+
+
+# --- VERIFICAÇÃO DE SOBREPOSIÇÃO ---
+def find_overlaps(appmod):
+    # Agendamentos do mesmo recurso (ou do estabelecimento, sem recurso) que se cruzam
+    A, S = appmod.Appointment, appmod.Service
+    with appmod.app.app_context():
+        rows = appmod.db.session.query(A.id, A.establishment_id, A.resource_id, A.appointment_date, A.appointment_time, S.duration).join(
+            S, A.service_id == S.id).order_by(A.establishment_id, A.resource_id, A.appointment_date, A.appointment_time).all()
+    overlaps, prev = [], None
+    for r in rows:
+        start = datetime.combine(r.appointment_date, r.appointment_time)
+        key = (r.establishment_id, r.resource_id, r.appointment_date)
+        if prev and prev[0] == key and start < prev[2]: overlaps.append((prev[1], r.id))
+        end = start + timedelta(minutes=r.duration)
+        if not prev or prev[0] != key or end > prev[2]: prev = (key, r.id, end)
+    return overlaps, len(rows)
+
+
+# --- EXECUÇÃO ---
+def customer(make_client, prefix, service_id, days, attempts, rng, lat, outcomes, lock):
+    client = make_client()
+    for _ in range(attempts):
+        d = rng.choice(days).isoformat()
+        t0 = time_module.perf_counter()
+        status, _ = client.get(f'/b/{prefix}')
+        t1 = time_module.perf_counter()
+        status_h, slots = client.get('/api/horarios_disponiveis', {'service_id': service_id, 'date': d})
+        t2 = time_module.perf_counter()
+        with lock:
+            lat['pagina'].append(t1 - t0); lat['horarios'].append(t2 - t1)
+            outcomes['pagina', status] += 1; outcomes['horarios', status_h] += 1
+        if not slots: continue
+        data = {'service_id': service_id, 'appointment_date': d, 'appointment_time': rng.choice(slots),
+                'client_name': f'Cliente {rng.randrange(10**6)}', 'client_phone': '11999999999', 'client_email': 'carga@example.com'}
+        status_c, _ = client.post(f'/b/{prefix}/confirmar', data)
+        with lock:
+            lat['confirmar'].append(time_module.perf_counter() - t2)
+            outcomes['confirmar', status_c] += 1
+
+
+def pct(samples, p):
+    return samples[min(len(samples) - 1, int(p * len(samples)))] * 1000 if samples else 0.0
+
+
+def main():
+    args = parse_args()
+    if not args.database_url and not args.url:
+        args.database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='carga-'), 'carga.db')
+    if args.database_url: os.environ['DATABASE_URL'] = args.database_url
+    os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+    os.environ.setdefault('BREVO_API_KEY', '')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as appmod
+
+    service_id = args.servico or seed(appmod, args.prefixo, args.recursos)
+    make_client = (lambda: HttpClient(args.url)) if args.url else (lambda: InProcessClient(appmod.app))
+    days = next_weekdays(args.dias)
+    lat, outcomes, lock = defaultdict(list), defaultdict(int), threading.Lock()
+    threads = [threading.Thread(target=customer, args=(make_client, args.prefixo, service_id, days, args.agendamentos, random.Random(args.seed + i), lat, outcomes, lock))
+               for i in range(args.clientes)]
+    started = time_module.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time_module.perf_counter() - started
+
+    print(f"\n{args.clientes} clientes x {args.agendamentos} tentativas em {len(days)} dia(s): {elapsed:.2f}s")
+    print(f"{'etapa':<10} {'req':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  status")
+    for step in STEPS:
+        samples = sorted(lat[step])
+        codes = ' '.join(f"{code}:{n}" for (s, code), n in sorted(outcomes.items()) if s == step)
+        print(f"{step:<10} {len(samples):>6} {len(samples) / elapsed:>8.1f} {pct(samples, .50):>8.1f} {pct(samples, .95):>8.1f} {pct(samples, .99):>8.1f}  {codes}")
+
+    if not args.database_url:
+        print("\nSem --database-url: checagem de sobreposição ignorada."); return 0
+    overlaps, total = find_overlaps(appmod)
+    print(f"\n{total} agendamentos no banco; sobreposições: {len(overlaps)}")
+    for a, b in overlaps[:20]: print(f"  ❌ agendamentos {a} e {b} se sobrepõem")
+    return 1 if overlaps else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# Atributos padrão de LogRecord; o que vier a mais (extra=...) vira campo do JSON
+_STANDARD = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+
+# --- FORMATOS ---
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                'nivel': record.levelname, 'logger': record.name, 'msg': record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in _STANDARD: data[key] = value
+        if record.exc_info: data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        extra = ' '.join(f"{k}={v}" for k, v in vars(record).items() if k not in _STANDARD)
+        return f"{line} {extra}" if extra else line
+
+
+# --- FILA + THREAD DE ESCRITA ---
+class _State:
+    listener = None
+
+
+def setup_logging(level='INFO', levels='', fmt='json', root='agenda'):
+    # Quem loga só enfileira (QueueHandler, sem I/O); uma thread (QueueListener) escreve
+    # no stdout. levels: "agenda.email=DEBUG,agenda.lembretes=WARNING".
+    if _State.listener is not None: return logging.getLogger(root)
+    log_queue = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    logger = logging.getLogger(root)
+    logger.setLevel(level.upper())
+    logger.addHandler(QueueHandler(log_queue))
+    logger.propagate = False
+    for item in filter(None, (p.strip() for p in levels.split(','))):
+        name, _, lvl = item.partition('=')
+        logging.getLogger(name.strip()).setLevel(lvl.strip().upper())
+    _State.listener = QueueListener(log_queue, output, respect_handler_level=True)
+    _State.listener.start()
+    atexit.register(_stop)
+    # A thread de escrita não sobrevive ao fork (gunicorn --preload): cada filho inicia a sua
+    if hasattr(os, 'register_at_fork'): os.register_at_fork(after_in_child=_restart_in_child)
+    return logger
+
+
+def _restart_in_child():
+    if _State.listener is not None:
+        _State.listener._thread = None
+        _State.listener.start()
+
+
+def _stop():
+    if _State.listener is not None and _State.listener._thread is not None:
+        _State.listener.stop()
@@ -0,0 +1,40 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashPoolBusy(Exception):
+    pass
+
+
+# --- HASH DE SENHAS (POOL LIMITADO) ---
+class PasswordHasher:
+    # scrypt/pbkdf2 do hashlib liberam o GIL, então o pool roda hashes em paralelo
+    # sem travar a thread da requisição além do necessário. A fila é limitada:
+    # passou de max_pending, a verificação é recusada em vez de enfileirada.
+    def __init__(self, method='scrypt:32768:8:1', workers=2, max_pending=8, timeout=10.0):
+        self.method = method
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hash')
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False): raise HashPoolBusy()
+        try: future = self._pool.submit(fn, *args)
+        except Exception:
+            self._slots.release(); raise
+        future.add_done_callback(lambda _: self._slots.release())
+        # Fila parada além do prazo é o mesmo caso do pool cheio para quem chamou
+        try: return future.result(timeout=self.timeout)
+        except FutureTimeout: raise HashPoolBusy() from None
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        # Formato werkzeug: "metodo:parametros$salt$hash"
+        return pwhash.split('$', 1)[0] != self.method
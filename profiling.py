@@ -0,0 +1,108 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time as time_module
+from datetime import datetime
+
+log = logging.getLogger('agenda.perfil')
+
+
+# --- PERFIL SOB DEMANDA (cProfile + SQL) ---
+class RequestProfiler:
+    # Perfila uma requisição inteira com cProfile e anota cada SQL com sua duração.
+    # Liga por requisição (cabeçalho de admin) ou por amostragem (sample_rate). Só um
+    # perfil por processo de cada vez: o cProfile é global ao interpretador em versões
+    # novas do Python, então uma requisição concorrente simplesmente não é perfilada.
+    # Desligado, o custo é uma comparação por requisição e um getattr por SQL.
+    def __init__(self, directory, max_files=50, sample_rate=0.0, top=30):
+        self.directory = directory
+        self.max_files = max_files
+        self.sample_rate = sample_rate
+        self.top = top
+        self._busy = threading.Lock()
+        self._local = threading.local()
+
+    def wants(self, forced):
+        return forced or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def start(self, meta):
+        if not self._busy.acquire(blocking=False): return False
+        prof = cProfile.Profile()
+        self._local.run = {'prof': prof, 'sql': [], 'meta': meta, 'started': time_module.perf_counter()}
+        prof.enable()
+        return True
+
+    def active(self):
+        return getattr(self._local, 'run', None) is not None
+
+    # Ligados aos eventos before/after_cursor_execute do SQLAlchemy
+    def sql_start(self, conn, cursor, statement, parameters, context, executemany):
+        if getattr(self._local, 'run', None) is None: return
+        conn.info.setdefault('profile_started', []).append(time_module.perf_counter())
+
+    def sql_end(self, conn, cursor, statement, parameters, context, executemany):
+        run = getattr(self._local, 'run', None)
+        if run is None or not conn.info.get('profile_started'): return
+        elapsed = time_module.perf_counter() - conn.info['profile_started'].pop()
+        run['sql'].append({'ms': round(elapsed * 1000, 3), 'sql': ' '.join(statement.split())[:2000], 'lote': bool(executemany)})
+
+    def finish(self, status=None):
+        run = getattr(self._local, 'run', None)
+        if run is None: return None
+        self._local.run = None
+        try:
+            run['prof'].disable()
+            total = (time_module.perf_counter() - run['started']) * 1000
+            return self._save(run, total, status)
+        except OSError as e:
+            log.error("Erro ao salvar perfil.", extra={'erro': str(e)}); return None
+        finally:
+            self._busy.release()
+
+    def _save(self, run, total_ms, status):
+        os.makedirs(self.directory, exist_ok=True)
+        meta = run['meta']
+        slug = re.sub(r'[^a-zA-Z0-9]+', '-', meta.get('path', '')).strip('-')[:60] or 'raiz'
+        name = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}-{slug}-{int(total_ms)}ms"
+        run['prof'].dump_stats(os.path.join(self.directory, name + '.prof'))
+        text = io.StringIO()
+        pstats.Stats(run['prof'], stream=text).sort_stats('cumulative').print_stats(self.top)
+        sql_ms = sum(q['ms'] for q in run['sql'])
+        summary = {**meta, 'nome': name, 'status': status, 'total_ms': round(total_ms, 2), 'sql_ms': round(sql_ms, 2),
+                   'sql_qtd': len(run['sql']), 'sql': run['sql'], 'funcoes': text.getvalue()}
+        with open(os.path.join(self.directory, name + '.json'), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False)
+        self._rotate()
+        return name
+
+    def _rotate(self):
+        names = sorted(n[:-5] for n in os.listdir(self.directory) if n.endswith('.json'))
+        for old in names[:max(0, len(names) - self.max_files)]:
+            for ext in ('.json', '.prof'):
+                try: os.remove(os.path.join(self.directory, old + ext))
+                except OSError: pass
+
+    def list(self):
+        # Mais recentes primeiro, sem o texto das funções e a lista de SQL
+        try: names = sorted((n[:-5] for n in os.listdir(self.directory) if n.endswith('.json')), reverse=True)
+        except OSError: return []
+        out = []
+        for name in names:
+            try:
+                with open(os.path.join(self.directory, name + '.json'), encoding='utf-8') as f: data = json.load(f)
+            except (OSError, ValueError): continue
+            data.pop('funcoes', None); data.pop('sql', None)
+            out.append(data)
+        return out
+
+    def load(self, name):
+        if not re.fullmatch(r'[\w.-]+', name): return None
+        try:
+            with open(os.path.join(self.directory, name + '.json'), encoding='utf-8') as f: return json.load(f)
+        except (OSError, ValueError): return None
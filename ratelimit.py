@@ -0,0 +1,142 @@
+import os
+import sqlite3
+import threading
+import time as time_module
+from collections import OrderedDict, defaultdict
+
+
+# --- ARMAZENAMENTO DOS BALDES (TOKEN BUCKET) ---
+class MemoryBucketStore:
+    # Baldes no próprio processo. Rápido, mas cada worker do gunicorn tem o seu.
+    def __init__(self, max_keys=50000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, capacity, cost=1.0):
+        now = time_module.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - last) * rate)
+            allowed = tokens >= cost
+            if allowed: tokens -= cost
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys: self._buckets.popitem(last=False)
+        return allowed, (0.0 if allowed else (cost - tokens) / rate)
+
+
+class SQLiteBucketStore:
+    # Baldes compartilhados entre workers via arquivo SQLite local (WAL).
+    def __init__(self, path, prune_every=1000):
+        self.path = path
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._calls = 0
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def take(self, key, rate, capacity, cost=1.0):
+        now = time_module.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, last = row if row else (capacity, now)
+            tokens = min(capacity, tokens + max(0.0, now - last) * rate)
+            allowed = tokens >= cost
+            if allowed: tokens -= cost
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._calls += 1
+        if self._calls % self.prune_every == 0: self.prune(now - 3600)
+        return allowed, (0.0 if allowed else (cost - tokens) / rate)
+
+    def prune(self, older_than):
+        self._conn().execute("DELETE FROM buckets WHERE updated < ?", (older_than,))
+
+
+def make_store(backend, sqlite_path=None):
+    if backend == 'sqlite': return SQLiteBucketStore(sqlite_path)
+    return MemoryBucketStore()
+
+
+# --- MÉTRICAS DE DESCARTE ---
+class ShedMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.allowed = defaultdict(int)
+        self.shed = defaultdict(int)
+
+    def ok(self, endpoint):
+        with self._lock: self.allowed[endpoint] += 1
+
+    def drop(self, endpoint, reason):
+        with self._lock: self.shed[(endpoint, reason)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            shed = {}
+            for (endpoint, reason), n in self.shed.items(): shed.setdefault(endpoint, {})[reason] = n
+            return {'permitidas': dict(self.allowed), 'descartadas': shed}
+
+
+# --- LIMITE DE CONCORRÊNCIA (SEM FILA) ---
+class ConcurrencyGate:
+    def __init__(self, limit):
+        self.limit = limit
+        self._sem = threading.BoundedSemaphore(limit) if limit > 0 else None
+
+    def try_enter(self):
+        return self._sem is None or self._sem.acquire(blocking=False)
+
+    def leave(self):
+        if self._sem is not None: self._sem.release()
+
+
+# --- LIMITADOR ---
+SCOPE_NAMES = {'est': 'estabelecimento', 'user': 'usuario'}
+
+class RateLimiter:
+    # Regras: "endpoint:escopo" -> (taxa por segundo, capacidade). Cada chamada consome
+    # um token do balde do IP e do balde do escopo (estabelecimento, usuário...);
+    # qualquer um vazio descarta.
+    def __init__(self, store, rules, max_concurrent=0, enabled=True):
+        self.store = store
+        self.rules = rules
+        self.gate = ConcurrencyGate(max_concurrent)
+        self.metrics = ShedMetrics()
+        self.enabled = enabled
+
+    def check(self, endpoint, client_ip, scope_key=None, scope='est'):
+        # Retorna (status_http, retry_after); status None significa liberado.
+        if not self.enabled: return None, 0
+        ip_rate, ip_cap = self.rules[endpoint + ':ip']
+        allowed, wait = self.store.take(f"{endpoint}:ip:{client_ip}", ip_rate, ip_cap)
+        if not allowed:
+            self.metrics.drop(endpoint, 'ip'); return 429, wait
+        if scope_key is not None:
+            rate, cap = self.rules[f"{endpoint}:{scope}"]
+            allowed, wait = self.store.take(f"{endpoint}:{scope}:{scope_key}", rate, cap)
+            if not allowed:
+                self.metrics.drop(endpoint, SCOPE_NAMES.get(scope, scope)); return 429, wait
+        return None, 0
+
+    def enter(self, endpoint):
+        if not self.enabled or self.gate.try_enter(): return True
+        self.metrics.drop(endpoint, 'concorrencia')
+        return False
+
+    def leave(self):
+        if self.enabled: self.gate.leave()
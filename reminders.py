@@ -0,0 +1,93 @@
+import heapq
+import logging
+import threading
+import time as time_module
+from datetime import timedelta
+
+log = logging.getLogger('agenda.lembretes')
+
+
+# --- AGENDADOR DE LEMBRETES (HEAP DE PRAZOS) ---
+class ReminderScheduler:
+    # Mantém um min-heap (prazo, agendamento, índice do lembrete) e dorme exatamente
+    # até o próximo prazo. create/delete atualizam o heap na hora; a reconciliação
+    # periódica relê o banco para pegar o que outros workers gravaram.
+    # Cancelamento é preguiçoso: cada agendamento tem uma geração, e entradas de
+    # gerações antigas são descartadas ao sair do heap.
+    def __init__(self, offsets, load_pending, fire, now_fn, reconcile_every=600, grace=600):
+        self.offsets = [timedelta(minutes=m) for m in offsets]  # do maior para o menor
+        self.full_mask = (1 << len(offsets)) - 1
+        self.load_pending = load_pending  # (ate) -> [(id, datetime, mascara_enviados)]
+        self.fire = fire                  # (id, indice) -> None
+        self.now = now_fn
+        self.reconcile_every = reconcile_every
+        self.grace = timedelta(seconds=grace)
+        self._heap = []
+        self._gen = {}
+        self._cond = threading.Condition()
+        self._next_reconcile = 0.0
+
+    @property
+    def horizon(self):
+        # Só entra no heap o que vence antes da próxima reconciliação (com folga)
+        return self.now() + timedelta(seconds=2 * self.reconcile_every)
+
+    def _push(self, appt_id, appt_dt, sent_mask, now, horizon):
+        gen = self._gen.get(appt_id, 0) + 1
+        pushed = False
+        for idx, offset in enumerate(self.offsets):
+            if sent_mask & (1 << idx): continue
+            deadline = appt_dt - offset
+            # Prazo perdido além da tolerância (ex: agendado 30 min antes) não dispara
+            if deadline + self.grace < now or deadline > horizon: continue
+            heapq.heappush(self._heap, (deadline, appt_id, idx, gen)); pushed = True
+        if pushed: self._gen[appt_id] = gen
+        else: self._gen.pop(appt_id, None)
+
+    def schedule(self, appt_id, appt_dt, sent_mask=0):
+        with self._cond:
+            self._push(appt_id, appt_dt, sent_mask, self.now(), self.horizon)
+            self._cond.notify()
+
+    def cancel(self, appt_id):
+        with self._cond: self._gen.pop(appt_id, None)
+
+    def reconcile(self):
+        pending = self.load_pending(self.horizon + max(self.offsets, default=timedelta(0)))
+        now, horizon = self.now(), self.horizon
+        with self._cond:
+            self._heap, self._gen = [], {}
+            for appt_id, appt_dt, sent_mask in pending: self._push(appt_id, appt_dt, sent_mask, now, horizon)
+            self._cond.notify()
+
+    def size(self):
+        with self._cond: return len(self._heap)
+
+    def _pop_due(self):
+        # Espera até o próximo prazo ou a próxima reconciliação; devolve o que venceu
+        with self._cond:
+            while True:
+                while self._heap and self._gen.get(self._heap[0][1]) != self._heap[0][3]:
+                    heapq.heappop(self._heap)
+                until_reconcile = self._next_reconcile - time_module.monotonic()
+                if until_reconcile <= 0: return None
+                if self._heap:
+                    wait = (self._heap[0][0] - self.now()).total_seconds()
+                    if wait <= 0:
+                        _, appt_id, idx, _ = heapq.heappop(self._heap)
+                        return appt_id, idx
+                    self._cond.wait(min(wait, until_reconcile))
+                else:
+                    self._cond.wait(until_reconcile)
+
+    def run(self):
+        while True:
+            try:
+                if time_module.monotonic() >= self._next_reconcile:
+                    self.reconcile()
+                    self._next_reconcile = time_module.monotonic() + self.reconcile_every
+                due = self._pop_due()
+                if due: self.fire(*due)
+            except Exception:
+                log.exception("Erro no worker de lembretes.")
+                time_module.sleep(10)
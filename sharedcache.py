@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time as time_module
+from collections import OrderedDict
+
+from instrumentation import LatencyWindow
+
+log = logging.getLogger('agenda.cache')
+
+
+# --- ESTATÍSTICAS COMUNS ---
+class _Stats:
+    def _init_stats(self):
+        self.hits = self.misses = self.sets = self.errors = 0
+        self.latency = LatencyWindow(1024)
+
+    def stats(self):
+        return {'backend': self.name, 'acertos': self.hits, 'faltas': self.misses, 'gravacoes': self.sets, 'erros': self.errors, 'leitura': self.latency.snapshot()}
+
+
+# --- LRU EM MEMÓRIA (POR PROCESSO) ---
+class LRUCache(_Stats):
+    name = 'memoria'
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._init_stats()
+
+    def get(self, key):
+        started = time_module.perf_counter()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] is not None and item[1] < time_module.monotonic():
+                del self._data[key]; item = None
+            if item is None: self.misses += 1
+            else:
+                self._data.move_to_end(key); self.hits += 1
+        self.latency.observe(time_module.perf_counter() - started)
+        return None if item is None else item[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time_module.monotonic() + ttl if ttl else None)
+            self._data.move_to_end(key)
+            self.sets += 1
+            while len(self._data) > self.max_entries: self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock: self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock: size = len(self._data)
+        return {**super().stats(), 'entradas': size}
+
+
+# --- ARQUIVO SQLITE LOCAL (COMPARTILHADO ENTRE WORKERS) ---
+class SQLiteCache(_Stats):
+    # Valores em JSON num arquivo WAL; também guarda os carimbos de versão dos namespaces.
+    name = 'sqlite'
+
+    def __init__(self, path, prune_every=1000):
+        self.path = path
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._init_stats()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS stamps (ns TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key):
+        started = time_module.perf_counter()
+        row = self._conn().execute("SELECT value, expires FROM entries WHERE key = ?", (key,)).fetchone()
+        if row and row[1] is not None and row[1] < time_module.time(): row = None
+        if row is None: self.misses += 1
+        else: self.hits += 1
+        self.latency.observe(time_module.perf_counter() - started)
+        return None if row is None else json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        self._conn().execute("INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)", (key, json.dumps(value), time_module.time() + ttl if ttl else None))
+        self.sets += 1
+        if self.sets % self.prune_every == 0: self._conn().execute("DELETE FROM entries WHERE expires < ?", (time_module.time(),))
+
+    def delete(self, key):
+        self._conn().execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def stamp(self, ns):
+        row = self._conn().execute("SELECT version FROM stamps WHERE ns = ?", (ns,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, ns):
+        conn = self._conn()
+        conn.execute("INSERT INTO stamps (ns, version) VALUES (?, 1) ON CONFLICT (ns) DO UPDATE SET version = version + 1", (ns,))
+        return self.stamp(ns)
+
+
+# --- REDIS (OPCIONAL) ---
+class RedisCache(_Stats):
+    name = 'redis'
+
+    def __init__(self, url, prefix='agenda:'):
+        import redis  # dependência opcional: só com CACHE_BACKEND=redis
+        self._redis = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.5)
+        self._redis.ping()
+        self.prefix = prefix
+        self._init_stats()
+
+    def get(self, key):
+        started = time_module.perf_counter()
+        raw = self._redis.get(self.prefix + key)
+        if raw is None: self.misses += 1
+        else: self.hits += 1
+        self.latency.observe(time_module.perf_counter() - started)
+        return None if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        self._redis.set(self.prefix + key, json.dumps(value), ex=int(ttl) if ttl else None)
+        self.sets += 1
+
+    def delete(self, key):
+        self._redis.delete(self.prefix + key)
+
+    def stamp(self, ns):
+        return int(self._redis.get(self.prefix + 'stamp:' + ns) or 0)
+
+    def bump(self, ns):
+        return int(self._redis.incr(self.prefix + 'stamp:' + ns))
+
+
+# --- NAMESPACES COM CARIMBO DE VERSÃO ---
+class VersionedCache:
+    # Chaves ficam em "ns@versao:chave". Invalidar um namespace incrementa o carimbo no
+    # armazenamento compartilhado (SQLite ou Redis); as entradas antigas ficam órfãs e
+    # saem por LRU/TTL. Cada worker relê o carimbo no máximo a cada `stamp_ttl`
+    # segundos, então uma invalidação feita em outro worker aparece em até stamp_ttl
+    # (no próprio worker, na hora). Erros do backend viram falta de cache.
+    def __init__(self, backend, stamps, stamp_ttl=2.0):
+        self.backend = backend
+        self.stamps = stamps
+        self.stamp_ttl = stamp_ttl
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def _version(self, ns):
+        now = time_module.monotonic()
+        cached = self._versions.get(ns)
+        if cached and now - cached[1] < self.stamp_ttl: return cached[0]
+        version = self.stamps.stamp(ns)
+        with self._lock:
+            if len(self._versions) > 10000: self._versions.clear()
+            self._versions[ns] = (version, now)
+        return version
+
+    def version(self, ns):
+        # Para quem mantém o próprio índice local: reconstruir quando a versão mudar
+        try: return self._version(ns)
+        except Exception as e:
+            self.backend.errors += 1; log.warning("Falha ao ler o carimbo.", extra={'erro': str(e), 'ns': ns}); return None
+
+    def get(self, ns, key):
+        try: return self.backend.get(f"{ns}@{self._version(ns)}:{key}")
+        except Exception as e:
+            self.backend.errors += 1; log.warning("Falha ao ler do cache.", extra={'erro': str(e)}); return None
+
+    def set(self, ns, key, value, ttl=None):
+        try: self.backend.set(f"{ns}@{self._version(ns)}:{key}", value, ttl)
+        except Exception as e:
+            self.backend.errors += 1; log.warning("Falha ao gravar no cache.", extra={'erro': str(e)})
+
+    def get_or_set(self, ns, key, loader, ttl=None):
+        # Lê o carimbo uma vez só, antes de carregar: se um commit invalidar o namespace
+        # enquanto `loader` roda, o resultado (já velho) fica na versão antiga, órfã,
+        # e não na nova. None não é guardado.
+        try:
+            full = f"{ns}@{self._version(ns)}:{key}"
+            value = self.backend.get(full)
+        except Exception as e:
+            self.backend.errors += 1; log.warning("Falha ao ler do cache.", extra={'erro': str(e)}); return loader()
+        if value is not None: return value
+        value = loader()
+        if value is not None:
+            try: self.backend.set(full, value, ttl)
+            except Exception as e:
+                self.backend.errors += 1; log.warning("Falha ao gravar no cache.", extra={'erro': str(e)})
+        return value
+
+    def invalidate(self, ns):
+        try: version = self.stamps.bump(ns)
+        except Exception as e:
+            self.backend.errors += 1; log.warning("Falha ao invalidar o cache.", extra={'erro': str(e), 'ns': ns}); return
+        with self._lock: self._versions[ns] = (version, time_module.monotonic())
+
+    def stats(self):
+        return {**self.backend.stats(), 'carimbos_ttl_s': self.stamp_ttl}
+
+
+def make_cache(backend, sqlite_path, redis_url=None, max_entries=5000, stamp_ttl=2.0):
+    # memory: valores no processo, carimbos no arquivo SQLite (invalidação chega aos outros workers)
+    # sqlite: valores e carimbos no arquivo; redis: tudo no Redis (cai para memory se indisponível)
+    if backend == 'redis':
+        try:
+            store = RedisCache(redis_url)
+            return VersionedCache(store, store, stamp_ttl)
+        except Exception as e:
+            log.warning("Redis indisponível; usando cache em memória.", extra={'erro': str(e)})
+    if backend == 'sqlite':
+        store = SQLiteCache(sqlite_path)
+        return VersionedCache(store, store, stamp_ttl)
+    return VersionedCache(LRUCache(max_entries), SQLiteCache(sqlite_path), stamp_ttl)
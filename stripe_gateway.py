@@ -0,0 +1,104 @@
+import threading
+import time as time_module
+
+import stripe
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# --- DISJUNTOR (CIRCUIT BREAKER) ---
+class CircuitBreaker:
+    # Fechado: chamadas passam. Aberto: falha imediata até reset_timeout.
+    # Meio-aberto: uma única chamada de teste decide se fecha ou reabre.
+    def __init__(self, failure_threshold=3, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None: return 'fechado'
+        if time_module.monotonic() - self.opened_at >= self.reset_timeout: return 'meio-aberto'
+        return 'aberto'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'fechado': return True
+            if state == 'meio-aberto' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures, self.opened_at, self._probing = 0, None, False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_at = time_module.monotonic()
+            self._probing = False
+
+
+# --- CLIENTE DE CHECKOUT ---
+class StripeCheckout:
+    # Envolve stripe.checkout.Session.create com timeout curto, disjuntor e
+    # reaproveitamento da sessão aberta de cada estabelecimento até expirar.
+    def __init__(self, api_key, price_id, timeout=(2.0, 5.0), api_base=None, session_ttl=3600,
+                 failure_threshold=3, reset_timeout=30.0):
+        self.api_key = api_key
+        self.price_id = price_id
+        self.session_ttl = max(1800, min(session_ttl, 86400))  # limites aceitos pelo Stripe
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._sessions = {}
+        self._lock = threading.Lock()
+        stripe.default_http_client = stripe.RequestsClient(timeout=timeout)
+        stripe.max_network_retries = 0
+        if api_base: stripe.api_base = api_base.rstrip('/')
+
+    @property
+    def configured(self):
+        return bool(self.api_key)
+
+    def checkout_url(self, establishment_id, customer_email, success_url, cancel_url):
+        params = (customer_email, success_url, cancel_url)
+        now = time_module.time()
+        with self._lock:
+            cached = self._sessions.get(establishment_id)
+        # Margem de 60s para o cliente não cair numa sessão que expira no caminho
+        if cached and cached[1] - 60 > now and cached[2] == params: return cached[0]
+        if not self.breaker.allow(): raise CircuitOpenError('Stripe indisponível no momento.')
+        try:
+            session = stripe.checkout.Session.create(
+                api_key=self.api_key,
+                payment_method_types=['card'],
+                line_items=[{'price': self.price_id, 'quantity': 1}],
+                mode='subscription',
+                allow_promotion_codes=True,
+                success_url=success_url,
+                cancel_url=cancel_url,
+                customer_email=customer_email,
+                client_reference_id=str(establishment_id),
+                expires_at=int(now) + self.session_ttl,
+            )
+        except stripe.InvalidRequestError:
+            # Erro de parâmetros não indica API fora do ar
+            self.breaker.success()
+            raise
+        except Exception:
+            self.breaker.failure()
+            raise
+        self.breaker.success()
+        with self._lock:
+            self._sessions[establishment_id] = (session.url, int(now) + self.session_ttl, params)
+        return session.url
+
+    def forget(self, establishment_id):
+        with self._lock: self._sessions.pop(establishment_id, None)
@@ -0,0 +1,48 @@
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _migrate(tmp_path, **env):
+    # Processo separado: o app lê a configuração do ambiente no import
+    env = dict(os.environ, AUTO_MIGRATE='0', BACKGROUND_SERVICES='off', LOG_LEVEL='WARNING', BREVO_API_KEY='',
+               CACHE_SQLITE_PATH=str(tmp_path / 'cache.db'), RATE_LIMIT_SQLITE_PATH=str(tmp_path / 'ratelimit.db'), **env)
+    return subprocess.run([sys.executable, '-c', 'import app; app.migrate()'], cwd=ROOT, env=env, capture_output=True, text=True)
+
+
+def _columns(path, table):
+    with sqlite3.connect(path) as conn:
+        return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def test_migrate_with_unreachable_replica(tmp_path):
+    # Banco da versão base (sem as colunas novas) e réplica inacessível: o primário migra mesmo assim
+    db_path = tmp_path / 'agendamento.db'
+    shutil.copy(os.path.join(ROOT, 'agendamento.db'), db_path)
+    result = _migrate(tmp_path, DATABASE_URL=f'sqlite:///{db_path}', DATABASE_REPLICA_URL='sqlite:////nonexistent/replica.db')
+    assert result.returncode == 0, result.stderr
+    assert {'content_version'} <= _columns(db_path, 'establishments')
+    assert {'reminders_sent', 'client_id'} <= _columns(db_path, 'appointments')
+
+
+def test_migrate_moves_client_copies_to_clients(tmp_path):
+    # As cópias client_* de cada agendamento viram clientes e as colunas saem
+    db_path = tmp_path / 'agendamento.db'
+    shutil.copy(os.path.join(ROOT, 'agendamento.db'), db_path)
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("INSERT INTO establishments (id, name, url_prefix, is_active) VALUES (1, 'Teste', 'teste', 1)")
+        conn.execute("INSERT INTO services (id, name, duration, price, establishment_id) VALUES (1, 'Corte', 30, 40.0, 1)")
+        conn.executemany("INSERT INTO appointments (client_name, client_phone, client_email, appointment_date, appointment_time, notified, service_id, establishment_id) "
+                         "VALUES (?, ?, ?, '2030-01-02', '10:00:00.000000', 0, 1, 1)",
+                         [('Ana', '(11) 98888-1234', 'ana@x.com'), ('Ana Maria', '+55 11 98888-1234', 'ANA@x.com'), ('Bia', '11 97777-0000', 'bia@x.com')])
+    result = _migrate(tmp_path, DATABASE_URL=f'sqlite:///{db_path}')
+    assert result.returncode == 0, result.stderr
+    assert not {'client_name', 'client_phone', 'client_email'} & _columns(db_path, 'appointments')
+    with sqlite3.connect(db_path) as conn:
+        rows = conn.execute('SELECT c.name, c.phone_local FROM appointments a JOIN clients c ON c.id = a.client_id ORDER BY a.id').fetchall()
+    # Mesmo telefone e e-mail normalizados: um cliente só, com o nome mais recente
+    assert rows == [('Ana Maria', '988881234'), ('Ana Maria', '988881234'), ('Bia', '977770000')]